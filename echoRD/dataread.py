@@ -3,7 +3,6 @@
 import numpy as np
 import pandas as pd
 import scipy as sp
-import matplotlib.pyplot as plt
 import scipy.constants as const
 import vG_conv as vG
 import partdyn_d2 as pdyn
@@ -74,103 +73,80 @@ def waterdensity(T,P):
 
 def mc_diffs(mc):
     '''Calculate diffs for D calculation
+       All tables are evaluated at once for the saturation levels (rows) and soils (columns).
     '''
     import numpy as np
-    D=np.empty((101,mc.soilmatrix.no.size))
-    Dcalc=np.empty(101)
-    ku=np.empty(101)
-    kumx=np.empty((101,mc.soilmatrix.no.size))
-    psi=np.empty(101)
-    psimx=np.empty((101,mc.soilmatrix.no.size))
-    theta=np.empty(101)
-    thetamx=np.empty((101,mc.soilmatrix.no.size))
-    dpsidtheta=np.empty(101)
-    dpsidthetamx=np.empty((101,mc.soilmatrix.no.size))
-    cH2O=np.empty(101)
-    cH2Omx=np.empty((101,mc.soilmatrix.no.size))
-    
-
-    for i in np.arange(mc.soilmatrix.no.size):
-        for j in np.arange(101):
-            thetaS=float(j)/100.
-            #ku[j]=mc.soilmatrix.ks[i]*thetaS**0.5*(1.-(1.-thetaS**(1./mc.soilmatrix.m[i]))**mc.soilmatrix.m[i])**2.
-            psi[j]=vG.psi_thst(thetaS,mc.soilmatrix.alpha[i],mc.soilmatrix.n[i],mc.soilmatrix.m[i])
-            ku[j]=vG.ku_psi(psi[j], mc.soilmatrix.ks[i], mc.soilmatrix.alpha[i], mc.soilmatrix.n[i], mc.soilmatrix.m[i])
-            dpsi=vG.psi_thst(np.amin([0.0001,thetaS-0.001]),mc.soilmatrix.alpha[i],mc.soilmatrix.n[i],mc.soilmatrix.m[i])-vG.psi_thst(np.amax([0.9999,thetaS+0.001]),mc.soilmatrix.alpha[i],mc.soilmatrix.n[i],mc.soilmatrix.m[i])
-            
-            #psi=psi/100. #convert to [m]
-            #theta[j]=thetaS*(mc.soilmatrix.ts[i]-mc.soilmatrix.tr[i])+mc.soilmatrix.tr[i]
-            theta[j]=vG.theta_thst(thetaS,mc.soilmatrix.ts[i],mc.soilmatrix.tr[i])
-            dtheta=vG.theta_thst(np.amin([0.0001,thetaS-0.001]),mc.soilmatrix.ts[i],mc.soilmatrix.tr[i])-vG.theta_thst(np.amax([0.9999,thetaS+0.001]),mc.soilmatrix.ts[i],mc.soilmatrix.tr[i])
-            dpsidtheta[j]=dpsi/dtheta
-            cH2O[j]=vG.c_psi(psi[j],mc.soilmatrix.ts[i],mc.soilmatrix.tr[i],mc.soilmatrix.alpha[i], mc.soilmatrix.n[i], mc.soilmatrix.m[i])
-            #dummy=-mc.soilmatrix.m[i]*(1./(1.+np.abs((psi[j])*mc.soilmatrix.alpha[i])**mc.soilmatrix.n[i]))**(mc.soilmatrix.m[i]+1) *mc.soilmatrix.n[i]*(abs(psi[j])*mc.soilmatrix.alpha[i])**(mc.soilmatrix.n[i]-1.)*mc.soilmatrix.alpha[i]
-            #cH2O[j]=-(mc.soilmatrix.ts[i]-mc.soilmatrix.tr[i])*dummy
-            Dcalc[j]=vG.D_psi(psi[j],mc.soilmatrix.ks[i],mc.soilmatrix.ts[i],mc.soilmatrix.tr[i],mc.soilmatrix.alpha[i], mc.soilmatrix.n[i], mc.soilmatrix.m[i])
-        psi[0]=-1.0e+11
-        theta[theta<0.01]=0.01
-        #DI=(ku[:-1]+(np.diff(ku)/2.))*np.diff(psi)/np.diff(theta)
-        #DI[0]=0 #define very low diffusion at zero
-        D[:,i]=Dcalc#/10000. # convert cm2/s -> m2/s
-        D[-1,:]=D[-2,:]
-        psimx[:,i]=psi
-        thetamx[:,i]=theta
-        dpsidthetamx[:,i]=dpsidtheta
-        kumx[:,i]=ku
-        cH2Omx[:,i]=cH2O
+    alpha=mc.soilmatrix.alpha.values[np.newaxis,:]
+    n=mc.soilmatrix.n.values[np.newaxis,:]
+    m=mc.soilmatrix.m.values[np.newaxis,:]
+    ks=mc.soilmatrix.ks.values[np.newaxis,:]
+    ts=mc.soilmatrix.ts.values[np.newaxis,:]
+    tr=mc.soilmatrix.tr.values[np.newaxis,:]
+    thetaS=(np.arange(101)/100.)[:,np.newaxis]
+
+    def psi_thst(th_star):
+        #vG.psi_thst without replacing infinite heads (as for scalar input)
+        return -1./alpha * ( (1-th_star**(1/m))/(th_star**(1/m)) )**(1./n)
+
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        psi=psi_thst(thetaS)
+        ku=vG.ku_psi(psi,ks,alpha,n,m)
+        dpsi=psi_thst(np.fmin(0.0001,thetaS-0.001))-psi_thst(np.fmax(0.9999,thetaS+0.001))
+
+        #psi=psi/100. #convert to [m]
+        theta=vG.theta_thst(thetaS,ts,tr)
+        dtheta=vG.theta_thst(np.fmin(0.0001,thetaS-0.001),ts,tr)-vG.theta_thst(np.fmax(0.9999,thetaS+0.001),ts,tr)
+        dpsidtheta=dpsi/dtheta
+        cH2O=vG.c_psi(psi,ts,tr,alpha,n,m)
+        #diffusivity as in vG.D_psi: ku*0.1 over the change of theta in the last 0.05 of psi
+        dth=vG.theta_thst(vG.thst_psi(psi,alpha,n,m),ts,tr)-vG.theta_thst(vG.thst_psi(psi-0.05,alpha,n,m),ts,tr)
+        D=vG.ku_psi(psi,ks,alpha,n,m)*0.1/dth
+    psi[0,:]=-1.0e+11
+    theta[theta<0.01]=0.01
+    D[-1,:]=D[-2,:]
 
 #DEBUG: Diffusive Flux is overestimated!
 #       THIS NEEDS THROUGOUT TESTING
 #       SET D SMALL ENOUGH FOR NOW.
 
     mc.D=np.abs(D)
-    mc.psi=psimx
-    mc.theta=thetamx
-    mc.ku=kumx
-    mc.cH2O=cH2Omx
-    mc.dpsidtheta=dpsidthetamx
+    mc.psi=psi
+    mc.theta=theta
+    mc.ku=ku
+    mc.cH2O=cH2O
+    mc.dpsidtheta=dpsidtheta
 
 #DEBUG: This is thetaS based. 
 #       However, we may need a psi based approach since this 
 #       is establishing the respective gradient.
-    ku=np.empty(121)
-    p_kumx=np.empty((121,mc.soilmatrix.no.size))
-    theta=np.empty(121)
-    p_thetamx=np.empty((121,mc.soilmatrix.no.size))
-    cH2O=np.empty(121)
-    p_cH2Omx=np.empty((121,mc.soilmatrix.no.size))
-
-    for i in np.arange(mc.soilmatrix.no.size):
-        for j in np.arange(121):
-            psi=-10**((float(j)/10.)-2.)
-            v = 1. + (mc.soilmatrix.alpha[i]* np.abs(psi))**mc.soilmatrix.n[i]
-            ku[j] = (mc.soilmatrix.ks[i] * (1. - ((mc.soilmatrix.alpha[i]*np.abs(psi))**(mc.soilmatrix.n[i]-1))*(v**(-mc.soilmatrix.m[i])) )**2. / (v**(mc.soilmatrix.m[i]*0.5)))/3600.
-            thetaS = (1./(1.+(psi*mc.soilmatrix.alpha[i])**mc.soilmatrix.n[i]))**mc.soilmatrix.m[i]
-            theta[j]=thetaS*(mc.soilmatrix.ts[i]-mc.soilmatrix.tr[i])+mc.soilmatrix.tr[i]
-            dummy=-mc.soilmatrix.m[i]*(1./(1.+np.abs(psi*mc.soilmatrix.alpha[i])**mc.soilmatrix.n[i]))**(mc.soilmatrix.m[i]+1.) *mc.soilmatrix.n[i]*(np.abs(psi)*mc.soilmatrix.alpha[i])**(mc.soilmatrix.n[i]-1.)*mc.soilmatrix.alpha[i]
-            cH2O[j]=-(mc.soilmatrix.ts[i]-mc.soilmatrix.tr[i])*dummy
-
-        p_thetamx[:,i]=theta
-        p_kumx[:,i]=ku
-        p_cH2Omx[:,i]=cH2O
-
-    mc.p_th=p_thetamx
-    mc.p_ku=p_kumx
-    mc.p_cH2O=p_cH2Omx
-
-    #get FC at psi = -0.33 bar
+    psi=-10**((np.arange(121)/10.)-2.)[:,np.newaxis]
+    with np.errstate(invalid='ignore'):
+        v = 1. + (alpha* np.abs(psi))**n
+        ku = (ks * (1. - ((alpha*np.abs(psi))**(n-1))*(v**(-m)) )**2. / (v**(m*0.5)))/3600.
+        thetaS = (1./(1.+(psi*alpha)**n))**m
+        theta=thetaS*(ts-tr)+tr
+        dummy=-m*(1./(1.+np.abs(psi*alpha)**n))**(m+1.) *n*(np.abs(psi)*alpha)**(n-1.)*alpha
+        cH2O=-(ts-tr)*dummy
+
+    mc.p_th=theta
+    mc.p_ku=ku
+    mc.p_cH2O=cH2O
+
+    #get FC at psi = -0.33 bar (first level in range for each soil)
     idx = (np.abs(mc.psi)>0.30*9.81)
     idy = (np.abs(mc.psi)<0.35*9.81)
-    idz = np.where(idx*idy)
-    idf = np.zeros(np.shape(mc.psi)[1],dtype=int)
-    for i in np.unique(idz[1]):
-        idf[i] = idz[0][np.where(idz[1]==i)[0][0]]
-    mc.FC=idf
+    idz = idx*idy
+    mc.FC=np.where(idz.any(axis=0),np.argmax(idz,axis=0),0)
 
     return mc
 
 
-def dataread_caos(mc):
+def dataread_caos(mc,plot=True):
+    '''Model setup from the mcini definitions and input files
+       plot: show the macropore image analysis and interface setup (off for headless runs)
+       The image stack is segmented by mc.nproc processes (default: number of cpus) and the
+       layers are cached in mc.cachedir if it is set (default None: no cache).
+    '''
     macbase=pd.read_csv(mc.macbf, sep=' ')
     tracerbase=pd.read_csv(mc.tracerbf, sep='\t')
     soilmatrix=pd.read_csv(mc.matrixbf, sep=' ')
@@ -210,18 +186,9 @@ def dataread_caos(mc):
     if mc.nomac==False:
         #READ MACROPORE DATA FROM IMAGE FILES
         mac=pd.read_csv(mc.macimg, sep=',')
-        patch_def=mpo.macfind_g(mac.file[0],[mac.threshold_l[0],mac.threshold_u[0]])
-        patch_dummy=patch_def.copy()*0.
-
-        for i in np.arange(len(mac)-1)+1:
-            patchnow=mpo.macfind_g(mac.file[i],[mac.threshold_l[i],mac.threshold_u[i]])
-            if isinstance(patchnow,pd.DataFrame):
-                patch_def=patch_def.append(patchnow)
-            else:
-                patch_def=patch_def.append(patch_dummy)
+        patch_def=mpo.macfind_layers(mac,getattr(mc,'nproc',None),getattr(mc,'cachedir',None),plot)
 
         #join macropore definitions
-        patch_def=patch_def.set_index(np.arange(len(mac)))
         mac=mac.join(patch_def)
 
         #get macropore share at advection vector
@@ -265,7 +232,7 @@ def dataread_caos(mc):
 
     mc=mpo.mac_matrix_setup(mac,mc)
     mc.soilmatrix=soilmatrix
-    if mc.nomac==False:
+    if (mc.nomac==False) & plot:
         mpo.mac_plot(mc.macP)
     mc=mc_diffs(mc)
     mc.prects=False
@@ -274,6 +241,23 @@ def dataread_caos(mc):
     return mc #[mc,soilmatrix,macP,mac,macid,macconnect,soilgrid,matrixdef,mc.mgrid]
 
 
+def particle_init(npart,mc):
+    '''Setup of the particle domain from the number of particles per grid cell (npart)
+       The particles are ordered by cell and placed at random within their cell.
+       Fast lane and advective velocity are sampled with pdyn.assignadvect.
+    '''
+    npartr=npart.ravel()
+    cell=np.repeat(np.arange(len(npartr)),npartr)
+    rw,cl=np.unravel_index(cell,np.shape(npart))
+    no=len(cell)
+    particles=pd.DataFrame(np.zeros((no,8)),columns=['lat', 'z', 'conc', 'temp', 'age', 'flag', 'fastlane', 'advect'])
+    particles['lat']=(cl+np.random.rand(no))*mc.mgrid.latfac.values
+    particles['z']=(rw+np.random.rand(no))*mc.mgrid.vertfac.values
+    particles['cell']=cell
+    particles['fastlane']=np.random.randint(len(mc.t_cdf_fast.T), size=no)
+    particles['advect']=pdyn.assignadvect(no,mc,particles.fastlane.values,True)
+    return particles
+
 def particle_setup(mc):
     # read ini moist
     inimoistbase=pd.read_csv(mc.inimf, sep=',')
@@ -308,28 +292,17 @@ def particle_setup(mc):
 
     # convert theta to particles
     # npart=moistdomain*(2*mc.part_sizefac)
-    npart=np.floor(mc.part_sizefac*vG.thst_theta(moistdomain,mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)), mc.soilmatrix.tr[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)))).astype(int)
+    npart=mc.part_sizefac*vG.thst_theta(moistdomain,mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)), mc.soilmatrix.tr[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)))
+    if getattr(mc,'prects',False)=='radial':
+        #ring volume of the cells in the axisymmetric domain
+        npart*=mc.radfac
+    npart=np.floor(npart).astype(int)
 
     # setup particle domain
-    particles=pd.DataFrame(np.zeros(int(np.sum(npart))*8).reshape(int(np.sum(npart)),8),columns=['lat', 'z', 'conc', 'temp', 'age', 'flag', 'fastlane', 'advect'])
-    particles['cell']=pd.Series(np.zeros(int(np.sum(npart)),dtype=int), index=particles.index)
-    # distribute particles
-    k=0
-    npartr=npart.ravel()
-    cells=len(npartr)
-
-    for i in np.arange(cells):
-        j=int(npartr[i])
-        particles.cell[k:(k+j)]=i
-        rw,cl=np.unravel_index(i,(mc.mgrid.vertgrid,mc.mgrid.latgrid))
-        particles.lat[k:(k+j)]=(cl+np.random.rand(j))*mc.mgrid.latfac.values
-        particles.z[k:(k+j)]=(rw+np.random.rand(j))*mc.mgrid.vertfac.values
-        k+=j
-
-    particles.fastlane=np.random.randint(len(mc.t_cdf_fast.T), size=len(particles))
-    particles.advect=pdyn.assignadvect(int(np.sum(npart)),mc,particles.fastlane.values,True)
+    particles=particle_init(npart,mc)
 
-    mc.mgrid['cells']=cells
-    return [mc,particles.iloc[0:k,:],npart]
+    mc.mgrid['cells']=npart.size
+    pdyn.mac_geometry_setup(mc)
+    return [mc,particles,npart]
 
 
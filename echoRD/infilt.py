@@ -1,9 +1,176 @@
 import numpy as np
 import scipy as sp
-import scipy.stats as sps
 import pandas as pd
+import os
+import hashlib
+import tempfile
 
-def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec_2D=False,lastidx=0,method='MDA',infiltscale=False):
+def prec_schedule(precip,mc):
+    '''Forcing schedule of the precipitation input, built once per run.
+       The time axis is divided at the breakpoints tb into intervals of constant forcing,
+       interval k ends at tb[k] (the first and the last interval are open).
+       Adjacent intervals with the same forcing are merged, so each breakpoint is a change of forcing.
+       mc.prects==True: nearest entry of the time series (breakpoints at the midpoints between entries)
+       else: reference table of (not overlapping) events with tstart and tend, no forcing outside the events
+
+       Output: [tb,intense,conc,side,cursor] for prec_lookup
+    '''
+    if mc.prects==True:
+        tp=np.asarray(precip.index,dtype=float)
+        order=np.argsort(tp,kind='mergesort')
+        tb=0.5*(tp[order][1:]+tp[order][:-1])
+        intense=precip.intense.values[order].astype(float)
+        conc=np.where(intense>0.,precip.conc.values[order],0.)
+        return prec_merge(tb,intense,conc,'left')
+    return prec_events(precip.tstart.values,precip.tend.values,precip.intense.values,precip.conc.values)
+
+def prec_events(tstart,tend,intense,conc):
+    '''Forcing schedule (see prec_schedule) of a table of events
+    '''
+    tstart=np.asarray(tstart,dtype=float)
+    tend=np.asarray(tend,dtype=float)
+    if len(tstart)==0:
+        return prec_merge(np.array([]),np.zeros(1),np.zeros(1),'right')
+    order=np.argsort(tstart,kind='mergesort')
+    tb=np.unique(np.append(tstart,tend))
+    #the event started last before the begin of each interval (none before the first breakpoint)
+    ev=np.searchsorted(tstart[order],tb,side='right')-1
+    ev=order[np.fmax(ev,0)]
+    active=np.append(False,(tstart[ev]<=tb) & (tend[ev]>tb))
+    ev=np.append(0,ev)
+    return prec_merge(tb,np.where(active,np.asarray(intense)[ev],0.),np.where(active,np.asarray(conc)[ev],0.),'right')
+
+def prec_merge(tb,intense,conc,side):
+    '''Schedule from the breakpoints tb and the forcing of the intervals between them,
+       adjacent intervals with the same forcing are merged
+    '''
+    keep=(intense[1:]!=intense[:-1]) | (conc[1:]!=conc[:-1])
+    return [tb[keep],intense[np.append(True,keep)],conc[np.append(True,keep)],side,np.zeros(1,dtype=int)]
+
+def prec_lookup(ti,schedule):
+    '''Forcing at time ti from the schedule (see prec_schedule)
+       The cursor of the schedule keeps the interval of the last lookup, so advancing
+       in time is O(1). Otherwise the interval is found with searchsorted.
+       Outputs: 1 intensity, 2 concentration, 3 time of the next change of forcing (inf if none)
+    '''
+    [tb,intense,conc,side,cursor]=schedule
+
+    def inside(k):
+        #ti in interval k
+        if (k<0) | (k>len(tb)):
+            return False
+        if side=='left':
+            return ((k==0) or (tb[k-1]<ti)) and ((k==len(tb)) or (ti<=tb[k]))
+        return ((k==0) or (tb[k-1]<=ti)) and ((k==len(tb)) or (ti<tb[k]))
+
+    k=cursor[0]
+    if not inside(k):
+        if inside(k+1):
+            k+=1
+        else:
+            k=np.searchsorted(tb,ti,side=side)
+    cursor[0]=k
+    if k<len(tb):
+        tnext=tb[k]
+    else:
+        tnext=np.inf
+    return [intense[k],conc[k],tnext]
+
+def prec_cachefile(precf,cachedir=None):
+    '''Name of the binary cache of the forcing file precf: precf+'.npy' next to the file,
+       in cachedir if given (named after the file and a hash of its path) or in the
+       temporary directory if the directory of the file is not writable
+    '''
+    if cachedir is None:
+        if os.access(os.path.dirname(os.path.abspath(precf)),os.W_OK):
+            return precf+'.npy'
+        cachedir=tempfile.gettempdir()
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    key=hashlib.sha1(os.path.abspath(precf)).hexdigest()[:12]
+    return os.path.join(cachedir,os.path.basename(precf)+'.'+key+'.npy')
+
+def prec_cache(precf,chunksize=100000,cachedir=None):
+    '''Binary cache of a forcing file in the CAOS irrigation format
+       (three comment lines, columns tstart,tend,total,intense,conc).
+       The file is converted once in chunks of rows into a cache (see prec_cachefile) holding
+       the rows tstart, tend, intense and conc (an intensity of -9999 is taken from total over
+       the duration, a concentration of -9999 is set to 0).
+       The events must be sorted by tstart and must not overlap (tend before the next tstart),
+       else a ValueError is raised. It is rebuilt if the forcing file is newer than the cache.
+       Output: memory mapped cache for prec_window
+    '''
+    cachef=prec_cachefile(precf,cachedir)
+    if (not os.path.exists(cachef)) or (os.path.getmtime(cachef)<os.path.getmtime(precf)):
+        header=pd.read_csv(precf,sep=',',skiprows=3,nrows=0).columns
+        missing=[c for c in ['tstart','tend','total','intense','conc'] if c not in header]
+        if len(missing)>0:
+            raise ValueError(precf+' is no event table in the CAOS irrigation format, missing columns: '+', '.join(missing))
+        #convert rows in chunks to a raw temporary file
+        tmpf=cachef+'.tmp'
+        fo=open(tmpf,'wb')
+        try:
+            lastend=-np.inf
+            for chunk in pd.read_csv(precf,sep=',',skiprows=3,chunksize=chunksize):
+                ev=chunk[['tstart','tend','intense','conc']].values.astype(float)
+                #each event starts at or after the end of the previous one (prec_window searches tend)
+                prevend=np.append(lastend,ev[:-1,1])
+                if np.any(ev[:,0]<prevend):
+                    i=np.where(ev[:,0]<prevend)[0][0]
+                    raise ValueError(precf+': the events are not sorted by tstart or overlap at tstart='+str(ev[i,0]))
+                lastend=ev[-1,1]
+                miss=(ev[:,2]==-9999.)
+                ev[miss,2]=chunk.total.values[miss]/(ev[miss,1]-ev[miss,0])
+                ev[ev[:,3]==-9999.,3]=0.
+                ev.tofile(fo)
+            fo.close()
+            rows=np.memmap(tmpf,dtype=float,mode='r').reshape(-1,4)
+            n=len(rows)
+            #column-wise cache, so that each column is contiguous for searchsorted
+            cache=np.lib.format.open_memmap(cachef+'.part',mode='w+',dtype=float,shape=(4,n))
+            for i in np.arange(0,n,chunksize):
+                cache[:,i:i+chunksize]=rows[i:i+chunksize].T
+            del cache,rows
+        except:
+            if os.path.exists(cachef+'.part'):
+                os.remove(cachef+'.part')
+            raise
+        finally:
+            fo.close()
+            os.remove(tmpf)
+        if os.path.exists(cachef):
+            os.remove(cachef)
+        os.rename(cachef+'.part',cachef)
+    return np.load(cachef,mmap_mode='r')
+
+def prec_stream(precf,mc,chunksize=100000):
+    '''Binary cache (prec_cache) of the forcing file precf for the drivers, which stream it in time windows.
+       The cache is written to mc.cachedir if it is set.
+       Only reference tables of events can be streamed, a time series (mc.prects==True)
+       is passed to the drivers as data frame (see prec_schedule).
+    '''
+    if mc.prects==True:
+        raise ValueError('the forcing time series (mc.prects==True) cannot be streamed from '+precf+', pass it as data frame')
+    return prec_cache(precf,chunksize,getattr(mc,'cachedir',None))
+
+def prec_window(cache,t0,t1):
+    '''Forcing schedule (see prec_schedule) of the time window [t0,t1) from the cache (prec_cache).
+       Only the events of the window are read from the cache. The schedule gets a breakpoint at t1,
+       the forcing is not defined beyond the window.
+       Outputs: 1 schedule, 2 end of window
+    '''
+    #events ending after t0 and starting before t1 (not overlapping, so tend is sorted too, see prec_cache)
+    i0=np.searchsorted(cache[1],t0,side='right')
+    i1=np.fmax(np.searchsorted(cache[0],t1,side='left'),i0)
+    ev=np.array(cache[:,i0:i1])
+    schedule=prec_events(ev[0],ev[1],ev[2],ev[3])
+    if (len(schedule[0])==0) or (schedule[0][-1]<t1):
+        schedule[0]=np.append(schedule[0],t1)
+        schedule[1]=np.append(schedule[1],schedule[1][-1])
+        schedule[2]=np.append(schedule[2],schedule[2][-1])
+    return [schedule,t1]
+
+def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec_2D=False,lastidx=0,method='MDA',infiltscale=False,schedule=None):
     '''Infiltration Routine for echoRD Model
        (cc) jackisch@kit.edu 2014
 
@@ -23,6 +190,7 @@ def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec
        dt: time step [s]
        precip: pandas data frame of precipitation as time series or reference table
                mc.prects specifies if this is a time series (True) or reference table (False)
+               ('column'/'radial' for volume input to column setups)
        prec_part: accumulated precipitation which has not yet reached the mass of one full particle
        mc: parameters and references of echoRD model
        pdyn: particle dynamics routines of echoRD model
@@ -31,9 +199,10 @@ def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec
                 True if input is given in volume to whole domain [m3/s], False when given in [m/s]
        lastidx: last index of particle domain to give unique and traceable particle IDs
        method: method of redistribution of infiltrating particles (see above)
+       schedule: forcing schedule of precip (prec_schedule or prec_window), built on the fly if not given
 
        OUTPUTS
-       particles_infilt: pandas data frame of new particles to be concatenated to particle data frame
+       particles_infilt: arrays of the new particles by column (labels in 'index') for particles_append
        prec_part: precipitation below the mass/volume of one particle for accumulation
        acc_mxinf: infiltration accumulation (important for very small time steps)
     '''
@@ -42,85 +211,48 @@ def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec
     # DEBUG: handle later w/ time series
     T=np.array(9)
 
-    # get timestep in prec time series and referenced precipitation
-    if mc.prects==True:
-        prec_id=np.argmin([np.abs(precip.index[x]-ti) for x in range(len(precip))])
-        if precip.intense.iloc[prec_id]>0.:
-            if prec_2D:
-                #precip as m3/s
-                prec_part+=precip.intense.values[prec_id]*dt/mc.particleV
-            else:
-                #precip as m/s
-                prec_part+=precip.intense.values[prec_id]*dt*mc.mgrid.width.values/mc.particleA
-            prec_avail=np.floor(prec_part)
-            prec_part-=prec_avail
-            prec_avail=int(prec_avail)
-            
-            prec_c=precip.conc.values[prec_id]
-        else:
-            prec_avail=0
-            prec_c=0.
-    elif mc.prects=='column':
-        prec_id=np.where((precip.tstart<=ti) & (precip.tend>ti))[0]
-        if np.size(prec_id)>0:
-            #prec_part+=precip.intense.values[prec_id]*dt/(36.*mc.particleV) #get true particle number for 5 degree open circle segment
-            prec_part+=precip.intense.values[prec_id]*dt/mc.particleV
-            prec_avail=np.floor(prec_part)
-            prec_part-=prec_avail
-            prec_avail=int(prec_avail)
-            #avail. water particles
-            prec_c=precip.conc.values[prec_id[0]]
+    # get forcing of the time step from the schedule
+    if schedule is None:
+        schedule=prec_schedule(precip,mc)
+    [intense,prec_c,tnext]=prec_lookup(ti,schedule)
+    if intense>0.:
+        if mc.prects=='radial':
+            #one radial half-plane represents both mirrored halves of the column
+            prec_part+=0.5*intense*dt/mc.particleV
+        elif (mc.prects=='column') | prec_2D:
+            #precip as m3/s
+            prec_part+=intense*dt/mc.particleV
         else:
-            prec_avail=0
-            prec_c=0.
+            #precip as m/s
+            prec_part+=intense*dt*mc.mgrid.width.values/mc.particleA
+            #maybe a third option is needed if precip is given as kg/s
+            #prec_part+=intense*dt*1000./mc.particlemass #1000. to convert to g->kg
+        prec_avail=np.floor(prec_part)
+        prec_part-=prec_avail
+        prec_avail=int(prec_avail)
     else:
-        prec_id=np.where((precip.tstart<=ti) & (precip.tend>ti))[0]
-        if np.size(prec_id)>0:
-            #prec_avail=np.round(precip.intense.values[prec_id]*dt*mc.refarea*waterdensity(T,np.array(-9999))/mc.particlemass)
-            if prec_2D:
-                #precip as m3/s
-                prec_part+=precip.intense.values[prec_id]*dt/mc.particleV
-            else:
-                #precip as m/s
-                prec_part+=precip.intense.values[prec_id]*dt*mc.mgrid.width.values/mc.particleA
-                #maybe a third option is needed if precip is given as kg/s
-                #prec_part+=precip.intense.values[prec_id]*dt*1000./mc.particlemass #1000. to convert to g->kg
-            prec_avail=np.floor(prec_part)
-            prec_part-=prec_avail
-            prec_avail=int(prec_avail)
-            
-            #avail. water particles
-            prec_c=precip.conc.values[prec_id[0]]
-        else:
-            prec_avail=0
-            prec_c=0.
+        prec_avail=0
 
     # reset particle definition in infilt container
-    prec_potinf=prec_avail+prec_leftover
+    prec_potinf=int(prec_avail+prec_leftover)
     
     if prec_potinf>0:
-        particles_infilt=pd.DataFrame(np.zeros(prec_potinf*9).reshape(prec_potinf,9),columns=['lat', 'z', 'conc', 'temp', 'age', 'flag', 'fastlane', 'advect','cell'])
-        # place particles at surface and redistribute later according to ponding
-        particles_infilt.z=-0.00001
-        particles_infilt.lat=np.random.rand(prec_potinf)*mc.mgrid.width.values
-        particles_infilt.conc=prec_c
-        particles_infilt.temp=T
-        particles_infilt.age=ti
-        particles_infilt.flag=0
-        particles_infilt.fastlane=np.random.randint(len(mc.t_cdf_fast.T), size=prec_potinf)
-        particles_infilt.advect=0.
+        # new particles are placed at surface and redistributed later according to ponding
+        lat=np.random.rand(prec_potinf)*mc.mgrid.width.values
+        flag=np.zeros(prec_potinf,dtype=int)
+        fastlane=np.random.randint(len(mc.t_cdf_fast.T), size=prec_potinf)
+        advect=np.zeros(prec_potinf)
 
         #cases for single or multiple macropore configuration
         if type(mc.nomac)==float:
             #single macropore defined
-            idx_adv=prec_potinf #all particles selected
-            particles_infilt.lat=mc.md_pos[0] #all into first cell
-            particles_infilt.flag=1
-            particles_infilt.advect=pdyn.assignadvect(prec_potinf,mc,particles_infilt.fastlane.values,True)
+            lat[:]=mc.md_pos[0] #all into first cell
+            flag[:]=1
+            advect=pdyn.assignadvect(prec_potinf,mc,fastlane,True)
 
         elif mc.nomac!=True:
             # assign to different macropores
-            particles_infilt.advect=pdyn.assignadvect(prec_potinf,mc,particles_infilt.fastlane.values,True)
+            advect=pdyn.assignadvect(prec_potinf,mc,fastlane,True)
             a=True
             activem=np.repeat(a,len(mc.md_pos)) #DEBUG: make dynamic!
 
@@ -129,39 +261,39 @@ def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec
                 # first layer as contact layer to surface
                 # take cell numbers (binned data) and allow all but one for free drain
                 if infiltscale:
-                    nearby=(mc.mgrid.width/(2.*sum(activem)))*infiltscale
-                    slots=[]
-                    for k in np.where(activem)[0]:
-                        slots=np.concatenate([slots,np.arange(mc.md_pos[k]-nearby,mc.md_pos[k]+nearby,mc.particleD)])
+                    nearby=np.asarray(mc.mgrid.width/(2.*sum(activem))*infiltscale).ravel()[0]
+                    slots=macslots(mc.md_pos[activem],nearby,mc.particleD[0])
                     redist=np.random.randint(len(slots), size=prec_potinf)
-                    particles_infilt.lat=slots[redist]
+                    lat=slots[redist]
 
-                particles_infilt.cell=pdyn.cellgrid(particles_infilt.lat,particles_infilt.z,mc).astype(int)
-                ucellfreq=sps.itemfreq(particles_infilt.cell.values)
-                freeparts=np.sum(ucellfreq[ucellfreq[:,1]>0.,1]-1.)
+                cellfreq=np.bincount(pdyn.cellgrid(lat,np.repeat(-0.00001,prec_potinf),mc).astype(int))
+                freeparts=prec_potinf-np.count_nonzero(cellfreq)
                 if infiltscale:
-                    freeparts+=np.sum(ucellfreq[ucellfreq[:,1]==1.,1])*(1.-infiltscale)
+                    freeparts+=np.sum(cellfreq==1)*(1.-infiltscale)
                 
                 # select number of free particles from particles_infilt at random (without proper reference of their position as it was there at random anyways)
                 idx_adv=np.random.randint(prec_potinf,size=int(freeparts))
-                idx_red=macredist(particles_infilt.lat.values[idx_adv],mc,activem)
+                idx_red=macredist(lat[idx_adv],mc,activem)
             elif method=='MED':
                 # infiltration based on maximum free energy dissipation
                 [mx_infp,idx_red,acc_mxinf]=maxEinf(prec_potinf,acc_mxinf,thS,dt,mc)
-                particles_infilt.flag.iloc[0:mx_infp]=0
                 idx_adv=np.arange(prec_potinf)[mx_infp:prec_potinf]
             # assign incidences to particles
-            particles_infilt.flag.iloc[idx_adv]=idx_red
-            particles_infilt.lat.iloc[idx_adv]=mc.md_pos[idx_red-1]+(np.random.rand(len(idx_adv))-0.5)*mc.mgrid.vertfac.values  
+            flag[idx_adv]=idx_red
+            lat[idx_adv]=mc.md_pos[idx_red-1]+(np.random.rand(len(idx_adv))-0.5)*mc.mgrid.vertfac.values  
 
-        particles_infilt.cell=pdyn.cellgrid(particles_infilt.lat,particles_infilt.z,mc).astype(int)
-        #if any(particles_infilt.cell<0):
+        z=np.repeat(-0.00001,prec_potinf)
+        cell=pdyn.cellgrid(lat,z,mc).astype(int)
+        #if any(cell<0):
         #    print 'cell error at infilt'
 
-        particles_infilt.index+=lastidx+1
+        # columns of the new particles to be appended to the particle store (particles_append)
+        particles_infilt={'index':np.arange(prec_potinf)+lastidx+1, 'lat':lat, 'z':z, 'conc':np.repeat(float(prec_c),prec_potinf),
+                          'temp':np.repeat(float(T),prec_potinf), 'age':np.repeat(float(ti),prec_potinf), 'flag':flag.astype(float),
+                          'fastlane':fastlane.astype(float), 'advect':advect, 'cell':cell}
 
     else:
-        particles_infilt=pd.DataFrame([])
+        particles_infilt={'index':np.arange(0)}
 
     #handle infiltration water as such, that it is prepared to take part in the standard operation
     #a particle is about 1 mm diameter at ks of 10-4m/s a time step of about 10 seconds is maybe a good start
@@ -169,24 +301,52 @@ def pmx_infilt(ti,precip,prec_part,acc_mxinf,thS,mc,pdyn,dt,prec_leftover=0,prec
     return [particles_infilt,prec_part,acc_mxinf]
 
 
+def particles_append(particles,p_inf):
+    '''Append the new particles p_inf (arrays by column of pmx_infilt) to the particle frame.
+       Each column is extended by the new values and the frame is rebuilt once from the columns,
+       without a frame of the new particles and its alignment in pd.concat.
+       Columns missing in p_inf are filled with nan.
+    '''
+    n=len(p_inf['index'])
+    if n==0:
+        return particles
+    cols={}
+    for c in particles.columns:
+        new=p_inf[c] if c in p_inf else np.repeat(np.nan,n)
+        cols[c]=np.append(particles[c].values,new).astype(np.result_type(particles[c].dtype,np.asarray(new).dtype))
+    return pd.DataFrame(cols,index=np.append(particles.index.values,p_inf['index']),columns=particles.columns)
+
 def macredist(lat,mc,activem):
     '''Distribute infiltration to macropores according to macropore drainage area
        Input: lateral position array, mc, bool mask of active macropores, mc.mgrid
        Output: index vector which macropore was appointed
     '''
+    rightbound=macdrainbounds(mc,activem)
+    activemacs=np.where(activem==True)[0]
+    #the first drainage area wraps around the domain boundary
+    latid=np.searchsorted(rightbound,lat,side='right')
+    latid[latid==len(rightbound)]=0
+    
+    return activemacs[latid]
+
+def macdrainbounds(mc,activem):
+    '''Right boundaries of the macropore drainage areas (midpoints to the next active macropore).
+       Stored as mc.md_drainbound for all macropores active.
+    '''
+    if all(activem) & hasattr(mc,'md_drainbound'):
+        return mc.md_drainbound
     m_dist=np.diff(np.append(mc.md_pos[activem],mc.mgrid.width+mc.md_pos[0]))/2
     rightbound=mc.md_pos[activem]+m_dist
-    activemacs=np.where(activem==True)
-    latid=np.zeros(lat.shape, dtype=int)
-    for i in np.arange(len(rightbound)):
-        if i==0:
-            macid=np.where((lat<rightbound[0]) | (lat>=rightbound[-1]))
-        else:
-            macid=np.where((lat<rightbound[i]) & (lat>=rightbound[i-1]))
-    
-        latid[macid]=activemacs[0][i]
-    
-    return latid
+    if all(activem):
+        mc.md_drainbound=rightbound
+    return rightbound
+
+def macslots(pos,nearby,particleD):
+    '''Infiltration slots (particle diameter steps) within nearby around the macropore positions pos
+    '''
+    nslot=np.ceil(((pos+nearby)-(pos-nearby))/particleD).astype(int)
+    offset=np.cumsum(nslot)-nslot
+    return np.repeat(pos-nearby,nslot)+(np.arange(np.sum(nslot))-np.repeat(offset,nslot))*particleD
 
 
 def maxEinf(prec_potinf,acc_mxinf,thS,dt,mc):
@@ -197,28 +357,26 @@ def maxEinf(prec_potinf,acc_mxinf,thS,dt,mc):
     '''
     #potential infiltration
     mac_infp=(mc.md_contact[:,0]/np.pi)*dt*-mc.a_velocity_real[-1]/mc.particleA
+    if hasattr(mc,'macocc'):
+        #particles occupying the macropore within the reach of one time step block its entry
+        reach=np.fmin(np.ceil(dt*-mc.a_velocity_real[-1]/mc.particleD[0]).astype(np.int64),mc.mac_gridcells)
+        occ=np.append(0,np.cumsum(mc.macocc))
+        mac_infp=np.fmax(mac_infp-(occ[mc.mac_offset+reach]-occ[mc.mac_offset]),0.)
     mx_infp=(1.-mc.macshare[1])*mc.mgrid.width.values*np.mean(dt*mc.ku[thS[0,:],mc.soilgrid[0,:]-1])/mc.particleA
     tot_infp=sum(mac_infp)+mx_infp
     acc_mxinf+=prec_potinf*(mx_infp/tot_infp)
     #if type(acc_mxinf)==pd.Series:
     #    acc_mxinf=acc_mxinf.values[0] #DEBUG: check why this happens
-    mx_inf=int(np.round(acc_mxinf))
+    mx_inf=int(np.fmin(np.round(acc_mxinf),prec_potinf))
     acc_mxinf-=mx_inf
     
-    mac_inf=np.zeros(len(mac_infp),dtype=int)
+    #allocate the remaining particles to the macropores in order up to half of their capacity
+    #(cumulative sum), what exceeds the macropores goes to the matrix
     prec_potinf-=mx_inf
-    idx_red=np.zeros(prec_potinf,dtype=int)
-    k=0
-    i=0
-    while prec_potinf>0:
-        mac_inf[i]=int(np.amin([np.round(mac_infp[i]/2.),prec_potinf]))
-        prec_potinf-=mac_inf[i]
-        idx_red[k:mac_inf[i]]=i+1
-        k+=mac_inf[i]
-        i+=1
-        if i>len(mac_infp):
-            mx_inf+=prec_potinf
-            prec_potinf=0
+    cum_inf=np.fmin(np.cumsum(np.round(mac_infp/2.)),prec_potinf).astype(int)
+    mac_inf=np.diff(np.append(0,cum_inf))
+    mx_inf+=prec_potinf-np.sum(mac_inf)
+    idx_red=np.repeat(np.arange(1,len(mac_inf)+1),mac_inf)
 
     return [mx_inf,idx_red,acc_mxinf]
 
@@ -3,27 +3,49 @@
 import numpy as np
 import pandas as pd
 import scipy as sp
-import matplotlib.pyplot as plt
 import scipy.constants as const
 import scipy.ndimage as snd
 from scipy import ndimage
-from skimage import img_as_float
-from skimage.filter import sobel
-from skimage.feature import peak_local_max
-from skimage import morphology
-from skimage import measure
-from skimage.color import label2rgb
-from shapely.geometry import Polygon
-from shapely.geometry import Point
-from shapely.geometry import MultiPoint
-from shapely.geometry import MultiPolygon
-from descartes.patch import PolygonPatch
-from shapely.geometry import asMultiPoint
+#imaging (skimage), geometry (shapely) and plotting (matplotlib, descartes) are
+#imported in the functions using them, the model core stays free of them
+
+def centroid_distances(centroidx,centroidy,sim,block=1024):
+    '''Min, max, mean and median distance of each centroid to all other centroids and
+       four reference points at 10/90 % of the image extent sim (the centroid itself excluded)
+       The distances are evaluated as blocks of rows, the order statistics by partitioning.
+    '''
+    n=len(centroidx)
+    pts=np.column_stack((np.append(centroidx,[0.1*sim[0],0.9*sim[0],0.1*sim[0],0.9*sim[0]]),
+                         np.append(centroidy,[0.1*sim[1],0.1*sim[1],0.9*sim[1],0.9*sim[1]])))
+    m=len(pts)-1 #number of distances per centroid
+    #the distance to the centroid itself is zero and thus the first order statistic of each row,
+    #the k-th smallest distance to the other points is at position k+1
+    k1=(m-1)//2+1
+    k2=m//2+1
+    mindist=np.zeros(n)
+    maxdist=np.zeros(n)
+    meandist=np.zeros(n)
+    mediandist=np.zeros(n)
+    for i in np.arange(0,n,block):
+        c=pts[i:min(i+block,n)]
+        d=np.sqrt((pts[:,0]-c[:,[0]])**2+(pts[:,1]-c[:,[1]])**2)
+        meandist[i:i+block]=d.sum(axis=1)/m
+        maxdist[i:i+block]=d.max(axis=1)
+        d.partition([1,k1,k2],axis=1)
+        mindist[i:i+block]=d[:,1]
+        mediandist[i:i+block]=0.5*(d[:,k1]+d[:,k2])
+    return [mindist,maxdist,meandist,mediandist]
 
 #THIS FUNCTION READS PREPARED HORIZONTAL IMAGES TO SETUP THE MACROPORE DOMAIN FROM BRILLIANT BLUE STAINED EXPERIMENTS
-def macfind_g(fi,patch_threshold):
+def macfind_g(fi,patch_threshold,plot=True):
     # fi is file to read
     # patch_threshold are min [0] and max [1] of the desired patch size limits
+    # plot: show the segmentation results
+    from skimage import img_as_float
+    from skimage.filter import sobel
+    from skimage.feature import peak_local_max
+    from skimage import morphology
+    from skimage import measure
     # read prepared horizontal BB image (res: 1px=1mm)
     # convert to float numbers
     Lface=snd.imread(fi)
@@ -87,20 +109,7 @@ def macfind_g(fi,patch_threshold):
         diameter[i]=meas[ix]['EquivDiameter']
         
     #calculate min/max distances of centroids
-    mindist=ulabels.astype(np.float64)
-    maxdist=ulabels.astype(np.float64)
-    meandist=ulabels.astype(np.float64)
-    mediandist=ulabels.astype(np.float64)
-
-    for i in np.arange(len(ulabels)):
-        cxm = np.ma.array(np.append(centroidx,[0.1*sim[0],0.9*sim[0],0.1*sim[0],0.9*sim[0]]), mask=False)
-        cym = np.ma.array(np.append(centroidy,[0.1*sim[1],0.1*sim[1],0.9*sim[1],0.9*sim[1]]), mask=False)
-        cxm.mask[i] = True
-        cym.mask[i] = True
-        mindist[i]=np.sqrt(np.min((cxm - centroidx[i])**2 + (cym - centroidy[i])**2))
-        maxdist[i]=np.sqrt(np.max((cxm - centroidx[i])**2 + (cym - centroidy[i])**2))
-        meandist[i]=np.mean(np.sqrt((cxm - centroidx[i])**2 + (cym - centroidy[i])**2))
-        mediandist[i]=np.median(np.sqrt((cxm - centroidx[i])**2 + (cym - centroidy[i])**2))
+    [mindist,maxdist,meandist,mediandist]=centroid_distances(centroidx,centroidy,sim)
     
     inan=-np.isnan(mediandist)
     tot_size=np.float64(im.shape[0])*np.float64(im.shape[1])
@@ -117,6 +126,11 @@ def macfind_g(fi,patch_threshold):
     else:
         patch_def=[]      
     
+    if not plot:
+        return patch_def
+
+    from skimage.color import label2rgb
+    import matplotlib.pyplot as plt
     image_label_overlay = label2rgb(labeled_patches, image=image_max)
 
     # plot results
@@ -140,12 +154,93 @@ def macfind_g(fi,patch_threshold):
     
     return patch_def
 
+def macfind_layer(args):
+    '''Pool worker of macfind_layers: macfind_g of one image (file, patch_threshold) without plots
+    '''
+    fi,patch_threshold=args
+    return macfind_g(fi,patch_threshold,False)
+
+def macfind_layers(mac,nproc=None,cachedir=None,plot=True):
+    '''Segmentation of the image stack mac (file, threshold_l, threshold_u per layer)
+       Results are cached per layer under mccache.layer_key in cachedir (None: no cache).
+       The missing layers are segmented by a pool of nproc processes (default: number of cpus),
+       sequentially in this process if plot is on or nproc is 1. The order of mac is kept.
+       Output: patch table with one row per layer (zeros for layers without patches)
+    '''
+    import mccache
+    layers=[(mac.file.iloc[i],[mac.threshold_l.iloc[i],mac.threshold_u.iloc[i]]) for i in np.arange(len(mac))]
+    patches=[None]*len(layers)
+    if cachedir is not None:
+        keys=[mccache.layer_key(fi,thr) for fi,thr in layers]
+        patches=[mccache.cache_load(key,cachedir) for key in keys]
+    todo=[i for i in np.arange(len(layers)) if patches[i] is None]
+
+    import multiprocessing
+    if nproc is None:
+        nproc=multiprocessing.cpu_count()
+    if plot or (nproc==1) or (len(todo)<2):
+        found=[macfind_g(layers[i][0],layers[i][1],plot) for i in todo]
+    else:
+        pool=multiprocessing.Pool(min(nproc,len(todo)))
+        try:
+            found=pool.map(macfind_layer,[layers[i] for i in todo])
+        finally:
+            pool.close()
+            pool.join()
+    for i,patchnow in zip(todo,found):
+        patches[i]=patchnow
+        if cachedir is not None:
+            mccache.cache_store(keys[i],patchnow,cachedir)
+
+    #layers without patches get a row of zeros
+    patch_found=[patchnow for patchnow in patches if isinstance(patchnow,pd.DataFrame)]
+    if len(patch_found)==0:
+        raise ValueError('no macropore patches found in the images of the stack')
+    patch_dummy=patch_found[0]*0.
+    patch_def=pd.concat([patchnow if isinstance(patchnow,pd.DataFrame) else patch_dummy for patchnow in patches])
+    return patch_def.set_index(np.arange(len(mac)))
+
 #NOTE:
 #Stained patches are seen as areas with macropore matrix interaction. We do not assume any tree network of pores explicitly. However, any patch must be connected to the surface. One could now analyse the overlaying matches of identified pores to get a more clear image. We will simplify this to the assumption, that the number of pores will not increase with depth and that non-visible paths will simply get a very low contact interface where they were not visible.
 #At the same time we do not necessarily need to take all the macropores to the model domain. Although the more representatives we choose the better the result may become, a minimal representative set is defined by the rarest macropore class.
 
 
-def mac_matrix_setup(mac,mc):
+def mac_raster(xleft,xright,md_depth,dummyl,dummyv):
+    '''Rasterization of the macropore contact polygons (see mac_matrix_setup) to the grid
+       xleft, xright: left and right bound of the polygons at the vertices md_depth (incl. surface)
+       dummyl, dummyv: lateral and vertical centroids of the grid
+       Between two vertices each polygon is a trapezoid, its bounds are interpolated at the
+       centroid rows and the enclosed columns (bounds included) are filled by slicing.
+       Overlaps are resolved as with the polygon intersects (the last macropore counts).
+       Output: macconnect (vertgrid x latgrid) with 0 for no or i for the i'th macropore
+    '''
+    macconnect=np.zeros((len(dummyv),len(dummyl)),dtype=int)
+    for i in np.arange(len(xleft)):
+        for k in np.arange(len(md_depth)-1):
+            top=-md_depth[k]
+            bot=-md_depth[k+1]
+            rows=np.where((dummyv<=max(top,bot)) & (dummyv>=min(top,bot)))[0]
+            if len(rows)==0:
+                continue
+            if top==bot:
+                t=np.zeros(len(rows))
+            else:
+                t=(dummyv[rows]-top)/(bot-top)
+            xl=xleft[i,k]+t*(xleft[i,k+1]-xleft[i,k])
+            xr=xright[i,k]+t*(xright[i,k+1]-xright[i,k])
+            inside=(dummyl[np.newaxis,:]>=xl[:,np.newaxis]) & (dummyl[np.newaxis,:]<=xr[:,np.newaxis])
+            sub=macconnect[rows[0]:rows[-1]+1]
+            sub[inside]=i+1
+    return macconnect
+
+def mac_matrix_setup(mac,mc,check=False):
+    '''Setup of the macropore and matrix domain
+       check: compare the rasterized macropore contact (mac_raster) with the intersects of
+              the grid centroids with the contact polygons (shapely)
+    '''
+    from shapely.geometry import Polygon
+    from shapely.geometry import MultiPoint
+    from shapely.geometry import MultiPolygon
     # Find lowest number of stained patches
     #idx=np.argmin(mac.no)
     # or take largest distance
@@ -297,23 +392,31 @@ def mac_matrix_setup(mac,mc):
     dummyl=latfac*(1+np.arange(latgrid))-latfac/2.
     dummyv=vertfac*(1+np.arange(vertgrid))-vertfac/2.
 
-    gridcentroids = MultiPoint(zip(np.repeat(dummyl,vertgrid).reshape(latgrid,vertgrid).ravel(),np.repeat(dummyv,latgrid).reshape(vertgrid,latgrid).T.ravel()))
     onepartpercell = np.repeat(dummyl,vertgrid).reshape(latgrid,vertgrid).ravel(),np.repeat(dummyv,latgrid).reshape(vertgrid,latgrid).T.ravel()
     mxdepth_cx=dummyv.repeat(latgrid).reshape(vertgrid,latgrid)
     mxdepth_cr=mxdepth_cx.ravel()
 
-    # loop through domain and check for overlap
+    # rasterize the contact polygons to the grid
     # give 0 for no or i for i'th macropore
-    macconnect=np.zeros(len(gridcentroids),dtype=int)
     if mc.nomac!=True:
-        for i in np.arange(len(gridcentroids)):
-            if gridcentroids[i].intersects(macP[0]):
-                macconnect[i]=1
-            for j in np.arange(len(macP)-1)+1:
-                if gridcentroids[i].intersects(macP[j]):
-                    macconnect[i]=j+1
-
-    macconnect=macconnect.reshape(latgrid,vertgrid).T
+        macconnect=mac_raster(xleft,xright,md_depth,dummyl,dummyv)
+    else:
+        macconnect=np.zeros((vertgrid,latgrid),dtype=int)
+
+    if check:
+        # loop through domain and check for overlap
+        gridcentroids = MultiPoint(zip(np.repeat(dummyl,vertgrid).reshape(latgrid,vertgrid).ravel(),np.repeat(dummyv,latgrid).reshape(vertgrid,latgrid).T.ravel()))
+        macconnect_p=np.zeros(len(gridcentroids),dtype=int)
+        if mc.nomac!=True:
+            for i in np.arange(len(gridcentroids)):
+                for j in np.arange(len(macP)):
+                    if gridcentroids[i].intersects(macP[j]):
+                        macconnect_p[i]=j+1
+        macconnect_p=macconnect_p.reshape(latgrid,vertgrid).T
+        if np.array_equal(macconnect,macconnect_p):
+            print 'macropore raster matches the polygon intersects'
+        else:
+            print 'macropore raster differs from the polygon intersects in',np.sum(macconnect!=macconnect_p),'cells'
 
     #macconnect.shape
     macid=[]
@@ -337,6 +440,7 @@ def mac_matrix_setup(mac,mc):
     mc.maccols=np.floor(mc.md_pos/mgrid.latfac.values).astype(np.int)
     mc.soilgrid=soilgrid
     mc.macconnect=macconnect
+    mc.ifcells=np.where(macconnect.ravel()>0)[0] #interface cells adjoined to a macropore
     mc.maccells=mac_cells
     mc.matrixdef=matrixdef
     mc.mgrid=mgrid
@@ -351,11 +455,129 @@ def mac_matrix_setup(mac,mc):
     #macP,macid,macconnect,soilgrid,matrixdef,mgrid went obsolete to pass since they reside in mc
 
 
+def mac_refine_setup(mc,reffac=2,halo=1):
+    '''Setup of a locally refined grid around the macropore interface cells.
+       All cells flagged in mc.macconnect and their neighbours (within halo cells, cyclic
+       in lateral direction) are subdivided into reffac x reffac subcells. The bulk matrix
+       stays at the coarse grid defined by mc.grid_sizefac.
+
+       Unrefined cells keep their coarse cell number. Subcells are numbered from
+       mc.mgrid.cells on. mc.ref_idx holds the mixed cell number for each cell of the
+       fine grid (reffac*vertgrid x reffac*latgrid) to allow direct position lookups.
+       Each mixed cell refers to its coarse parent (mc.ref_parent) with its share of
+       the parent area (mc.ref_area) for consistent thS aggregation (partdyn_d2.ref_aggregate).
+       The contact to the macropores is evaluated at the subcell centroids (mc.ref_macconnect)
+       by rasterizing the contact polygons to the fine grid (mac_raster).
+       The refined state is used for the entry of matrix particles into the macropores
+       (partdyn_d2.mx_mp_interact_ref) and the placement of exfiltrating particles
+       (partdyn_d2.mac_exfilt_lat), the diffusion stays at the coarse grid.
+    '''
+    vertgrid=int(mc.mgrid.vertgrid.values[0])
+    latgrid=int(mc.mgrid.latgrid.values[0])
+    cells=vertgrid*latgrid
+
+    # flag interface cells and their neighbours
+    iface=(mc.macconnect>0)
+    refmask=iface.copy()
+    for i in np.arange(-halo,halo+1):
+        for j in np.arange(-halo,halo+1):
+            shifted=np.roll(iface,j,axis=1)
+            if i>0:
+                shifted=np.vstack((np.zeros((i,latgrid),dtype=bool),shifted[:-i,:]))
+            elif i<0:
+                shifted=np.vstack((shifted[-i:,:],np.zeros((-i,latgrid),dtype=bool)))
+            refmask|=shifted
+
+    # mixed cell numbering
+    refcells=np.where(refmask.ravel())[0]
+    ref_idx=np.arange(cells,dtype=np.int64).reshape(vertgrid,latgrid).repeat(reffac,axis=0).repeat(reffac,axis=1)
+    subno=cells+np.arange(len(refcells)*reffac*reffac,dtype=np.int64).reshape(len(refcells),reffac,reffac)
+    rw,cl=np.unravel_index(refcells,(vertgrid,latgrid))
+    for i in np.arange(reffac):
+        for j in np.arange(reffac):
+            ref_idx[rw*reffac+i,cl*reffac+j]=subno[:,i,j]
+
+    ref_parent=np.append(np.arange(cells,dtype=np.int64),refcells.repeat(reffac*reffac))
+    ref_area=np.append(np.ones(cells),np.ones(len(refcells)*reffac*reffac)/float(reffac*reffac))
+    ref_area[refcells]=0. #refined parents are represented by their subcells only
+
+    # macropore contact at subcell centroids
+    ref_macconnect=np.append(mc.macconnect.ravel(),np.zeros(len(refcells)*reffac*reffac,dtype=int))
+    ref_macconnect[refcells]=0
+    sub_rw=(rw*reffac).repeat(reffac*reffac)+np.tile(np.arange(reffac).repeat(reffac),len(refcells))
+    sub_cl=(cl*reffac).repeat(reffac*reffac)+np.tile(np.tile(np.arange(reffac),reffac),len(refcells))
+    if mc.nomac!=True:
+        #contact polygons as in mac_matrix_setup (with surface vertex)
+        xleft=mc.md_pos[:,np.newaxis]-mc.md_contact/2
+        xright=mc.md_pos[:,np.newaxis]+mc.md_contact/2
+        xleft=np.hstack((xleft[:,[0]],xleft))
+        xright=np.hstack((xright[:,[0]],xright))
+        finel=(np.arange(latgrid*reffac)+0.5)*mc.mgrid.latfac.values[0]/reffac
+        finev=(np.arange(vertgrid*reffac)+0.5)*mc.mgrid.vertfac.values[0]/reffac
+        ref_macconnect[cells:]=mac_raster(xleft,xright,mc.md_depth,finel,finev)[sub_rw,sub_cl]
+
+    mc.ref_fac=reffac
+    mc.ref_mask=refmask
+    mc.ref_idx=ref_idx
+    mc.ref_parent=ref_parent
+    mc.ref_area=ref_area
+    mc.ref_cells=len(ref_parent)
+    mc.ref_macconnect=ref_macconnect
+
+    return mc
+
+
+def mac_radial_setup(mc):
+    '''Setup of an axisymmetric radial-depth domain for single macropore column setups.
+       The centred column domain (mc.nomac given as domain width) is reduced to one radial
+       half-plane starting at the macropore axis (r=0, lat is the radius from here on).
+       Each cell refers to its ring of the half cylinder through the volume factor mc.radfac
+       (mean of 1 over a row), which scales the particle capacity of the cell.
+       The axis and the outer wall are reflecting. Sets mc.prects='radial'.
+       Call after dataread_caos and before particle_setup.
+    '''
+    vertgrid=int(mc.mgrid.vertgrid.values[0])
+    latfac=mc.mgrid.latfac.values[0]
+    vertfac=mc.mgrid.vertfac.values[0]
+    c0=int(mc.maccols[0])
+    latgrid=int(mc.mgrid.latgrid.values[0])-c0
+    domain_width=latgrid*latfac
+
+    # radius dependent cell volume as ring area relative to the mean ring area
+    radfac=(2.*np.arange(latgrid)+1.)/latgrid
+
+    mc.soilgrid=mc.soilgrid[:,c0:].copy()
+    mc.macconnect=mc.macconnect[:,c0:].copy()
+    mc.ifcells=np.where(mc.macconnect.ravel()>0)[0]
+    mc.macid=[]
+    for i in np.arange(len(mc.md_pos)):
+        mc.macid.append(np.where(mc.macconnect.ravel()==i+1))
+
+    mc.md_pos=np.zeros(len(mc.md_pos))
+    mc.maccols=np.zeros(len(mc.md_pos),dtype=np.int)
+    mc.maccells=(np.arange(vertgrid)*latgrid).astype(np.int64)
+
+    dummyl=latfac*(1+np.arange(latgrid))-latfac/2.
+    dummyv=vertfac*(1+np.arange(vertgrid))-vertfac/2.
+    mc.onepartpercell = np.repeat(dummyl,vertgrid).reshape(latgrid,vertgrid).ravel(),np.repeat(dummyv,latgrid).reshape(vertgrid,latgrid).T.ravel()
+    mc.mxdepth_cr=dummyv.repeat(latgrid)
+    mc.zgrid=mc.zgrid[:,c0:].copy()
+
+    mc.mgrid['latgrid']=latgrid
+    mc.mgrid['width']=domain_width
+    if 'cells' in mc.mgrid.columns:
+        mc.mgrid['cells']=vertgrid*latgrid
+    mc.radfac=np.tile(radfac,vertgrid).reshape(vertgrid,latgrid)
+    mc.prects='radial'
+
+    return mc
 
 
 def mac_plot(macP):
     '''Plot Macropore Interface Setup based on MultiPolygon
     '''
+    import matplotlib.pyplot as plt
+    from descartes.patch import PolygonPatch
     COLORs = ['#FF6347','#FF8C00','#9ACD32','#20B2AA','#1E90FF','#9932CC','#A0522D','#EF471A','#10A325','#CCD315','#FF6347','#FF8C00','#9ACD32','#20B2AA','#1E90FF','#9932CC','#A0522D','#EF471A','#10A325','#CCD315']
 
     def v_color(ob):
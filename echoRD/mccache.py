@@ -0,0 +1,130 @@
+# coding=utf-8
+
+import os
+import hashlib
+import types
+import cPickle as pickle
+import numpy as np
+import pandas as pd
+
+#content addressed cache of the preprocessed domain (dataread_caos output)
+
+def cache_key(mc,seed=None):
+    '''Hash of the model setup before dataread_caos:
+       mcini parameters (plain values of the mc namespace except nproc and cachedir), the contents of the input files
+       (macbf, tracerbf, matrixbf, matrixdeffi, macimg and the images listed therein),
+       the RNG seed and the sources of the preprocessing modules.
+    '''
+    import dataread as dr
+    import macropore_ini as mpo
+    import vG_conv as vG
+    h=hashlib.sha1()
+    for name in sorted(vars(mc)):
+        val=getattr(mc,name)
+        if name.startswith('_') or (name in ['nproc','cachedir']):
+            continue
+        if isinstance(val,(str,unicode,int,long,float,bool,tuple,list,type(None))):
+            h.update(name+'='+repr(val)+'\n')
+    h.update('seed='+repr(seed)+'\n')
+
+    files=[getattr(mc,f) for f in ['macbf','tracerbf','matrixbf','matrixdeffi'] if hasattr(mc,f)]
+    if (getattr(mc,'nomac',True)==False) and hasattr(mc,'macimg'):
+        files.append(mc.macimg)
+        files.extend(pd.read_csv(mc.macimg, sep=',').file.values)
+    for mod in [dr,mpo,vG]:
+        files.append(os.path.splitext(mod.__file__)[0]+'.py')
+    for fi in files:
+        h.update(fi+'\n')
+        if os.path.isfile(fi):
+            with open(fi,'rb') as f:
+                for chunk in iter(lambda: f.read(1048576),''):
+                    h.update(chunk)
+        else:
+            h.update('missing\n')
+    return h.hexdigest()
+
+def layer_key(fi,patch_threshold):
+    '''Hash of the segmentation of one image layer (macropore_ini.macfind_g):
+       the image contents, the patch thresholds and the source of macropore_ini.
+    '''
+    import macropore_ini as mpo
+    h=hashlib.sha1()
+    h.update('layer patch_threshold='+repr([float(thr) for thr in patch_threshold])+'\n')
+    for fi in [fi,os.path.splitext(mpo.__file__)[0]+'.py']:
+        with open(fi,'rb') as f:
+            for chunk in iter(lambda: f.read(1048576),''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def default_cachedir():
+    '''Cache directory if none is given: ~/.echoRD_cache
+    '''
+    return os.path.join(os.path.expanduser('~'),'.echoRD_cache')
+
+def cache_load(key,cachedir):
+    '''Returns the cached domain (dict of mc attributes) or None. Marks the entry as recently used.
+    '''
+    fname=os.path.join(cachedir,key+'.pickle')
+    if not os.path.isfile(fname):
+        return None
+    with open(fname,'rb') as f:
+        domain=pickle.load(f)
+    os.utime(fname,None)
+    return domain
+
+def cache_store(key,domain,cachedir,maxsize=2.e9):
+    '''Writes the domain (dict of mc attributes) to the cache and evicts the least recently
+       used entries beyond maxsize [bytes].
+    '''
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    fname=os.path.join(cachedir,key+'.pickle')
+    tmp=fname+'.%i.tmp' % os.getpid()
+    with open(tmp,'wb') as f:
+        pickle.dump(domain,f,protocol=2)
+    os.rename(tmp,fname)
+    cache_evict(cachedir,maxsize)
+
+def cache_evict(cachedir,maxsize=2.e9):
+    '''Least recently used eviction of cache entries until their total size is below maxsize [bytes].
+    '''
+    entries=[os.path.join(cachedir,fi) for fi in os.listdir(cachedir) if fi.endswith('.pickle')]
+    entries.sort(key=os.path.getmtime)
+    size=sum(os.path.getsize(fi) for fi in entries)
+    while (size>maxsize) and (len(entries)>1):
+        fi=entries.pop(0)
+        size-=os.path.getsize(fi)
+        os.remove(fi)
+
+def dataread_cached(mc,seed=None,cachedir=None,maxsize=2.e9,plot=True):
+    '''dataread_caos with a content addressed cache of its output
+       The domain is looked up under cache_key of the (unprocessed) mc. If it is missing, the
+       random generator is seeded (if seed is given), dataread_caos is run and all attributes
+       it added or replaced are stored. Changes of the parameters or input files give a new key.
+       cachedir: directory of the cache (default mc.cachedir or ~/.echoRD_cache)
+       maxsize: size bound of the cache directory [bytes]
+       plot: plotting of dataread_caos when the domain is built
+    '''
+    import dataread as dr
+    if cachedir is None:
+        cachedir=getattr(mc,'cachedir',default_cachedir())
+    key=cache_key(mc,seed)
+    domain=cache_load(key,cachedir)
+    if domain is not None:
+        for name in domain:
+            setattr(mc,name,domain[name])
+        print 'MODEL SETUP LOADED FROM CACHE.'
+        return mc
+
+    before=dict((name,id(val)) for name,val in vars(mc).items())
+    if seed is not None:
+        np.random.seed(seed)
+    mc=dr.dataread_caos(mc,plot)
+    domain={}
+    for name,val in vars(mc).items():
+        if name.startswith('_') or isinstance(val,(types.ModuleType,types.FunctionType,type)):
+            continue
+        if before.get(name)!=id(val):
+            domain[name]=val
+    cache_store(key,domain,cachedir,maxsize)
+    return mc
@@ -1,8 +1,11 @@
 # coding=utf-8
 
 import numpy as np
+import pandas as pd
+import heapq
+from bisect import bisect_right
+from collections import deque
 import scipy as sp
-import matplotlib.pyplot as plt
 import scipy.constants as const
 import scipy.ndimage as spn
 import dataread as dr
@@ -58,8 +61,9 @@ def thetaSidx(npart,mc):
     return thetaS*100
 
 
-def gridupdate_thS(lat,z,mc,gauss=0.5):
+def gridupdate_thS(lat,z,mc,gauss=0.5,thS_float=False):
     '''Calculates thetaS from particle density
+       thS_float: return thetaS in percent as float (for dynamic_pedo=='table', see pedo_props) instead of the integer id
     '''
     #import numpy as np
     #import scipy as sp
@@ -78,6 +82,13 @@ def gridupdate_thS(lat,z,mc,gauss=0.5):
     #do not smooth at macropores centroids
     #npart_s[np.unravel_index(mc.maccells,(mc.mgrid.vertgrid.values.astype(np.int64),mc.mgrid.latgrid.values.astype(np.int64)))]=npart[np.unravel_index(mc.maccells,(mc.mgrid.vertgrid.values.astype(np.int64),mc.mgrid.latgrid.values.astype(np.int64)))]
     #thetaS=npart_s.ravel()/(mc.soilmatrix.ts[mc.soilgrid.ravel()-1]*(2*mc.part_sizefac))
+    return [npart_thS(npart,mc,thS_float),npart]
+
+
+def npart_thS(npart,mc,thS_float=False):
+    '''Calculates thetaS from the particle count of the grid cells (as gridupdate_thS)
+       thS_float: return thetaS in percent as float instead of the integer id
+    '''
     if mc.prects=='column':
         if mc.colref==False:
             #initialise reference
@@ -104,12 +115,57 @@ def gridupdate_thS(lat,z,mc,gauss=0.5):
         ths_part=mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid))*(2*mc.part_sizefac)
         #thetaS=npart.astype(np.float)*mc.particleV/mc.tsref
         thetaS=mc.moistfac*npart.astype(np.float)/ths_part
+    elif mc.prects=='radial':
+        #capacity of the cells scales with the ring volume (see macropore_ini.mac_radial_setup)
+        ths_part=mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid))*(2*mc.part_sizefac)*mc.radfac
+        thetaS=npart.astype(np.float)/ths_part
     else:
         ths_part=mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid))*(2*mc.part_sizefac)
         thetaS=npart.astype(np.float)/ths_part
     thetaS[thetaS>0.99]=0.99
     thetaS[thetaS<0.1]=0.1
-    return [(thetaS*100).astype(np.int),npart]
+    if thS_float:
+        return thetaS*100.
+    return (thetaS*100).astype(np.int)
+
+
+def cellgrid_ref(lat,z,mc):
+    '''Calculate cell number in the locally refined grid (see macropore_ini.mac_refine_setup)
+       from given position of a particle. Direct lookup in mc.ref_idx.
+    '''
+    rw=np.floor(np.asarray(z)/(mc.mgrid.vertfac.values[0]/mc.ref_fac)).astype(np.int64)
+    cl=np.floor(np.asarray(lat)/(mc.mgrid.latfac.values[0]/mc.ref_fac)).astype(np.int64)
+    rw[rw<0]=0
+    rw[rw>=np.shape(mc.ref_idx)[0]]=np.shape(mc.ref_idx)[0]-1
+    cl[cl<0]=0
+    cl[cl>=np.shape(mc.ref_idx)[1]]=np.shape(mc.ref_idx)[1]-1
+
+    return mc.ref_idx[rw,cl]
+
+
+def gridupdate_thS_ref(lat,z,mc):
+    '''Calculates thetaS in the locally refined grid from particle density
+       Returns thetaS id and particle count per mixed cell and the mixed cell of each particle.
+       Use ref_aggregate to get the consistent state of the coarse grid.
+    '''
+    rcell=cellgrid_ref(lat,z,mc)
+    npart_r=np.bincount(rcell,minlength=mc.ref_cells)
+    ths_part=(mc.soilmatrix.ts.values[mc.soilgrid.ravel()-1]*(2*mc.part_sizefac))[mc.ref_parent]*mc.ref_area
+    thetaS=np.ones(mc.ref_cells)
+    idx=ths_part>0.
+    thetaS[idx]=npart_r[idx].astype(np.float)/ths_part[idx]
+    thetaS[thetaS>0.99]=0.99
+    thetaS[thetaS<0.1]=0.1
+    return [(thetaS*100).astype(np.int),npart_r,rcell]
+
+
+def ref_aggregate(npart_r,mc,thS_float=False):
+    '''Aggregates particle counts of the locally refined grid to the coarse grid
+       Returns thetaS and npart as gridupdate_thS does (for dt criteria and outputs).
+    '''
+    npart=np.bincount(mc.ref_parent,weights=npart_r,minlength=mc.mgrid.cells.values[0]).astype(np.int64)
+    npart=npart.reshape(np.shape(mc.soilgrid))
+    return [npart_thS(npart,mc,thS_float),npart]
 
 
 def npart_theta(npart,mc):
@@ -122,9 +178,202 @@ def npart_theta(npart,mc):
     theta=(mc.particleA/(-mc.gridcellA))[0]*npart_s.ravel()
     return theta
 
+def pedo_tables(mc):
+    '''Base tables of the closed form vG functions used with dynamic_pedo for the
+       saturation levels (thS in percent, rows) and soils (columns) with ks of the soil:
+       pedo_theta: theta_thst of thS in percent /100 (as in part_diffusion_split)
+       pedo_ku, pedo_D, pedo_Dpsi: ku_thst, D_thst and D_psi (at psi_thst)
+       pedo_psi: psi_thst
+       ku and D are linear in ks, the ks noise is applied as factor in pedo_lookup.
+    '''
+    lev=np.arange(101)[:,np.newaxis]
+    th=lev/100.
+    ts=mc.soilmatrix.ts.values[np.newaxis,:]
+    tr=mc.soilmatrix.tr.values[np.newaxis,:]
+    ks=mc.soilmatrix.ks.values[np.newaxis,:]
+    alpha=mc.soilmatrix.alpha.values[np.newaxis,:]
+    n=mc.soilmatrix.n.values[np.newaxis,:]
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        mc.pedo_theta=vG.theta_thst(lev,ts,tr)/100.
+        mc.pedo_ku=vG.ku_thst(th,ks,alpha,n)
+        mc.pedo_D=vG.D_thst(th,ts,tr,ks,alpha,n)
+        mc.pedo_psi=np.empty((len(lev),len(mc.soilmatrix)))
+        mc.pedo_Dpsi=np.empty((len(lev),len(mc.soilmatrix)))
+        for i in np.arange(len(mc.soilmatrix)):
+            mc.pedo_psi[:,i]=vG.psi_thst(th[:,0],float(alpha[0,i]),float(n[0,i]))
+            mc.pedo_Dpsi[:,i]=vG.D_psi(mc.pedo_psi[:,i],float(ks[0,i]),ts[0,i],tr[0,i],alpha[0,i],n[0,i])
+    return mc
+
+def pedo_lookup(thS,soil,mc,ksn=1.,check=False):
+    '''Closed form vG values of dynamic_pedo from the base tables (pedo_tables)
+       thS: saturation in percent, soil: soil index (0-based), ksn: ks noise factor(s)
+       check: validate against the closed forms (pedo_check)
+       Outputs: 1 theta, 2 ku, 3 D (D_thst), 4 psi, 5 D (D_psi)
+    '''
+    if not hasattr(mc,'pedo_ku'):
+        pedo_tables(mc)
+    out=[mc.pedo_theta[thS,soil],mc.pedo_ku[thS,soil]*ksn,mc.pedo_D[thS,soil]*ksn,mc.pedo_psi[thS,soil],mc.pedo_Dpsi[thS,soil]*ksn]
+    if check:
+        pedo_check(thS,soil,mc,ksn,out)
+    return out
+
+def pedo_check(thS,soil,mc,ksn=1.,out=None,rtol=1e-10):
+    '''Validation of the table values of pedo_lookup against the closed form vG functions.
+       Deviations beyond rtol are reported.
+       Output: maximum relative deviation of theta, ku, D, psi and D (D_psi)
+    '''
+    if out is None:
+        out=pedo_lookup(thS,soil,mc,ksn)
+    thS=np.asarray(thS)
+    ts=mc.soilmatrix.ts.values[soil]
+    tr=mc.soilmatrix.tr.values[soil]
+    ks=ksn*mc.soilmatrix.ks.values[soil]
+    alpha=mc.soilmatrix.alpha.values[soil]
+    n=mc.soilmatrix.n.values[soil]
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        psi=vG.psi_thst(thS/100.,alpha,n)
+        ref=[vG.theta_thst(thS,ts,tr)/100.,vG.ku_thst(thS/100.,ks,alpha,n),vG.D_thst(thS/100.,ts,tr,ks,alpha,n),psi,vG.D_psi(psi,ks,ts,tr,alpha,n)]
+        dev=[np.nanmax(np.append(0.,np.abs(o-r)/np.abs(r))) for o,r in zip(out,ref)]
+    for name,d in zip(['theta','ku','D','psi','Dpsi'],dev):
+        if d>rtol:
+            print 'pedo table deviation:',name,d
+    return dev
+
+def proptable_build(soilmatrix,levels=1000,method='linear',thmin=0.01,thmax=0.99):
+    '''High resolution tables of the closed form vG functions for interpolation on a float thS
+       levels: number of intervals between thmin and thmax (relative saturation)
+       method: 'linear' or 'pchip' (monotone cubic Hermite interpolation after Fritsch and Carlson)
+       The table holds theta, ku, D (D_thst), psi and D (D_psi) with ks of the soil and is laid
+       out per soil (soil, level, property), so that a gather reads all properties of a level at once.
+       Output: [table, slopes*dth (pchip) or None, thmin, dth, method]
+    '''
+    th=np.linspace(thmin,thmax,levels+1)
+    tab=np.empty((len(soilmatrix),levels+1,5))
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        for i in np.arange(len(soilmatrix)):
+            [ts,tr,ks,alpha,n]=[float(soilmatrix[c].values[i]) for c in ['ts','tr','ks','alpha','n']]
+            psi=vG.psi_thst(th,alpha,n)
+            tab[i,:,0]=vG.theta_thst(th,ts,tr)
+            tab[i,:,1]=vG.ku_thst(th,ks,alpha,n)
+            tab[i,:,2]=vG.D_thst(th,ts,tr,ks,alpha,n)
+            tab[i,:,3]=psi
+            tab[i,:,4]=vG.D_psi(psi,ks,ts,tr,alpha,n)
+    slope=None
+    if method=='pchip':
+        #slopes (per level step) as harmonic mean of the secants, zero at local extrema
+        sec=np.diff(tab,axis=1)
+        slope=np.zeros(np.shape(tab))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            hm=2./(1./sec[:,:-1]+1./sec[:,1:])
+        idx=(sec[:,:-1]*sec[:,1:])>0.
+        slope[:,1:-1][idx]=hm[idx]
+        slope[:,0]=sec[:,0]
+        slope[:,-1]=sec[:,-1]
+    return [tab,slope,thmin,(thmax-thmin)/levels,method]
+
+def proptable_setup(mc,levels=1000,method='linear',thmin=0.01,thmax=0.99):
+    '''Sets up the high resolution property tables (see proptable_build) as mc.ptab
+    '''
+    mc.ptab=proptable_build(mc.soilmatrix,levels,method,thmin,thmax)
+    return mc
+
+def proptable_eval(thS,soil,ptab,ksn=1.):
+    '''Interpolation in a property table of proptable_build
+       thS: saturation in percent (float), soil: soil index (0-based), ksn: ks noise factor(s)
+       Outputs: 1 theta, 2 ku, 3 D (D_thst), 4 psi, 5 D (D_psi)
+    '''
+    [tab,slope,thmin,dth,method]=ptab
+    levels=np.shape(tab)[1]-1
+    t=np.clip((np.asarray(thS)/100.-thmin)/dth,0.,levels)
+    k=np.fmin(t.astype(np.int64),levels-1)
+    s=(t-k)[...,np.newaxis]
+    y0=tab[soil,k]
+    y1=tab[soil,k+1]
+    if method=='pchip':
+        h00=(1.+2.*s)*(1.-s)**2
+        h10=s*(1.-s)**2
+        h01=s**2*(3.-2.*s)
+        h11=s**2*(s-1.)
+        y=h00*y0+h10*slope[soil,k]+h01*y1+h11*slope[soil,k+1]
+    else:
+        y=y0+s*(y1-y0)
+    return [y[...,0],y[...,1]*ksn,y[...,2]*ksn,y[...,3],y[...,4]*ksn]
+
+def proptable_lookup(thS,soil,mc,ksn=1.):
+    '''Interpolated vG values for a float thS (in percent) from mc.ptab (proptable_setup)
+       Outputs: 1 theta, 2 ku, 3 D (D_thst), 4 psi, 5 D (D_psi)
+    '''
+    if not hasattr(mc,'ptab'):
+        proptable_setup(mc)
+    return proptable_eval(thS,soil,mc.ptab,ksn)
+
+def pedo_props(thS,soil,mc,ksn=1.,dynamic_pedo=True):
+    '''vG values of dynamic_pedo for the model routines
+       dynamic_pedo=='table': interpolated for a float thS (gridupdate_thS with thS_float) from the
+       high resolution tables (proptable_lookup), theta as in pedo_tables
+       else: base tables of the integer thS (pedo_lookup), validated for dynamic_pedo=='check'
+       Outputs: 1 theta, 2 ku, 3 D (D_thst), 4 psi, 5 D (D_psi)
+    '''
+    if dynamic_pedo=='table':
+        out=proptable_lookup(thS,soil,mc,ksn)
+        out[0]=vG.theta_thst(np.asarray(thS),mc.soilmatrix.ts.values[soil],mc.soilmatrix.tr.values[soil])/100.
+        return out
+    return pedo_lookup(thS,soil,mc,ksn,dynamic_pedo=='check')
+
+def proptable_report(mc,levels=[101,1000,10000],methods=['linear','pchip'],N=100000,thrange=[10.,99.],seed=0):
+    '''Benchmark and accuracy report of the property tables against the closed form vG functions
+       for N random float thS (percent in thrange) and soils. The integer tables of
+       pedo_lookup (thS rounded) are listed as reference.
+       Output: DataFrame with setup time, lookup time and max/median relative error per property
+    '''
+    import time
+    names=['theta','ku','D','psi','Dpsi']
+    r=np.random.RandomState(seed)
+    thS=thrange[0]+r.rand(N)*(thrange[1]-thrange[0])
+    soil=r.randint(0,len(mc.soilmatrix),N)
+    sm=mc.soilmatrix
+    [ts,tr,ks,alpha,n]=[sm[c].values[soil] for c in ['ts','tr','ks','alpha','n']]
+    t0=time.time()
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        psi=vG.psi_thst(thS/100.,alpha,n)
+        ref=[vG.theta_thst(thS/100.,ts,tr),vG.ku_thst(thS/100.,ks,alpha,n),vG.D_thst(thS/100.,ts,tr,ks,alpha,n),psi,vG.D_psi(psi,ks,ts,tr,alpha,n)]
+    t_closed=time.time()-t0
+
+    def row(name,t_setup,t_look,out):
+        rel=[np.abs(o-f)/np.abs(f) for o,f in zip(out,ref)]
+        return dict([('table',name),('setup [s]',t_setup),('lookup [s]',t_look)]+[(nm+' max',np.nanmax(e)) for nm,e in zip(names,rel)]+[(nm+' median',np.nanmedian(e)) for nm,e in zip(names,rel)])
+
+    rows=[dict([('table','closed form'),('setup [s]',0.),('lookup [s]',t_closed)])]
+    #integer percent tables of dynamic_pedo (theta in pedo_tables is based on thS in percent)
+    t0=time.time()
+    pedo_tables(mc)
+    t_setup=time.time()-t0
+    t0=time.time()
+    out=pedo_lookup(np.round(thS).astype(np.int64),soil,mc)
+    t_look=time.time()-t0
+    out[0]=vG.theta_thst(np.round(thS)/100.,ts,tr)
+    rows.append(row('pedo 101',t_setup,t_look,out))
+    for lev in levels:
+        for method in methods:
+            t0=time.time()
+            ptab=proptable_build(sm,lev,method)
+            t_setup=time.time()-t0
+            t0=time.time()
+            out=proptable_eval(thS,soil,ptab)
+            t_look=time.time()-t0
+            rows.append(row(method+' '+str(lev),t_setup,t_look,out))
+    report=pd.DataFrame(rows,columns=['table','setup [s]','lookup [s]']+[nm+' max' for nm in names]+[nm+' median' for nm in names])
+    print report.to_string(index=False)
+    return report
+
 def boundcheck(lat,z,mc):
     '''Boundary checks
     '''
+    if mc.prects=='radial':
+        #reflecting axis and outer wall
+        lat[lat<0.0]=-lat[lat<0.0]
+        lat[lat>mc.mgrid.width[0]]=2.*mc.mgrid.width[0]-lat[lat>mc.mgrid.width[0]]
+        lat[lat<0.0]=0.0
     #cycle bound:
     #if any(lat<0.0):
     lat[lat<0.0]=mc.mgrid.width[0]+lat[lat<0.0]
@@ -154,6 +403,13 @@ def boundcheck(lat,z,mc):
     z[-nodrain]=mc.mgrid.depth[0]+0.000000000001
     return [lat,z,nodrain]
 
+def radial_drift(r,D,dt,mc):
+    '''Drift of the radial random walk (D/r) in the axisymmetric domain.
+       The radius is cut at half a cell width to avoid the singularity at the axis.
+    '''
+    r=np.fmax(r,mc.mgrid.latfac.values[0]/2.)
+    return D*dt/r
+
 def assignadvect(no,mc,dummy=None,realcrosssec=True):
     '''Assign advective velocity from observed velocity distribution 
        stored in mc.a_velocity or mc.a_velocity_real.
@@ -198,7 +454,323 @@ def assignadvect(no,mc,dummy=None,realcrosssec=True):
 
     return adv
 
-def mac_advection(particles,mc,thS,dt,clog_switch=False,maccoatscaling=1.,exfilt_method='Ediss',film=True,retardfac=0.5,dynamic_pedo=False,ksnoise=1.):
+def mac_geometry_setup(mc):
+    '''Static geometry tables of the macropores used by mac_advection.
+       Needs the particle definition (particle_setup) and is stored in mc:
+       mac_refpos: reference positions of the macropore capacity (as macropore index)
+       mac_gridcells: number of particle diameter steps of each macropore
+       mac_offset: offset of each macropore in the concatenated (segmented) macropore grid
+       mac_cell: soil grid cell of each macropore step (padded with -1)
+       mac_R2, mac_uhag, mac_Etkin: r2, max Hagen-Poiseuille flow and translatory energy
+       mac_ev*: segments of the macropores between soil grid rows and depth increments
+                (bottom/top depth, macropore, soil cell, depth increment and number of slots)
+                concatenated for all macropores with mac_evoffset and mac_evcount
+    '''
+    refpos=np.unique(mc.macP[0].exterior.coords.xy[1])[::-1] #reference position (z) of macropore capacity
+    mc.mac_refpos=np.round(-refpos/mc.particleD).astype(int) #reference position as macropore index
+    mc.mac_gridcells=np.floor(np.asarray(mc.md_macdepth).ravel()/mc.particleD[0]).astype(np.int64)
+    mc.mac_offset=np.append(0,np.cumsum(mc.mac_gridcells)[:-1])
+    mc.mac_cell=-np.ones((len(mc.maccols),np.amax(mc.mac_gridcells)),dtype=np.int64)
+    for maccol in np.arange(len(mc.maccols)):
+        mxgridcell=mc.mac_gridcells[maccol]
+        mc.mac_cell[maccol,:mxgridcell]=cellgrid(mc.md_pos[maccol].repeat(mxgridcell),-np.arange(mxgridcell)*mc.particleD,mc)
+    mc.mac_R2=np.mean(mc.md_area,axis=1)/np.pi #r2 of macropore (mean over depth)
+    mc.mac_uhag=2.*(1000.*const.g*mc.mac_R2 / (8*0.001308)) #max Hagen Poiseuille laminar flow at center
+    mc.mac_Etkin=(mc.particlemass/1000.)*0.5*mc.mac_uhag**2
+
+    #segments for the event-driven transport (mac_advection_event)
+    vertfac=np.abs(mc.mgrid.vertfac.values[0])
+    evbot=[]
+    for maccol in np.arange(len(mc.maccols)):
+        mdepth=np.asarray(mc.md_macdepth).ravel()[maccol]
+        bounds=np.append(np.arange(1,int(np.ceil(mdepth/vertfac))+1)*vertfac,mc.md_depth)
+        bounds=np.unique(np.round(bounds,8))
+        evbot.append(np.append(bounds[(bounds>0.) & (bounds<mdepth)],mdepth))
+    mc.mac_evcount=np.array([len(b) for b in evbot],dtype=np.int64)
+    mc.mac_evoffset=np.append(0,np.cumsum(mc.mac_evcount)[:-1])
+    mc.mac_evmac=np.repeat(np.arange(len(mc.maccols)),mc.mac_evcount)
+    mc.mac_evbot=np.concatenate(evbot)
+    mc.mac_evtop=np.concatenate([np.append(0.,b[:-1]) for b in evbot])
+    evmid=0.5*(mc.mac_evtop+mc.mac_evbot)
+    mc.mac_evcell=cellgrid(mc.md_pos[mc.mac_evmac],-evmid,mc).astype(np.int64)
+    mc.mac_evincr=np.clip(macdepth_idx(-evmid,mc),0,np.shape(mc.maccap)[1]-1)
+    mc.mac_evslots=np.fmax(np.round((mc.mac_evbot-mc.mac_evtop)/mc.particleD[0]),1.).astype(np.int64)
+
+    #exchange tables of the Ediss exfiltration
+    if hasattr(mc,'psi'):
+        mac_exchange_tables(mc)
+    return mc
+
+def mac_exchange_tables(mc,dynamic_pedo=False):
+    '''Ediss exchange tables for all pairs of soils on the macropore columns
+       and all pairs of states (thS at start, thS at end of the projected step).
+       The last axis holds the darcy flux into the matrix Q and dpsi/dtheta*g*rho,
+       both from the geometric means of the start and end cell.
+       mc.ediss_sidx maps the soil id to the first two axes (-1 if not on a macropore column).
+       dynamic_pedo: closed form vG functions with ks*1 (mc.ediss_dyn), the flux and
+                     dpsi/dtheta scale with the geometric mean of the ks factors of both cells
+    '''
+    cells=np.append(mc.mac_cell[mc.mac_cell>=0],mc.mac_evcell)
+    soils=np.unique(mc.soilgrid.ravel()[cells]-1)
+    mc.ediss_sidx=-np.ones(len(mc.soilmatrix),dtype=np.int64)
+    mc.ediss_sidx[soils]=np.arange(len(soils))
+    lev=np.shape(mc.psi)[0]
+    psi=np.zeros((len(soils),lev))
+    dpsi=np.zeros((len(soils),lev))
+    k=np.zeros((len(soils),lev))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for i in np.arange(len(soils)):
+            sl=soils[i]
+            if dynamic_pedo:
+                th=np.arange(lev)/100.
+                alpha=float(mc.soilmatrix.alpha.values[sl])
+                n=float(mc.soilmatrix.n.values[sl])
+                ks=mc.soilmatrix.ks.values[sl]
+                psi[i]=vG.psi_thst(th,alpha,n)
+                dpsi[i]=vG.dcst_thst(th,mc.soilmatrix.ts.values[sl],mc.soilmatrix.tr.values[sl],ks,alpha,n)
+                k[i]=vG.ku_psi(psi[i],ks,alpha,n)
+            else:
+                psi[i]=mc.psi[:,sl]
+                dpsi[i]=mc.dpsidtheta[:,sl]
+                k[i]=mc.ku[:,sl]
+        tab=np.zeros((len(soils),len(soils),lev,lev,2))
+        for i in np.arange(len(soils)):
+            for j in np.arange(len(soils)):
+                tab[i,j,:,:,0]=np.sqrt(np.outer(k[i],k[j]))*np.sqrt(np.outer(psi[i],psi[j]))/mc.particleD[0]
+                tab[i,j,:,:,1]=np.sqrt(np.outer(dpsi[i],dpsi[j]))*const.g*1000.
+    if dynamic_pedo:
+        mc.ediss_dyn=tab
+    else:
+        mc.ediss_tab=tab
+    return tab
+
+def mac_exchange(idx,idy,thS,mc,dynamic_pedo=False,ksnoise=1.):
+    '''Ediss exchange between the soil cells idx (start) and idy (end) from the exchange tables
+       Outputs: 1 darcy flux into matrix, 2 dpsi/dtheta*g*rho
+    '''
+    if dynamic_pedo:
+        if not hasattr(mc,'ediss_dyn'):
+            mac_exchange_tables(mc,True)
+        tab=mc.ediss_dyn
+    else:
+        if not hasattr(mc,'ediss_tab'):
+            mac_exchange_tables(mc)
+        tab=mc.ediss_tab
+    #the exchange tables are at integer percent (also for a float thS of dynamic_pedo=='table')
+    thS=thS.ravel().astype(np.int64)
+    ex=tab[mc.ediss_sidx[mc.soilgrid.ravel()[idx]-1],mc.ediss_sidx[mc.soilgrid.ravel()[idy]-1],thS[idx],thS[idy]]
+    if dynamic_pedo:
+        if type(ksnoise)==float:
+            ksf=ksnoise
+        else:
+            ksf=np.sqrt(ksnoise.ravel()[idx]*ksnoise.ravel()[idy])
+        return [ex[...,0]*ksf,ex[...,1]*ksf]
+    return [ex[...,0],ex[...,1]]
+
+def macdepth_idx(x,mc):
+    '''Increment of the macropore depth definition (mc.md_depth) for positions -x
+       This is the last increment above -x and -1 above the first definition.
+    '''
+    i=np.searchsorted(mc.md_depth,-np.asarray(x),side='right')
+    return np.where(i<len(mc.md_depth),i-1,len(mc.md_depth)-1)
+
+def macfree_index(mfilling):
+    '''Index structures over the filling state of the macropore grid:
+       prefix sum of free slots and next free slot at or below each slot.
+    '''
+    free=(mfilling==0)
+    cumfree=np.append(0,np.cumsum(free))
+    nextfree=np.where(free,np.arange(len(mfilling)),len(mfilling))
+    nextfree=np.append(np.minimum.accumulate(nextfree[::-1])[::-1],len(mfilling))
+    return [cumfree,nextfree]
+
+def freecount_idx(idx,idy,cumfree,end=None):
+    '''Number of free slots in mfilling[idx:idy] for all particles (see macfree_index)
+       end: end of the grid segment of each particle (default: end of mfilling)
+    '''
+    if end is None:
+        end=len(cumfree)-1
+    a=np.clip(idx,0,len(cumfree)-1)
+    b=np.clip(np.fmin(idy,end),0,len(cumfree)-1)
+    return np.where(b>a,cumfree[b]-cumfree[a],0)
+
+def firstfree_idx(idx,idy,nextfree,end=None):
+    '''Steps to the first free slot in mfilling[idx:idy] for all particles (see macfree_index)
+       Returns 0 if there is no free slot on course.
+    '''
+    if end is None:
+        end=len(nextfree)-1
+    f=nextfree[np.clip(idx,0,len(nextfree)-1)]
+    hit=(idx<idy) & (f<np.fmin(idy,end-1))
+    return np.where(hit,f-idx-1,0)
+
+def clogpos_idx(idx,idy,cap,mfilling,end=None):
+    '''Position of the first slot in mfilling[idx:idy] with filling below capacity cap
+       for all particles. Returns idy if there is no such slot and -1 if idx==idy.
+    '''
+    if end is None:
+        end=np.repeat(len(mfilling),len(idx))
+    clog=-np.ones(len(idx),dtype=np.int64)
+    for c in np.unique(cap):
+        sel=np.where((cap==c) & (idx!=idy))[0]
+        below=np.where(mfilling<c,np.arange(len(mfilling)),len(mfilling))
+        nextbelow=np.append(np.minimum.accumulate(below[::-1])[::-1],len(mfilling))
+        f=nextbelow[np.clip(idx[sel],0,len(mfilling))]
+        hit=(idx[sel]<idy[sel]) & (f<np.fmin(idy[sel],end[sel]))
+        clog[sel]=np.where(hit,f,idy[sel])
+    return clog
+
+def macbucket_init(particles,mc):
+    '''Bucket index of the particles in each macropore.
+       mc.macbucket holds a sorted array of particle labels for each macropore,
+       built with one pass over the flags. It is maintained with macbucket_add
+       and macbucket_remove, entries of particles which left are dropped lazily.
+    '''
+    flag=particles.flag.values.astype(np.int64)
+    labels=particles.index.values
+    order=np.argsort(flag,kind='mergesort')
+    bounds=np.searchsorted(flag[order],np.arange(len(mc.maccols)+2))
+    mc.macbucket=[np.sort(labels[order[bounds[i]:bounds[i+1]]]) for i in np.arange(1,len(mc.maccols)+1)]
+    return mc.macbucket
+
+def macbucket_add(labels,flags,mc):
+    '''Add particles (labels) to the buckets of the macropores given by their flags
+    '''
+    if not hasattr(mc,'macbucket'):
+        return
+    flags=np.asarray(flags).astype(np.int64)
+    labels=np.asarray(labels)
+    for mp in np.unique(flags[(flags>0) & (flags<=len(mc.maccols))]):
+        mc.macbucket[mp-1]=np.union1d(mc.macbucket[mp-1],labels[flags==mp])
+
+def macbucket_remove(labels,maccol,mc):
+    '''Remove particles (labels) from the buckets of macropores maccol (scalar or per particle)
+    '''
+    if not hasattr(mc,'macbucket'):
+        return
+    labels=np.asarray(labels)
+    maccol=np.asarray(maccol).repeat(len(labels)) if np.ndim(maccol)==0 else np.asarray(maccol)
+    for mp in np.unique(maccol):
+        mc.macbucket[mp]=np.setdiff1d(mc.macbucket[mp],labels[maccol==mp],assume_unique=True)
+
+def labelpos(particles,labels):
+    '''Position of the labels in the particle index (-1 if missing), with searchsorted
+       if the index is monotonic, else with a lookup of the labels
+    '''
+    if not particles.index.is_unique:
+        raise ValueError('the particle labels are not unique')
+    pidx=particles.index.values
+    if particles.index.is_monotonic_increasing:
+        pos=np.searchsorted(pidx,labels)
+        pos[pos>=len(pidx)]=0
+        pos[pidx[pos]!=labels]=-1
+    else:
+        pos=particles.index.get_indexer(labels)
+    return pos
+
+def macbucket_all(particles,mc):
+    '''Positional index of the particles in all macropores and their macropore (0-based).
+       The labels of the buckets are located in the particle index (labelpos) and checked against the flag.
+       Stale entries are removed from the buckets. The positions are sorted within each macropore.
+    '''
+    labels=np.concatenate(mc.macbucket+[np.array([],dtype=np.int64)]).astype(np.int64)
+    mac=np.repeat(np.arange(len(mc.macbucket)),[len(b) for b in mc.macbucket])
+    pos=labelpos(particles,labels)
+    valid=(pos>=0)
+    valid[valid]=(particles.flag.values[pos[valid]]==(mac[valid]+1))
+    if not all(valid):
+        bounds=np.cumsum(np.bincount(mac[valid],minlength=len(mc.macbucket)))[:-1]
+        mc.macbucket=np.split(labels[valid],bounds)
+    [pos,mac]=[pos[valid],mac[valid]]
+    if not particles.index.is_monotonic_increasing:
+        order=np.lexsort((pos,mac))
+        [pos,mac]=[pos[order],mac[order]]
+    return [pos,mac]
+
+def macslot(z,pmac,mc):
+    '''Slot of the particles at depth z in macropores pmac (0-based) in the concatenated
+       grid of all macropores (particle diameter steps, see mac_geometry_setup)
+    '''
+    p_mzid=np.floor(-np.asarray(z)/mc.particleD[0]).astype(np.int64)
+    p_mzid=np.clip(p_mzid,0,mc.mac_gridcells[pmac]-1)
+    return mc.mac_offset[pmac]+p_mzid
+
+def macocc_init(particles,mc):
+    '''Occupancy of the macropore grids (particles per slot, see macslot) as state mc.macocc.
+       It is counted once and then updated incrementally with macocc_add by advection,
+       exfiltration, drainage, infiltration and the entry from the matrix, and with
+       macocc_leave by the clean up of the driver.
+    '''
+    if not hasattr(mc,'mac_cell'):
+        mac_geometry_setup(mc)
+    if not hasattr(mc,'macbucket'):
+        macbucket_init(particles,mc)
+    [midx,pmac]=macbucket_all(particles,mc)
+    mc.macocc=np.bincount(macslot(particles.z.values[midx],pmac,mc),minlength=np.sum(mc.mac_gridcells))
+    return mc.macocc
+
+def macocc_add(z,flags,mc,sign=1):
+    '''Add (sign=1) or remove (sign=-1) particles at depth z to the occupancy of the macropores given by their flags
+    '''
+    if not hasattr(mc,'macocc'):
+        return
+    flags=np.asarray(flags).astype(np.int64)
+    sel=(flags>0) & (flags<=len(mc.maccols))
+    np.add.at(mc.macocc,macslot(np.asarray(z)[sel],flags[sel]-1,mc),sign)
+
+def macocc_leave(particles,mask,mc):
+    '''Remove the particles at mask (boolean or positions) which are in a macropore from the
+       occupancy and the buckets, before the driver drops them or sets their flags
+    '''
+    flags=particles.flag.values[mask].astype(np.int64)
+    sel=(flags>0) & (flags<=len(mc.maccols))
+    if not any(sel):
+        return
+    macocc_add(particles.z.values[mask][sel],flags[sel],mc,-1)
+    macbucket_remove(particles.index.values[mask][sel],flags[sel]-1,mc)
+
+def macfilm(slot):
+    '''Position of each particle in the film: the rank of the particle within its slot
+       (in order of appearance, starting with 1) from a stable sort by slot
+    '''
+    order=np.argsort(slot,kind='mergesort')
+    sorted_slot=slot[order]
+    filmloc=np.empty(len(slot),dtype=int)
+    filmloc[order]=np.arange(len(slot))-np.searchsorted(sorted_slot,sorted_slot)+1
+    return filmloc
+
+def macfil(p_mzid,mxgridcell):
+    '''Filling of the macropore grid and position of each particle in the film (see macfilm).
+       Outputs: 1 filling state, 2 location in film/distance to porewall
+    '''
+    mfilling=np.bincount(p_mzid,minlength=mxgridcell)
+    return [mfilling, macfilm(p_mzid)]
+
+def mac_exfilt_lat(z,pmac,mc,refined=False):
+    '''Lateral position of particles exfiltrating from the macropores pmac at z
+       The particles are placed at random within the contact width (mc.md_contact) at their depth.
+       refined: the particles are placed at random into a subcell of the locally refined grid which is
+                in contact with the macropore (mc.ref_macconnect) in their row of the fine grid,
+                within the contact width if no subcell of the row is in contact
+    '''
+    macincr=np.fmin(macdepth_idx(z,mc),np.shape(mc.md_contact)[1]-1)
+    lat=mc.md_pos[pmac]+mc.md_contact[pmac,macincr]*(np.random.rand(len(pmac))-0.5)
+    if refined:
+        rw=np.floor(np.asarray(z)/(mc.mgrid.vertfac.values[0]/mc.ref_fac)).astype(np.int64)
+        rw=np.fmin(np.fmax(rw,0),np.shape(mc.ref_idx)[0]-1)
+        conn=(mc.ref_macconnect[mc.ref_idx[rw,:]]==pmac[:,np.newaxis]+1)
+        ncon=conn.sum(axis=1)
+        sub=np.where(ncon>0)[0]
+        if len(sub)>0:
+            #k-th contact subcell in the row of the particle
+            k=np.floor(np.random.rand(len(sub))*ncon[sub])
+            cl=np.argmax(np.cumsum(conn[sub],axis=1)>k[:,np.newaxis],axis=1)
+            lat[sub]=(cl+np.random.rand(len(sub)))*mc.mgrid.latfac.values[0]/mc.ref_fac
+    if mc.prects=='radial':
+        lat=np.abs(lat)
+    return lat
+
+def mac_advection(particles,mc,thS,dt,clog_switch=False,maccoatscaling=1.,exfilt_method='Ediss',film=True,retardfac=0.5,dynamic_pedo=False,ksnoise=1.,refined=False):
     '''Calculate Advection in Macropore
        Advective particle movement in macropore with retardation of the advective momentum 
        through drag at interface, plus check for each macropore's capacity and possible overload (clog_switch).
@@ -215,6 +787,8 @@ def mac_advection(particles,mc,thS,dt,clog_switch=False,maccoatscaling=1.,exfilt
                       RWdiff = Random Walk Diffusion: a simple stochastic term simulates diffusion into the matrix
        film: if True, particles may move more quickly if inside a film at the pore wall
        retardfac: assumption of wetting resistance - factor reducing infiltration of the first film layer (only if film == True)
+       refined: if True, exfiltrating particles are placed into the contact subcells of the locally refined grid
+                (see mac_exfilt_lat, requires macropore_ini.mac_refine_setup)
 
        OUTPUTS
        particles: pandas data frame of all particles after advection
@@ -222,336 +796,627 @@ def mac_advection(particles,mc,thS,dt,clog_switch=False,maccoatscaling=1.,exfilt
        exfilt_p: number of particles which exfiltrated from the macropores
     '''
 
-    pm=mc.particlemass/1000. #particle mass conversion into kg
-
     thS=thS.ravel()
     s_red=np.array([])
     exfilt_p=0.
     s_red_store=[]
-    refpos=np.unique(mc.macP[0].exterior.coords.xy[1])[::-1] #reference position (z) of macropore capacity > this may be sourced in dataread
-    refpos=np.round(-refpos/mc.particleD).astype(int) #reference position as macropore index
-    #loop through macropores
-    for maccol in np.arange(len(mc.maccols)):
-        macstate=[]
-        if not particles.loc[particles.flag==(maccol+1)].empty:
-            #project advection step
-            midx=np.where(particles.flag==(maccol+1))[0]
-            #macropore is divided in grid of particle diameter steps
-            #ux=particles.loc[particles.flag==(maccol+1),'advect'].values
+    if not hasattr(mc,'mac_cell'):
+        mac_geometry_setup(mc)
+    refpos=mc.mac_refpos #reference position as macropore index
+    if not hasattr(mc,'macbucket'):
+        macbucket_init(particles,mc)
+    if not hasattr(mc,'macocc'):
+        macocc_init(particles,mc)
+
+    #particles of all macropores from the bucket index
+    [midx,pmac]=macbucket_all(particles,mc)
+    if len(midx)==0:
+        return [particles,s_red_store,exfilt_p]
+
+    #the grids of all macropores (particle diameter steps) are concatenated to one segmented grid
+    #a particle in step mzid of macropore pmac takes slot gbase+mzid, its segment ends at gend
+    ncell=mc.mac_gridcells[pmac]
+    gbase=mc.mac_offset[pmac]
+    gend=gbase+ncell
+
+    def macpos(z,mxgridcell):
+        #get position in macropore
+        p_mzid=np.floor(-z/mc.particleD).astype(int)
+        #bound checks
+        p_mzid=np.where(p_mzid>mxgridcell-1,mxgridcell-1,p_mzid)
+        p_mzid[p_mzid<0]=0
+        #Outputs: 1 film id
+        return p_mzid
+
+    #id in macropore
+    p_z=particles.z.values[midx]
+    particles_mzid=macpos(p_z,ncell)
+
+    #filling of the macropore grids is the live occupancy state (updated in place)
+    #film position of the particles at the start of the step
+    mfilling=mc.macocc
+    filmloc=macfilm(gbase+particles_mzid)
+
+    #advective velocity
+    ux=particles.advect.values[midx]
+    #particles reset advective velocity when far from pore wall
+    ux[filmloc>1]=assignadvect(sum(filmloc>1),mc)
+
+    s_proj=ux*dt #project step
+    z_proj=p_z+s_proj #project new position
+
+    #check lower boundary
+    nodrain=(z_proj>=mc.soildepth)
+    if any(-nodrain):
+        z_proj[-nodrain]=mc.soildepth
+    #cell of projected step
+    proj_mzid=macpos(z_proj,ncell)
+
+    exfilt=particles_mzid<0 #create exfilt array with all False
+    s_red_store=np.zeros(len(particles_mzid))
+
+    particles_znew=p_z.copy()
+
+    #single pass through the macropores from front to back:
+    #particles are grouped by their start cell and processed from the deepest cell upwards,
+    #each group experiences the filling left by the particles ahead of it.
+    #the level of a group is its rank from the front, all macropores are processed at once per level
+    order=np.lexsort((-particles_mzid,pmac))
+    gslot=gbase[order]+particles_mzid[order]
+    newgroup=np.append(True,np.diff(gslot)!=0)
+    groupid=np.cumsum(newgroup)-1
+    groupstart=np.where(newgroup)[0]
+    groupsize=np.diff(np.append(groupstart,len(order)))
+    newmac=np.append(True,np.diff(pmac[order])!=0)
+    level=groupid-groupid[np.where(newmac)[0]][np.cumsum(newmac)-1]
+    levelorder=np.argsort(level,kind='mergesort')
+    levelbounds=np.searchsorted(level[levelorder],np.arange(np.amax(level)+2))
+
+    #index of the free slots, rebuilt when a slot changes between empty and occupied
+    [cumfree,nextfree]=macfree_index(mfilling)
+
+    #loop through levels:
+    for lev in np.arange(np.amax(level)+1):
+        sel=levelorder[levelbounds[lev]:levelbounds[lev+1]]
+        samplenow=order[sel]
+        startslot=gslot[sel]
+
+        #position in film: particles which moved up into the start cell in this pass (clogging)
+        #stay at the pore wall, the group follows in the order of macfil
+        filmloc[samplenow]+=np.fmax(mfilling[startslot]-groupsize[groupid[sel]],0)
+
+        #soil cell id of start and end
+        idx=mc.mac_cell[pmac[samplenow],particles_mzid[samplenow]]
+        idy=mc.mac_cell[pmac[samplenow],proj_mzid[samplenow]]
+        s_red=np.zeros(len(samplenow))
+        t_left=np.ones(len(samplenow))*dt
+        #u_hag=s_red #advective velocity after hagen-poiseuille
+        contactfac=np.ones(len(samplenow),dtype=np.float64)
+
+        #project diffusion into matrix
+        ##CONTACT FACE##
+        if film:
+            #assume film initialisation at pore wall 
+            exfilt_retard=np.zeros(len(samplenow),dtype=int)
             
-            #id and filling in macropore grid
-            mxgridcell=np.floor(mc.md_macdepth[maccol]/mc.particleD).astype(np.int64)[0]
-            def macpos(z,mxgridcell):
-                #get position in macropore
-                p_mzid=np.floor(-z/mc.particleD).astype(int)
-                #bound checks
-                p_mzid[p_mzid>mxgridcell-1]=mxgridcell-1
-                p_mzid[p_mzid<0]=0
-                #Outputs: 1 film id
-                return p_mzid
-
-            def macfil(p_mzid,mxgridcell):
-                #get macropore filling and position in film
-                p_mzid_plus1=np.append(p_mzid,np.arange(mxgridcell))
-                mfilling=np.bincount(p_mzid_plus1)-1
-                filmloc=np.ones(len(p_mzid),dtype=int)
-                for idx in np.where(mfilling>0)[0]:
-                    idy=np.where(p_mzid==idx)
-                    filmloc[idy]=np.arange(mfilling[idx],dtype=int)+1
-                #Outputs: 1 filling state, 2 location in film/distance to porewall
-                return [mfilling, filmloc]
-
-            #find macropore increment of particles
-            def findincr(x):
-                #DEBUG
-                #idxx=0
-                idx=np.where(mc.md_depth>-x)[0]-1
-                if len(idx)>=1:
-                    idxx=idx[0]
-                else:
-                    idxx=len(mc.md_depth)-1
-                return idxx
-            vfindincr = np.vectorize(findincr)
-
-            #id in macropore
-            particles_mzid=macpos(particles.loc[particles.flag==(maccol+1),'z'].values,mxgridcell)
-            
-            [mfilling, filmloc]=macfil(particles_mzid,mxgridcell)
+            #particles will proceed with v_adv to the end of the film
+            #therefore the reference will shift to the first free slot
+            ib=filmloc[samplenow]>1
+            if any(ib):
+                filmstep=firstfree_idx(gbase[samplenow[ib]]+particles_mzid[samplenow[ib]],gbase[samplenow[ib]]+proj_mzid[samplenow[ib]],nextfree,gend[samplenow[ib]])
+                s_red[ib]=-(filmstep+0.45)*mc.particleD
+                t_left[ib]=np.fmax(s_red[ib]/ux[samplenow[ib]],0.)
+
+                particles_mzid[samplenow[ib]]+=np.fmin(filmstep,ncell[samplenow[ib]]-particles_mzid[samplenow[ib]]) #project step to end of film
+                idx=mc.mac_cell[pmac[samplenow],particles_mzid[samplenow]] #update reference to soil
+                
+            filmweight=freecount_idx(gbase[samplenow]+particles_mzid[samplenow],gbase[samplenow]+proj_mzid[samplenow],cumfree,gend[samplenow]).astype(np.float64) #free slots on course
+            passage=(proj_mzid[samplenow]-particles_mzid[samplenow]).astype(np.float64) #length of projected voyage
             
-            #advective velocity
-            ux=particles.loc[particles.flag==(maccol+1),'advect'].values
-            #particles reset advective velocity when far from pore wall
-            ux[filmloc>1]=assignadvect(sum(filmloc>1),mc)
-
-            s_proj=ux*dt #project step
-            z_proj=particles.loc[particles.flag==(maccol+1),'z'].values+s_proj #project new position
-
-            #check lower boundary
-            nodrain=(z_proj>=mc.soildepth)
-            if any(-nodrain):
-                z_proj[-nodrain]=mc.soildepth
-            #cell of projected step
-            proj_mzid=macpos(z_proj,mxgridcell)
-
-            #id of macropore in soil grid
-            mac_cell=cellgrid(mc.md_pos[maccol].repeat(mxgridcell),-np.arange(mxgridcell)*mc.particleD,mc)
-
-            exfilt=particles_mzid<0 #create exfilt array with all False
-            s_red_store=np.zeros(len(particles_mzid))
+            contactfac=np.ones(len(samplenow),dtype=np.float64)
+            ia=filmweight>0.
+            ic=passage>0.
+            if any(ia & ic):
+                contactfac[ia & ic]=filmweight[ia & ic]/passage[ia & ic]
+
+            #particles at position 1 in film can be retarded for exfiltration to simulate a film
+            exfilt_retard[filmloc[samplenow]==1]=1
             
-            #splitsample macropore particles according to filling
-            splitfac=int(np.round(np.amax(mfilling).astype(float)/2.))
-            if splitfac>1:
-                N_tot=np.arange(len(particles_mzid),dtype=np.int64)
-                if (len(N_tot)/splitfac)*splitfac!=len(N_tot):
-                    adddummy=int(np.round((np.ceil(len(N_tot)/float(splitfac))-len(N_tot)/float(splitfac))*splitfac))
-                    N_tot=np.concatenate([N_tot,np.zeros(adddummy)*np.nan])
-                sampleset=np.random.permutation(N_tot).reshape([splitfac,len(N_tot)/splitfac]).astype(np.int64)
+        else:
+            #assume only film particles to interact with the matrix
+            dragweight=freecount_idx(gbase[samplenow]+particles_mzid[samplenow],gbase[samplenow]+proj_mzid[samplenow],cumfree,gend[samplenow]) #free slots on course
+            passage=(proj_mzid[samplenow]-particles_mzid[samplenow]).astype(np.float64) #length of projected voyage
+            ia=dragweight>0.
+            ib=passage>0.
+            if any(ia & ib):
+                contactfac[ia & ib]=1.-(dragweight[ia & ib]/passage[ia & ib])
+        
+        #scale contactfac with coating factor
+        contactfac=contactfac/maccoatscaling
+
+        if exfilt_method=='RWdiff':
+            xi=np.random.rand(len(samplenow))
+            #diffusion over projected passage as geo mean of start and end
+            if dynamic_pedo:
+                if type(ksnoise)==float:
+                    [ksx,ksy]=[ksnoise,ksnoise]
+                else:
+                    [ksx,ksy]=[ksnoise[idx],ksnoise[idy]]
+                D1=pedo_props(thS.ravel()[idx],mc.soilgrid.ravel()[idx]-1,mc,ksx,dynamic_pedo)[4]
+                D2=pedo_props(thS.ravel()[idy],mc.soilgrid.ravel()[idy]-1,mc,ksy,dynamic_pedo)[4]
+                D=np.sqrt(D1*D2)
             else:
-                splitfac=1
-                #sampleset=np.arange(len(particles_mzid),dtype=np.int64)
-                sampleset=np.tile(np.arange(len(particles_mzid),dtype=np.int64),2).reshape([2,len(particles_mzid)])
+                D=np.sqrt(mc.D[thS.ravel()[idx],mc.soilgrid.ravel()[idx]-1]*mc.D[thS.ravel()[idy],mc.soilgrid.ravel()[idy]-1])
+
+            diff_proj=(xi*((2*D*t_left)**0.5))*contactfac
+
+            if film:
+                diff_proj[exfilt_retard==1]*=retardfac
+            adv_retard=(mc.particleD.repeat(len(diff_proj))-diff_proj)/mc.particleD
+            adv_retard[adv_retard<0.]=0.
             
-            particles_znew=particles.loc[particles.flag==(maccol+1),'z'].values
-
-            #loop through splitsamples:
-            for subsample in np.arange(splitfac):
-                samplenow=sampleset[subsample]
-                #if type(sampleset[subsample])!=np.array:
-                #    samplenow=np.array(sampleset[subsample])
-                #elif len(sampleset[subsample])>1:
-                samplenow=samplenow[samplenow>=0]
-                if sum(samplenow>=0)<1:
-                    continue #go to next iteration cycle if no particles are selected
-
-                #update gridfill
-                particles_mzid=macpos(particles_znew,mxgridcell)
-                [mfilling, filmloc]=macfil(particles_mzid,mxgridcell)
-
-                #functions to check free slots in macropore along path
-                #mfilling must be defined before as filling state of macropore, thus new def of functions here
-                def contactcount(idx,idy):
-                    #ocuppied slots on course
-                    return np.count_nonzero(mfilling[idx:idy]==0)
-                vcontactcount=np.vectorize(contactcount)
-                def freecount(idx,idy):
-                    #free slots on course
-                    return sum(mfilling[idx:idy]==0)
-                vfreecount=np.vectorize(freecount)
-                def firstfree(idx,idy):
-                    #find first free slot on course and count steps
-                    f=np.where(mfilling[idx:idy]==0)[0]
-                    if len(f)==0:
-                        ff=0
-                    else:
-                        f=np.amax(f[0]-1,0)
-                        ff=np.fmin(f,idy-idx)
-                    return ff
-                vfirstfree=np.vectorize(firstfree)
-
-                #dragweight=vcontactcount(particles_mzid[samplenow],proj_mzid[samplenow]) #free slots on course
-                #filmweight=vfreecount(particles_mzid[samplenow],proj_mzid[samplenow]) #occupied slots on course
-                #passage=(proj_mzid[samplenow]-particles_mzid[samplenow]).astype(np.float64) #length of projected voyage
-
-                #soil cell id of start and end
-                idx=mac_cell[particles_mzid[samplenow]]
-                idy=mac_cell[proj_mzid[samplenow]]
-                s_red=np.zeros(len(samplenow))
-                t_left=np.ones(len(samplenow))*dt
-                #u_hag=s_red #advective velocity after hagen-poiseuille
-                contactfac=np.ones(len(samplenow),dtype=np.float64)
-
-                #project diffusion into matrix
-                ##CONTACT FACE##
-                if film:
-                    #assume film initialisation at pore wall 
-                    exfilt_retard=np.zeros(len(samplenow),dtype=int)
-                    
-                    #particles will proceed with v_adv to the end of the film
-                    #therefore the reference will shift to the first free slot
-                    ib=filmloc[samplenow]>1
-                    if any(ib):
-                        filmstep=vfirstfree(particles_mzid[samplenow[ib]],proj_mzid[samplenow[ib]])
-                        s_red[ib]=-(filmstep+0.45)*mc.particleD
-                        t_left[ib]=np.fmax(s_red[ib]/ux[samplenow[ib]],0.)
-
-                        particles_mzid[samplenow[ib]]+=np.fmin(filmstep,mxgridcell-particles_mzid[samplenow[ib]]) #project step to end of film
-                        idx=mac_cell[particles_mzid[samplenow]] #update reference to soil
-                        
-                    filmweight=vcontactcount(particles_mzid[samplenow],proj_mzid[samplenow]).astype(np.float64) #free slots on course
-                    passage=(proj_mzid[samplenow]-particles_mzid[samplenow]).astype(np.float64) #length of projected voyage
-                    
-                    contactfac=np.ones(len(samplenow),dtype=np.float64)
-                    ia=filmweight>0.
-                    ic=passage>0.
-                    if any(ia & ic):
-                        contactfac[ia & ic]=filmweight[ia & ic]/passage[ia & ic]
-
-                    #particles at position 1 in film can be retarded for exfiltration to simulate a film
-                    exfilt_retard[filmloc[samplenow]==1]=1
-                    
-                else:
-                    #assume only film particles to interact with the matrix
-                    dragweight=vcontactcount(particles_mzid[samplenow],proj_mzid[samplenow]) #free slots on course
-                    passage=(proj_mzid[samplenow]-particles_mzid[samplenow]).astype(np.float64) #length of projected voyage
-                    ia=dragweight>0.
-                    ib=passage>0.
-                    if any(ia & ib):
-                        contactfac[ia & ib]=1.-(dragweight[ia & ib]/passage[ia & ib])
-                
-                #scale contactfac with coating factor
-                contactfac=contactfac/maccoatscaling
-
-                if exfilt_method=='RWdiff':
-                    xi=np.random.rand(len(samplenow))
-                    #diffusion over projected passage as geo mean of start and end
-                    if dynamic_pedo:
-                        psi1=vG.psi_thst(thS.ravel()[idx],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idx]-1]).values
-                        psi2=vG.psi_thst(thS.ravel()[idy],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idy]-1]).values
-                        if type(ksnoise)==float:
-                            D1=vG.D_psi(psi1,ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.ts[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.tr[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idx]-1])
-                            D2=vG.D_psi(psi2,ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.ts[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.tr[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idy]-1])
-                        else:
-                            D1=vG.D_psi(psi1,ksnoise[idx]*mc.soilmatrix.ks[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.ts[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.tr[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idx]-1])
-                            D2=vG.D_psi(psi2,ksnoise[idy]*mc.soilmatrix.ks[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.ts[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.tr[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idy]-1])
-                        D=np.sqrt(D1*D2)
-                    else:
-                        D=np.sqrt(mc.D[thS.ravel()[idx],mc.soilgrid.ravel()[idx]-1]*mc.D[thS.ravel()[idy],mc.soilgrid.ravel()[idy]-1])
-
-                    diff_proj=(xi*((2*D*t_left)**0.5))*contactfac
-
-                    if film:
-                        diff_proj[exfilt_retard==1]*=retardfac
-                    adv_retard=(mc.particleD.repeat(len(diff_proj))-diff_proj)/mc.particleD
-                    adv_retard[adv_retard<0.]=0.
-                    
-                    ux[samplenow]*=adv_retard
-                    s_red+=ux[samplenow]*t_left
-                    
-                    exfilt[samplenow]=(adv_retard<=0.3)
-                #elif exfilt_method=='Ediss':
-                else:
-                    #experienced psi
-                    if dynamic_pedo:
-                        xsample=mc.soilgrid.ravel()[idx]-1
-                        psi1=vG.psi_thst(thS.ravel()[idx]/100.,mc.soilmatrix.alpha[xsample].values,mc.soilmatrix.n[xsample].values)
-                        xsample=mc.soilgrid.ravel()[idy]-1
-                        psi2=vG.psi_thst(thS.ravel()[idy]/100.,mc.soilmatrix.alpha[xsample].values,mc.soilmatrix.n[xsample].values)
-                        exp_psi=-np.sqrt(psi1*psi2)
-                        xsample=mc.soilgrid.ravel()[idx]-1
-                        ysample=mc.soilgrid.ravel()[idy]-1
-                        if type(ksnoise)==float:
-                            dD1=vG.dcst_thst(thS.ravel()[idx]/100., mc.soilmatrix.ts[xsample].values, mc.soilmatrix.tr[xsample].values,ksnoise*mc.soilmatrix.ks[xsample].values, mc.soilmatrix.alpha[xsample].values, mc.soilmatrix.n[xsample].values)
-                            dD2=vG.dcst_thst(thS.ravel()[idy]/100., mc.soilmatrix.ts[ysample].values, mc.soilmatrix.tr[ysample].values,ksnoise*mc.soilmatrix.ks[ysample].values, mc.soilmatrix.alpha[ysample].values, mc.soilmatrix.n[ysample].values)
-                        else:
-                            dD1=vG.dcst_thst(thS.ravel()[idx]/100., mc.soilmatrix.ts[xsample].values, mc.soilmatrix.tr[xsample].values,ksnoise[idx]*mc.soilmatrix.ks[xsample].values, mc.soilmatrix.alpha[xsample].values, mc.soilmatrix.n[xsample].values)
-                            dD2=vG.dcst_thst(thS.ravel()[idy]/100., mc.soilmatrix.ts[ysample].values, mc.soilmatrix.tr[ysample].values,ksnoise[idy]*mc.soilmatrix.ks[ysample].values, mc.soilmatrix.alpha[ysample].values, mc.soilmatrix.n[ysample].values)
-                        dpsi_dtheta=np.sqrt(dD1*dD2)
-                        if type(ksnoise)==float:
-                            k1=vG.ku_psi(psi1,ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idx]-1])
-                            k2=vG.ku_psi(psi2,ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idy]-1])
-                        else:
-                            k1=vG.ku_psi(psi1,ksnoise[idx]*mc.soilmatrix.ks[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idx]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idx]-1])
-                            k2=vG.ku_psi(psi2,ksnoise[idy]*mc.soilmatrix.ks[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()[idy]-1],mc.soilmatrix.n[mc.soilgrid.ravel()[idy]-1])
-                        k=np.sqrt(k1*k2)
-                    else:
-                        exp_psi=-np.sqrt(mc.psi[thS.ravel()[idx],mc.soilgrid.ravel()[idx]-1]*mc.psi[thS.ravel()[idy],mc.soilgrid.ravel()[idy]-1])
-                        dpsi_dtheta=np.sqrt(mc.dpsidtheta[thS.ravel()[idx],mc.soilgrid.ravel()[idx]-1]*mc.dpsidtheta[thS.ravel()[idy],mc.soilgrid.ravel()[idy]-1])
-                        k=np.sqrt(mc.ku[thS.ravel()[idx],mc.soilgrid.ravel()[idx]-1]*mc.ku[thS.ravel()[idy],mc.soilgrid.ravel()[idy]-1])
-                    
-                    #darcy flux into matrix
-                    Q=k*-exp_psi/mc.particleD
-                    if film:
-                        Q[exfilt_retard==1]*=retardfac
-
-                    q_ex=Q*contactfac
-                    #exchange impulse
-                    p_ex=mc.particleV*(dpsi_dtheta*const.g*1000.)/q_ex
-
-                    #theoretic translatory energy and
-                    #structural friction impulse
-                    R2=(np.mean(mc.md_area,axis=1)/np.pi)[maccol] #r2 of macropore (mean over depth)
-                    u_hag = 1000.*const.g*R2 / (8*0.001308) #mean Hagen Poiseuille laminar flow estimate
-                    u_hag *= 2. #max HP flow at center
-                    E_tkin = pm*0.5*u_hag**2
-                    p_dr = E_tkin/-ux[samplenow] #drag impulse based on current apparent particle velocity
-
-                    ux[samplenow]=-E_tkin/(p_ex+p_dr) #update particle velocity as reduced flow
-                    s_red+=ux[samplenow]*t_left #add advective step outside film
-                    
-                    ##Exfiltration##
-                    exfilt[samplenow]=(np.abs(q_ex*t_left)>mc.particleD[0]*0.5)
-
-                #perform advection
-                particles_znew[samplenow]+=s_red
-                s_red_store[samplenow]=s_red
-                
-                #check clogging of macropore
-                #this may be relevant for cohesive soils with small, coated macropores
-                if (clog_switch==True):
-                    #functions for clogging calculation
-                    #check macropore capacity (clogging)
-                    #check if clogging occurs and where
-                    def clogpos(idx,idy,idz):
-                        x=-1
-                        if (idx!=idy):
-                            #debug:
-                            #print np.shape(mc.maccap), maccol, idz
-                            #idz[idz>=np.shape(mc.maccap)[1]]=np.shape(mc.maccap)[1]-1
-                            idz_ref=np.where(refpos>idz)[0][0]-1
-
-                            t = mfilling[idx:idy]-mc.maccap[maccol,idz_ref]
-                            if any(t<0.):
-                                x=idx+np.nonzero(t<0.)[0][0] #mzid of clogged cell
-                            else:
-                                x=idy
-                        return x
-                    vclogpos=np.vectorize(clogpos)
-
-                    z_proj=particles_znew[samplenow]
-                    macincr=vfindincr(-z_proj)
-                    clog=vclogpos(particles_mzid[samplenow],proj_mzid[samplenow],macincr.astype(np.int))
-
-                    #cut advection at clogging
-                    cid=(clog>=0)
-                    if any(cid):
-                        #update z_proj to center of last free cell before clog
-                        z_proj[cid]=-mc.particleD*(clog[cid]-0.5)
-                        particles_znew[samplenow[cid]]=np.amax([particles_znew[samplenow[cid]],z_proj[cid]],axis=0)
-
-
-            #set for exfiltration if excceding macropore depth
-            exfilt_low = (particles_znew < -mc.md_macdepth[maccol])
-            particles_znew[exfilt_low] = -mc.md_macdepth[maccol]
-
-            particles_zid=np.floor(particles_znew/mc.mgrid.vertfac.values).astype(int)
-            particles_zid[particles_zid>=mc.mgrid.vertgrid.values[0]]=mc.mgrid.vertgrid.values[0]-1
-                
-            #assign new z into data frame:
-            [lat_new,z_new,nodrain]=boundcheck(particles.lat.iloc[midx],particles_znew,mc)
-            particles.loc[particles.flag==(maccol+1),'z']=z_new #particles_znew
-            particles.loc[particles.flag==(maccol+1),'cell']=cellgrid(particles.loc[particles.flag==(maccol+1),'lat'].values,particles.loc[particles.flag==(maccol+1),'z'].values,mc).astype(np.int64)
+            ux[samplenow]*=adv_retard
+            s_red+=ux[samplenow]*t_left
+            
+            exfilt[samplenow]=(adv_retard<=0.3)
+        #elif exfilt_method=='Ediss':
+        else:
+            #darcy flux into matrix and exchange potential
+            [Q,dpsi_g]=mac_exchange(idx,idy,thS,mc,dynamic_pedo,ksnoise)
+            if film:
+                Q[exfilt_retard==1]*=retardfac
+
+            q_ex=Q*contactfac
+            #exchange impulse
+            p_ex=mc.particleV*dpsi_g/q_ex
+
+            #theoretic translatory energy and
+            #structural friction impulse
+            E_tkin = mc.mac_Etkin[pmac[samplenow]] #from max Hagen Poiseuille laminar flow at center
+            p_dr = E_tkin/-ux[samplenow] #drag impulse based on current apparent particle velocity
+
+            ux[samplenow]=-E_tkin/(p_ex+p_dr) #update particle velocity as reduced flow
+            s_red+=ux[samplenow]*t_left #add advective step outside film
             
-            #assign updated advective velocity to particles
-            particles.loc[particles.flag==(maccol+1),'advect']=ux #particles_znew
-
-            #debug
-            exfilt+=exfilt_low
-            if any(exfilt):
-                exfilt_p+=sum(exfilt)
-                idy=midx[exfilt]
-                macincr=np.fmin(vfindincr(particles_znew[exfilt]),np.shape(mc.md_contact)[1]-1)
-                particles.flag.iloc[idy]=0
-                particles.lat.iloc[idy]=mc.md_pos[maccol]+mc.md_contact[maccol,macincr]*(np.random.rand(sum(exfilt))-0.5)
-
-            #handle draining particles if any
-            if any(-nodrain):
-                particles.flag.iloc[midx[-nodrain]]=len(mc.maccols)+1
-                particles.z.iloc[midx[-nodrain]]=mc.soildepth-0.0001
+            ##Exfiltration##
+            exfilt[samplenow]=(np.abs(q_ex*t_left)>mc.particleD[0]*0.5)
+
+        #perform advection
+        particles_znew[samplenow]+=s_red
+        s_red_store[samplenow]=s_red
+
+        #check clogging of macropore
+        #this may be relevant for cohesive soils with small, coated macropores
+        if (clog_switch==True):
+            z_proj=particles_znew[samplenow]
+            macincr=macdepth_idx(-z_proj,mc)
+            #capacity of the macropore at the increment of the particle
+            idz_ref=np.searchsorted(refpos,macincr.astype(np.int),side='right')-1
+            clog=clogpos_idx(gbase[samplenow]+particles_mzid[samplenow],gbase[samplenow]+proj_mzid[samplenow],mc.maccap[pmac[samplenow],idz_ref],mfilling,gend[samplenow])
+
+            #cut advection at clogging
+            cid=(clog>=0)
+            if any(cid):
+                #update z_proj to center of last free cell before clog
+                z_proj[cid]=-mc.particleD*(clog[cid]-gbase[samplenow[cid]]-0.5)
+                particles_znew[samplenow[cid]]=np.amax([particles_znew[samplenow[cid]],z_proj[cid]],axis=0)
+
+        #update filling of the macropore grids
+        newslot=gbase[samplenow]+macpos(particles_znew[samplenow],ncell[samplenow])
+        touched=np.append(startslot,newslot)
+        wasfree=(mfilling[touched]==0)
+        np.add.at(mfilling,startslot,-1)
+        np.add.at(mfilling,newslot,1)
+        if any(wasfree!=(mfilling[touched]==0)):
+            [cumfree,nextfree]=macfree_index(mfilling)
+    pslot=gbase+macpos(particles_znew,ncell)
+
+    #set for exfiltration if excceding macropore depth
+    exfilt_low = (particles_znew < -mc.md_macdepth[pmac])
+    particles_znew[exfilt_low] = -mc.md_macdepth[pmac[exfilt_low]]
+
+    #assign new z into data frame:
+    p_lat=particles.lat.values[midx]
+    [lat_new,z_new,nodrain]=boundcheck(p_lat.copy(),particles_znew,mc)
+    particles.z.iloc[midx]=z_new #particles_znew
+    particles.cell.iloc[midx]=cellgrid(p_lat,z_new,mc).astype(np.int64)
+
+    #assign updated advective velocity to particles
+    particles.advect.iloc[midx]=ux #particles_znew
+
+    #debug
+    exfilt+=exfilt_low
+    if any(exfilt):
+        exfilt_p+=sum(exfilt)
+        idy=midx[exfilt]
+        particles.flag.iloc[idy]=0
+        particles.lat.iloc[idy]=mac_exfilt_lat(particles_znew[exfilt],pmac[exfilt],mc,refined)
+        particles.cell.iloc[idy]=cellgrid(particles.lat.values[idy],particles.z.values[idy],mc).astype(np.int64)
+        macbucket_remove(particles.index.values[idy],pmac[exfilt],mc)
+        cellbucket_add(particles.index.values[idy],particles.cell.values[idy],mc)
+
+    #handle draining particles if any
+    if any(-nodrain):
+        particles.flag.iloc[midx[-nodrain]]=len(mc.maccols)+1
+        particles.z.iloc[midx[-nodrain]]=mc.soildepth-0.0001
+        macbucket_remove(particles.index.values[midx[-nodrain]],pmac[-nodrain],mc)
+
+    #exfiltrated and drained particles leave the occupancy
+    np.add.at(mfilling,pslot[exfilt | -nodrain],-1)
+
+    return [particles,s_red_store,exfilt_p]
+
+
+
+def mac_event_exchange(thS,mc,dynamic_pedo=False,ksnoise=1.):
+    '''Exchange between each macropore segment (see mac_geometry_setup) and its matrix cell
+       for the current matrix state.
+       Outputs: 1 Darcy flux into the matrix, 2 dpsi/dtheta*g*rho, 3 diffusivity of the matrix
+    '''
+    cell=mc.mac_evcell
+    soil=mc.soilgrid.ravel()[cell]-1
+    th=thS.ravel()[cell]
+    [Q,dpsi_g]=mac_exchange(cell,cell,thS,mc,dynamic_pedo,ksnoise)
+    if dynamic_pedo:
+        if type(ksnoise)==float:
+            ksn=ksnoise
+        else:
+            ksn=ksnoise.ravel()[cell]
+        Dm=pedo_props(th,soil,mc,ksn,dynamic_pedo)[4]
+    else:
+        Dm=mc.D[th,soil]
+    return [Q,dpsi_g,np.asarray(Dm)]
+
+def mac_advection_event(particles,mc,thS,dt,clog_switch=False,maccoatscaling=1.,exfilt_method='Ediss',film=True,retardfac=0.5,dynamic_pedo=False,ksnoise=1.,refined=False):
+    '''Event-driven Advection in Macropore
+       Macropore particles move in continuous time within the matrix time step dt. Each macropore
+       is divided into segments between the soil grid rows and the depth increments of the macropore
+       definition (see mac_geometry_setup). The events of a particle are:
+       - end of segment: the particle enters the next segment if it is below capacity,
+         else it waits at the boundary until a particle leaves the next segment (clogging)
+       - exfiltration: the exchange with the matrix accumulated in the time step exceeds half
+         a particle diameter (Ediss) or the random walk into the matrix covers 0.7 particle
+         diameters (RWdiff), as in mac_advection
+       - macropore bottom: drainage at the lower boundary or exfiltration
+       The events of all particles are processed in the order of their time from a priority
+       queue (heapq). Particles blocked by a full segment wait at its upper boundary and enter
+       in the order of their arrival when a particle leaves the segment.
+       The contact to the matrix refers to the projected passage of the rest of the time step
+       (start and end segment, share of free slots as in mac_advection). With film, particles beyond the wall layer of their segment move with
+       a new advective velocity until they enter the next segment (the film step of mac_advection)
+       and the particles in the wall layer of a segment are retarded by retardfac.
+       The retardation of the advective velocity is applied once per time step, at the first
+       contact of the particle to the matrix. The exchange flux follows the segments.
+       For sparse particles both modes agree. In crowded macropores mac_advection queues the
+       particles behind the film, here they pass segment by segment (up to the capacity).
+       The matrix state is synced at the matrix time step only (thS of the call).
+       Exfiltrating particles are placed as in mac_advection (mac_exfilt_lat).
+
+       INPUTS and OUTPUTS as in mac_advection
+       With clog_switch the capacity of a segment is its number of slots times mc.maccap
+       at its depth increment.
+    '''
+    thS=thS.ravel()
+    exfilt_p=0.
+    if not hasattr(mc,'mac_evbot'):
+        mac_geometry_setup(mc)
+    if not hasattr(mc,'macbucket'):
+        macbucket_init(particles,mc)
+    if not hasattr(mc,'macocc'):
+        macocc_init(particles,mc)
+
+    #particles of all macropores from the bucket index
+    [midx,pmac]=macbucket_all(particles,mc)
+    if len(midx)==0:
+        return [particles,[],exfilt_p]
+
+    [Q,dpsi_g,Dm]=mac_event_exchange(thS,mc,dynamic_pedo,ksnoise)
+    if clog_switch:
+        cap=mc.maccap[mc.mac_evmac,mc.mac_evincr]*mc.mac_evslots
+    else:
+        cap=np.repeat(len(midx)+1,len(mc.mac_evbot))
+    evbot=mc.mac_evbot
+    evslots=mc.mac_evslots
+    evlast=mc.mac_evoffset+mc.mac_evcount-1
+    pD=mc.particleD[0]
+    pV=np.asarray(mc.particleV).ravel()[0]
+    E_tkin=np.asarray(mc.mac_Etkin).ravel()
+    #segment of depth zz in macropore mac (the segments of all macropores are searched at once)
+    K=2.*np.amax(evbot)+1.
+    evkey=evbot+mc.mac_evmac*K
+    def segment(zz,mac):
+        return np.fmin(np.searchsorted(evkey,np.fmax(zz,0.)+mac*K,side='right'),evlast[mac])
+
+    #particle state (depth and downward velocity positive)
+    N=len(midx)
+    z0=-particles.z.values[midx]
+    z=z0.copy()
+    u=-particles.advect.values[midx]
+    seg=segment(z,pmac)
+    [occ,filmloc]=macfil(seg,len(evbot))
+    #particles reset advective velocity when far from pore wall
+    far=(filmloc>evslots[seg])
+    u[far]=-assignadvect(sum(far),mc)
+    tnow=np.zeros(N)
+    q_ex=np.zeros(N) #exchange flux into the matrix
+    expo=np.zeros(N) #exchange distance in the time step
+    t_ex=np.repeat(np.inf,N) #exfiltration time of the random walk (RWdiff)
+    contacted=np.zeros(N,dtype=bool) #retardation of the time step applied
+    state=np.zeros(N,dtype=int) #0 moving, 1 waiting, 2 exfiltrated, 3 drained
+
+    def contact(ids,t,wall):
+        #interaction with the matrix on the projected passage of the rest of the time step
+        #(from the current segment to the segment of the projected position, as in mac_advection)
+        #wall: the particles are in the wall layer of the segment (retarded by retardfac with film)
+        s=seg[ids]
+        sp=segment(z[ids]+u[ids]*(dt-t),pmac[ids])
+        #share of free slots on the passage, occ includes the particle itself
+        cumslots=np.append(0,np.cumsum(evslots))
+        cumocc=np.append(0,np.cumsum(occ))
+        slots=cumslots[sp+1]-cumslots[s]
+        free=slots-(cumocc[sp+1]-cumocc[s])
+        contactfac=np.where(free>0,free.astype(np.float64)/slots,1.)/maccoatscaling
+        first=film & wall
+        retard=~contacted[ids]
+        if exfilt_method=='RWdiff':
+            #random walk over the rest of the time step from the first contact
+            c=np.random.rand(len(ids))*contactfac*np.sqrt(2.*np.sqrt(Dm[s]*Dm[sp]))
+            c[first]*=retardfac
+            ir=retard & (c>0.)
+            u[ids[ir]]*=np.fmax(pD-c[ir]*np.sqrt(dt-t[ir]),0.)/pD
+            t_ex[ids[ir]]=t[ir]+(0.7*pD/c[ir])**2
+        else:
+            q=Q[s]*contactfac
+            q[first]*=retardfac
+            q_ex[ids]=q
+            ir=retard & (q>0.) & (u[ids]>0.)
+            [Qp,dpsi_p]=mac_exchange(mc.mac_evcell[s[ir]],mc.mac_evcell[sp[ir]],thS,mc,dynamic_pedo,ksnoise)
+            p_ex=pV*dpsi_p/(Qp*contactfac[ir]*np.where(first[ir],retardfac,1.))
+            u[ids[ir]]=E_tkin[pmac[ids[ir]]]/(p_ex+E_tkin[pmac[ids[ir]]]/u[ids[ir]])
+        contacted[ids[retard]]=True
+
+    if film:
+        contact(np.where(~far)[0],tnow[~far],np.ones(sum(~far),dtype=bool))
+    else:
+        contact(np.arange(N),tnow,~far)
+
+    #first event of each particle
+    t_move=np.repeat(np.inf,N)
+    moving=(u>0.)
+    t_move[moving]=(evbot[seg[moving]]-z[moving])/u[moving]
+    if exfilt_method=='RWdiff':
+        t_exf=t_ex.copy()
+    else:
+        t_exf=np.repeat(np.inf,N)
+        iq=(q_ex>0.)
+        t_exf[iq]=0.5*pD/q_ex[iq]
+    te=np.fmin(t_move,t_exf)
+    ids=np.where(te<dt)[0]
+    #event queue in global time order: (time, particle, version, exfiltration)
+    #a particle has one valid event, older ones are outdated by its version
+    heap=zip(te[ids].tolist(),ids.tolist(),[0]*len(ids),(t_exf<=t_move)[ids].tolist())
+    heapq.heapify(heap)
+
+    #the queue is processed one event at a time on the scalar state
+    [z,u,seg,tnow,q_ex,expo,t_ex,contacted,state]=[a.tolist() for a in [z,u,seg,tnow,q_ex,expo,t_ex,contacted,state]]
+    occ=occ.tolist()
+    version=[0]*N
+    waiting={} #particles waiting for each segment in the order of arrival
+    pmac_l=pmac.tolist()
+    [evbot_l,evkey_l,evlast_l,evslots_l,cap_l,Q_l,Dm_l]=[np.asarray(a).tolist() for a in [evbot,evkey,evlast,evslots,cap,Q,Dm]]
+    cumslots=np.append(0,np.cumsum(evslots)).tolist()
+    E_tkin_l=E_tkin.tolist()
+
+    def contact1(i,t,wall):
+        #contact of particle i on entering a segment (see contact)
+        if contacted[i] and (exfilt_method=='RWdiff'):
+            return #the random walk of the time step is drawn
+        s=seg[i]
+        sp=min(bisect_right(evkey_l,max(z[i]+u[i]*(dt-t),0.)+pmac_l[i]*K),evlast_l[pmac_l[i]])
+        slots=cumslots[sp+1]-cumslots[s]
+        free=slots-sum(occ[s:sp+1])
+        contactfac=(float(free)/slots if free>0 else 1.)/maccoatscaling
+        fac=retardfac if (film & wall) else 1.
+        if exfilt_method=='RWdiff':
+            c=np.random.rand()*contactfac*np.sqrt(2.*np.sqrt(Dm_l[s]*Dm_l[sp]))*fac
+            if c>0.:
+                u[i]*=max(pD-c*np.sqrt(dt-t),0.)/pD
+                t_ex[i]=t+(0.7*pD/c)**2
+        else:
+            q_ex[i]=Q_l[s]*contactfac*fac
+            if (not contacted[i]) and (q_ex[i]>0.) and (u[i]>0.):
+                [Qp,dpsi_p]=mac_exchange(mc.mac_evcell[[s]],mc.mac_evcell[[sp]],thS,mc,dynamic_pedo,ksnoise)
+                p_ex=pV*dpsi_p[0]/(Qp[0]*contactfac*fac)
+                u[i]=E_tkin_l[pmac_l[i]]/(p_ex+E_tkin_l[pmac_l[i]]/u[i])
+        contacted[i]=True
+
+    def schedule(i):
+        #next event of particle i from its current time
+        version[i]+=1
+        t=tnow[i]
+        if (state[i]==0) and (u[i]>0.):
+            t_move=t+(evbot_l[seg[i]]-z[i])/u[i]
+        else:
+            t_move=np.inf
+        if exfilt_method=='RWdiff':
+            t_exf=t_ex[i]
+        elif q_ex[i]>0.:
+            t_exf=t+(0.5*pD-expo[i])/q_ex[i]
+        else:
+            t_exf=np.inf
+        if min(t_move,t_exf)<dt:
+            heapq.heappush(heap,(min(t_move,t_exf),i,version[i],t_exf<=t_move))
+
+    def advance(i,t):
+        if state[i]==0:
+            z[i]+=u[i]*(t-tnow[i])
+        expo[i]+=q_ex[i]*(t-tnow[i])
+        tnow[i]=t
+
+    def enter(i,s,t):
+        occ[seg[i]]-=1
+        seg[i]=s
+        occ[s]+=1
+        #position in the segment in the order of arrival
+        contact1(i,t,occ[s]<=evslots_l[s])
+        schedule(i)
+
+    def release(s,t):
+        #a slot of segment s was freed at time t: the first particle waiting for it enters,
+        #which frees a slot in the segment above (up to a segment without waiting particles)
+        while (s in waiting) and (occ[s]<cap_l[s]):
+            queue=waiting[s]
+            while queue and (state[queue[0]]!=1):
+                queue.popleft()
+            if not queue:
+                return
+            j=queue.popleft()
+            advance(j,t)
+            state[j]=0
+            old=seg[j]
+            enter(j,s,t)
+            s=old
+
+    def leave(i,t,newstate):
+        state[i]=newstate
+        version[i]+=1
+        occ[seg[i]]-=1
+        release(seg[i],t)
+
+    while heap:
+        [t,i,ver,exf]=heapq.heappop(heap)
+        if ver!=version[i]:
+            continue #outdated event
+        advance(i,t)
+        if exf:
+            #exfiltration into the matrix
+            leave(i,t,2)
+            continue
+        s=seg[i]
+        z[i]=evbot_l[s]
+        if s==evlast_l[pmac_l[i]]:
+            #macropore bottom: drain at the lower boundary or exfiltrate
+            leave(i,t,3 if -z[i]<=mc.soildepth else 2)
+        elif occ[s+1]<cap_l[s+1]:
+            #end of segment: enter the next segment
+            enter(i,s+1,t)
+            release(s,t)
+        else:
+            #clogged: wait at the boundary
+            state[i]=1
+            waiting.setdefault(s+1,deque()).append(i)
+            schedule(i)
+
+    [z,u,seg,tnow,state]=[np.array(a) for a in [z,u,seg,tnow,state]]
+
+    #sync with the matrix time step
+    moving=(state==0)
+    z[moving]=np.fmin(z[moving]+u[moving]*(dt-tnow[moving]),evbot[seg[moving]])
+    s_red_store=z0-z
+
+    #assign new z into data frame:
+    p_lat=particles.lat.values[midx]
+    particles.z.iloc[midx]=-z
+    particles.cell.iloc[midx]=cellgrid(p_lat,-z,mc).astype(np.int64)
+
+    #assign updated advective velocity to particles
+    particles.advect.iloc[midx]=-u
+
+    exfilt=(state==2)
+    if any(exfilt):
+        exfilt_p+=sum(exfilt)
+        idy=midx[exfilt]
+        particles.flag.iloc[idy]=0
+        particles.lat.iloc[idy]=mac_exfilt_lat(-z[exfilt],pmac[exfilt],mc,refined)
+        particles.cell.iloc[idy]=cellgrid(particles.lat.values[idy],particles.z.values[idy],mc).astype(np.int64)
+        macbucket_remove(particles.index.values[idy],pmac[exfilt],mc)
+        cellbucket_add(particles.index.values[idy],particles.cell.values[idy],mc)
+
+    #handle draining particles if any
+    drain=(state==3)
+    if any(drain):
+        particles.flag.iloc[midx[drain]]=len(mc.maccols)+1
+        particles.z.iloc[midx[drain]]=mc.soildepth-0.0001
+        macbucket_remove(particles.index.values[midx[drain]],pmac[drain],mc)
+
+    #update occupancy: all particles leave their start slot, the remaining enter their new slot
+    np.add.at(mc.macocc,macslot(-z0,pmac,mc),-1)
+    np.add.at(mc.macocc,macslot(-z[state<2],pmac[state<2],mc),1)
 
     return [particles,s_red_store,exfilt_p]
 
+def mac_interface(thS,mc):
+    '''Active interface cells: cells adjoined to a macropore (mc.ifcells, non-zero macconnect)
+       with a state above field capacity. Only the interface cells are evaluated.
+    '''
+    if not hasattr(mc,'ifcells'):
+        mc.ifcells=np.where(mc.macconnect.ravel()>0)[0]
+    ifc=mc.ifcells
+    return ifc[thS.ravel()[ifc]>mc.FC[mc.soilgrid.ravel()[ifc]-1]]
+
+def cellmask(cells,ncells):
+    '''Lookup table of the grid cells (True for cells)
+    '''
+    mask=np.zeros(ncells,dtype=bool)
+    mask[cells]=True
+    return mask
 
+def ifrank(cells,mc):
+    '''Rank of the grid cells in the interface cells mc.ifcells (-1 for other cells and outside the grid)
+    '''
+    if not hasattr(mc,'ifrank'):
+        if not hasattr(mc,'ifcells'):
+            mc.ifcells=np.where(mc.macconnect.ravel()>0)[0]
+        mc.ifrank=-np.ones(mc.macconnect.size,dtype=np.int64)
+        mc.ifrank[mc.ifcells]=np.arange(len(mc.ifcells))
+    cells=np.asarray(cells).astype(np.int64)
+    rank=-np.ones(len(cells),dtype=np.int64)
+    valid=(cells>=0) & (cells<len(mc.ifrank))
+    rank[valid]=mc.ifrank[cells[valid]]
+    return rank
+
+def cellbucket_init(particles,mc):
+    '''Bucket index of the matrix particles in the interface cells (mc.ifcells).
+       mc.cellbucket holds the rank of the interface cell (see ifrank) and the label of
+       the particles, sorted by cell. It is rebuilt by part_diffusion_split, which moves all
+       matrix particles, and extended with cellbucket_add. Entries of particles which left
+       the cell or the matrix are skipped by cellbucket_find.
+    '''
+    rank=ifrank(particles.cell.values,mc)
+    sel=np.where((rank>=0) & (particles.flag.values==0))[0]
+    order=np.argsort(rank[sel],kind='mergesort')
+    mc.cellbucket=[rank[sel][order],particles.index.values[sel][order]]
+    return mc.cellbucket
+
+def cellbucket_add(labels,cells,mc):
+    '''Add matrix particles (labels) in the grid cells cells to the buckets of the interface cells
+    '''
+    if not hasattr(mc,'cellbucket'):
+        return
+    rank=ifrank(cells,mc)
+    sel=(rank>=0)
+    if any(sel):
+        rank=np.append(mc.cellbucket[0],rank[sel])
+        labels=np.append(mc.cellbucket[1],np.asarray(labels)[sel])
+        order=np.argsort(rank,kind='mergesort')
+        mc.cellbucket=[rank[order],labels[order]]
+
+def cellbucket_find(particles,cells,mc):
+    '''Positions (sorted) of the matrix particles in the interface cells cells from the bucket index.
+       Only the entries of these cells are located in the particle index (labelpos) and checked
+       against the cell and the flag of the particles.
+    '''
+    if not hasattr(mc,'cellbucket'):
+        cellbucket_init(particles,mc)
+    [rank,labels]=mc.cellbucket
+    r=ifrank(cells,mc)
+    start=np.searchsorted(rank,r,side='left')
+    n=np.searchsorted(rank,r,side='right')-start
+    idx=np.repeat(start-np.cumsum(n)+n,n)+np.arange(np.sum(n))
+    pos=labelpos(particles,labels[idx])
+    valid=(pos>=0)
+    valid[valid]=(particles.flag.values[pos[valid]]==0) & (particles.cell.values[pos[valid]]==mc.ifcells[rank[idx[valid]]])
+    return np.unique(pos[valid])
 
 def mx_mp_interact(particles,npart,thS,mc,dt,dynamic_pedo=False,ksnoise=1.):
     '''Calculate if matrix particles infiltrate into a macropore at the inferface areas
@@ -559,67 +1424,116 @@ def mx_mp_interact(particles,npart,thS,mc,dt,dynamic_pedo=False,ksnoise=1.):
     thS=thS.ravel()
     idx=np.where(thS>mc.FC[mc.soilgrid-1].ravel())[0]
     if len(idx)>0:
+        pcell=particles.cell.values.astype(np.int64)
         #a) exfiltration into macropores
-        idy=mc.macconnect.ravel()[idx]>0
-        if any(idy):
-            idc=np.in1d(particles.cell.values.astype(np.int),idx[idy]) #get index vector which particles are in affected cells
-            #DEBUG: maybe check if any idc is true?
+        ifa=mac_interface(thS,mc)
+        if len(ifa)>0:
+            #matrix particles in active interface cells from the per-cell index
+            idc=cellbucket_find(particles,ifa,mc)
             #we assume diffusive transport into macropore - allow diffusive step and check whether particeD/2 is moved -> then assign to macropore
-            N=np.sum(idc)
+            N=len(idc)
             xi=np.random.rand(N)
             if dynamic_pedo:
-                xsample=mc.soilgrid.ravel()[particles.cell[idc].values]-1
+                xsample=mc.soilgrid.ravel()[pcell[idc]]-1
                 if type(ksnoise)==float:
-                    D=vG.D_thst(thS[particles.cell[idc].values]/100.,mc.soilmatrix.ts[xsample],mc.soilmatrix.tr[xsample],ksnoise*mc.soilmatrix.ks[xsample],mc.soilmatrix.alpha[xsample],mc.soilmatrix.n[xsample]).values
+                    ksn=ksnoise
                 else:
-                    D=vG.D_thst(thS[particles.cell[idc].values]/100.,mc.soilmatrix.ts[xsample],mc.soilmatrix.tr[xsample],ksnoise[particles.cell[idc].values]*mc.soilmatrix.ks[xsample],mc.soilmatrix.alpha[xsample],mc.soilmatrix.n[xsample]).values
+                    ksn=ksnoise[pcell[idc]]
+                D=pedo_props(thS[pcell[idc]],xsample,mc,ksn,dynamic_pedo)[2]
             else:
-                D=mc.D[thS[particles.cell[idc].values],mc.soilgrid.ravel()[particles.cell[idc].values]-1]
+                D=mc.D[thS[pcell[idc]],mc.soilgrid.ravel()[pcell[idc]]-1]
             step_proj=(xi*((2.*D*dt)**0.5))
             ida=(step_proj>=mc.particleD/2.)
             if any(ida):
-                particles.loc[idc[ida],'flag']=mc.macconnect.ravel()[particles.cell[idc[ida]].values    ]
+                ent=idc[ida]
+                particles.flag.iloc[ent]=mc.macconnect.ravel()[pcell[ent]]
+                macbucket_add(particles.index.values[ent],particles.flag.values[ent],mc)
+                macocc_add(particles.z.values[ent],particles.flag.values[ent],mc)
         #b) bulk flow advection
-        idb=np.in1d(particles.cell.values.astype(np.int),idx.astype(np.int))
+        idb=np.where(cellmask(idx,len(thS))[pcell])[0]
         # allow only one particle in appropriate cell to move advectively - DEBUG: this should be an explicit parameter
-        dummy, idad = np.unique(particles.cell[idb].values.astype(np.int), return_index=True)
-        ida=np.where(idb)[0][idad]
+        # first particle of each cell: reversed assignment keeps the first occurrence
+        first=np.empty(len(thS),dtype=np.int64)
+        first[pcell[idb[::-1]]]=idb[::-1]
+        ida=first[np.where(cellmask(pcell[idb],len(thS)))[0]]
         z_new=particles.z.values[ida]+particles.advect.values[ida]*dt
         z_new[z_new<mc.soildepth]=mc.soildepth+0.0000001
+        macocc_add(particles.z.values[ida],particles.flag.values[ida],mc,-1)
+        macocc_add(z_new,particles.flag.values[ida],mc)
         particles.z.iloc[ida]=z_new
         particles.cell.iloc[ida]=cellgrid(particles.lat.values[ida],particles.z.values[ida],mc).astype(np.int64)
+        mx=(particles.flag.values[ida]==0)
+        cellbucket_add(particles.index.values[ida[mx]],particles.cell.values[ida[mx]],mc)
 
     return particles
 
-def mx_mp_interact_nobulk(particles,npart,thS,mc,dt,dynamic_pedo=False,ksnoise=1.):
+def mx_mp_interact_nobulk(particles,npart,thS,mc,dt,dynamic_pedo=False,ksnoise=1.,refined=False):
     '''Calculate if matrix particles infiltrate into a macropore at the inferface areas
+       refined: if True, the state and macropore contact of the locally refined grid is used
+                (requires macropore_ini.mac_refine_setup)
     '''
+    if refined:
+        return mx_mp_interact_ref(particles,mc,dt,dynamic_pedo,ksnoise)
     thS=thS.ravel()
-    idx=np.where(thS>mc.FC[mc.soilgrid-1].ravel())[0]
+    #flag for exfiltration into adjoined macropores
+    ifa=mac_interface(thS,mc)
+    if len(ifa)>0:
+        #matrix particles in active interface cells from the per-cell index
+        idc=cellbucket_find(particles,ifa,mc)
+        icell=particles.cell.values[idc].astype(np.int64)
+        #we assume diffusive transport into macropore - allow diffusive step and check whether particeD/2 is moved -> then assign to macropore
+        N=len(idc)
+        xi=np.random.rand(N)
+        if dynamic_pedo:
+            xsample=mc.soilgrid.ravel()[icell]-1
+            if type(ksnoise)==float:
+                ksn=ksnoise
+            else:
+                ksn=ksnoise[icell]
+            D=pedo_props(thS[icell],xsample,mc,ksn,dynamic_pedo)[2]
+        else:
+            D=mc.D[thS[icell],mc.soilgrid.ravel()[icell]-1]
+        step_proj=(xi*((6*D*dt)**0.5))
+        ida=(step_proj>=mc.particleD/2.)
+        if any(ida):
+            ent=idc[ida]
+            particles.flag.iloc[ent]=mc.macconnect.ravel()[icell[ida]]
+            particles.advect.iloc[ent]=assignadvect(len(ent),mc,mc.macconnect.ravel()[icell[ida]])
+            macbucket_add(particles.index.values[ent],particles.flag.values[ent],mc)
+            macocc_add(particles.z.values[ent],particles.flag.values[ent],mc)
+
+    return particles
+
+def mx_mp_interact_ref(particles,mc,dt,dynamic_pedo=False,ksnoise=1.):
+    '''Calculate if matrix particles infiltrate into a macropore at the inferface areas
+       based on the locally refined grid around the macropores
+    '''
+    [thS_r,npart_r,rcell]=gridupdate_thS_ref(particles.lat.values,particles.z.values,mc)
+    soil_r=mc.soilgrid.ravel()[mc.ref_parent]-1
+    idx=np.where((thS_r>mc.FC[soil_r]) & (mc.ref_macconnect>0))[0]
     if len(idx)>0:
-        #flag for exfiltration into adjoined macropores
-        thS0=thS*0.
-        thS0.ravel()[idx]=mc.macconnect.ravel()[idx]
-        idy=np.where(thS0.ravel()>0.)[0]
-        if any(idy):
-            idc=np.in1d(particles.cell.values.astype(np.int),idy) #get index vector which particles are in affected cells
-            #DEBUG: maybe check if any idc is true?
-            #we assume diffusive transport into macropore - allow diffusive step and check whether particeD/2 is moved -> then assign to macropore
-            N=np.sum(idc)
-            xi=np.random.rand(N)
-            if dynamic_pedo:
-                xsample=mc.soilgrid.ravel()[particles.cell[idc].values]-1
-                if type(ksnoise)==float:
-                    D=vG.D_thst(thS[particles.cell[idc].values]/100.,mc.soilmatrix.ts[xsample],mc.soilmatrix.tr[xsample],ksnoise*mc.soilmatrix.ks[xsample],mc.soilmatrix.alpha[xsample],mc.soilmatrix.n[xsample]).values
-                else:
-                    D=vG.D_thst(thS[particles.cell[idc].values]/100.,mc.soilmatrix.ts[xsample].values,mc.soilmatrix.tr[xsample].values,ksnoise[particles.cell[idc].values]*mc.soilmatrix.ks[xsample].values,mc.soilmatrix.alpha[xsample].values,mc.soilmatrix.n[xsample].values)
+        active=np.zeros(mc.ref_cells,dtype=bool)
+        active[idx]=True
+        idc=np.where(active[rcell] & (particles.flag.values==0))[0] #matrix particles in active interface cells
+        N=len(idc)
+        xi=np.random.rand(N)
+        xsample=soil_r[rcell[idc]]
+        if dynamic_pedo:
+            if type(ksnoise)==float:
+                ksn=ksnoise
             else:
-                D=mc.D[thS[particles.cell[idc].values],mc.soilgrid.ravel()[particles.cell[idc].values]-1]
-            step_proj=(xi*((6*D*dt)**0.5))
-            ida=(step_proj>=mc.particleD/2.)
-            if any(ida):
-                particles.loc[idc[ida],'flag']=mc.macconnect.ravel()[particles.cell[idc[ida]].values]
-                particles.loc[idc[ida],'advect']=assignadvect(sum(idc[ida]),mc,mc.macconnect.ravel()[particles.cell[idc[ida]].values])
+                ksn=ksnoise[mc.ref_parent[rcell[idc]]]
+            D=pedo_props(thS_r[rcell[idc]],xsample,mc,ksn,dynamic_pedo)[2]
+        else:
+            D=mc.D[thS_r[rcell[idc]],xsample]
+        step_proj=(xi*((6*D*dt)**0.5))
+        ida=idc[step_proj>=mc.particleD/2.]
+        if len(ida)>0:
+            macs=mc.ref_macconnect[rcell[ida]]
+            particles.flag.iloc[ida]=macs
+            particles.advect.iloc[ida]=assignadvect(len(ida),mc,macs)
+            macbucket_add(particles.index.values[ida],macs,mc)
+            macocc_add(particles.z.values[ida],macs,mc)
 
     return particles
 
@@ -658,18 +1572,17 @@ def part_diffusion_split(particles,npart,thS,mc,dt,uffink_corr=True,splitfac=5,v
         #u=u/theta
         #D=D/(theta**2)
         if dynamic_pedo:
-            theta=vG.theta_thst(thSx,mc.soilmatrix.ts[mc.soilgrid.ravel()-1],mc.soilmatrix.tr[mc.soilgrid.ravel()-1]).values/100.
-            u=vG.ku_thst(thSx/100.,mc.soilmatrix.ks[mc.soilgrid.ravel()-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()-1],mc.soilmatrix.n[mc.soilgrid.ravel()-1]).values/theta
-            D=vG.D_thst(thSx/100.,mc.soilmatrix.ts[mc.soilgrid.ravel()-1],mc.soilmatrix.tr[mc.soilgrid.ravel()-1],ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()-1],mc.soilmatrix.n[mc.soilgrid.ravel()-1]).values*theta
-            #print type(theta)
-            #print type(u)
-            #print type(D)
+            [theta,ku,D]=pedo_props(thSx,mc.soilgrid.ravel()-1,mc,ksnoise,dynamic_pedo)[:3]
+            u=ku/theta
+            D=D*theta
         else:
             u=mc.ku[thSx,mc.soilgrid.ravel()-1]/mc.theta[thSx,mc.soilgrid.ravel()-1]
             D=mc.D[thSx,mc.soilgrid.ravel()-1]*mc.theta[thSx,mc.soilgrid.ravel()-1]
 
         vert_sproj=vertcalfac*(dt*u[particles.cell[samplenow].values.astype(np.int)] + (xi[:,0]*((2*D[particles.cell[samplenow].values.astype(np.int)]*dt)**0.5)))
         lat_sproj=latcalfac*(xi[:,1]*((2*D[particles.cell[samplenow].values.astype(np.int)]*dt)**0.5))
+        if mc.prects=='radial':
+            lat_sproj+=latcalfac*radial_drift(particles.lat[samplenow].values,D[particles.cell[samplenow].values.astype(np.int)],dt,mc)
         
         if (uffink_corr==True):
             #Itô Scheme after Uffink 1990 and Kitanidis 1994 for vertical step
@@ -683,7 +1596,7 @@ def part_diffusion_split(particles,npart,thS,mc,dt,uffink_corr=True,splitfac=5,v
             lat_proj[samplenow]=particles.lat[samplenow].values+lat_sproj
             z_proj[samplenow]=particles.z[samplenow].values-vert_sproj
             [lat_proj,z_proj,nodrain]=boundcheck(lat_proj,z_proj,mc)
-            [thSx,npartx]=gridupdate_thS(lat_proj,z_proj,mc) 
+            [thSx,npartx]=gridupdate_thS(lat_proj,z_proj,mc,thS_float=(dynamic_pedo=='table'))
             thSx=thSx.ravel()
             cell_proj=cellgrid(lat_proj,z_proj,mc).astype(np.int64)
             #cut thSx>1 and thSx<0 for projection - in case they appear
@@ -697,9 +1610,9 @@ def part_diffusion_split(particles,npart,thS,mc,dt,uffink_corr=True,splitfac=5,v
             #u_proj=u_proj/theta_proj
             #D_proj=D_proj/(theta_proj**2)
             if dynamic_pedo:
-                theta_proj=vG.theta_thst(thSx,mc.soilmatrix.ts[mc.soilgrid.ravel()-1],mc.soilmatrix.tr[mc.soilgrid.ravel()-1]).values/100.
-                u_proj=vG.ku_thst(thSx/100.,ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()-1],mc.soilmatrix.n[mc.soilgrid.ravel()-1]).values/theta_proj
-                D_proj=vG.D_thst(thSx/100.,mc.soilmatrix.ts[mc.soilgrid.ravel()-1],mc.soilmatrix.tr[mc.soilgrid.ravel()-1],ksnoise*mc.soilmatrix.ks[mc.soilgrid.ravel()-1],mc.soilmatrix.alpha[mc.soilgrid.ravel()-1],mc.soilmatrix.n[mc.soilgrid.ravel()-1]).values*theta_proj
+                [theta_proj,ku_proj,D_proj]=pedo_props(thSx,mc.soilgrid.ravel()-1,mc,ksnoise,dynamic_pedo)[:3]
+                u_proj=ku_proj/theta_proj
+                D_proj=D_proj*theta_proj
             else:
                 u_proj=mc.ku[thSx,mc.soilgrid.ravel()-1]/mc.theta[thSx,mc.soilgrid.ravel()-1]
                 D_proj=mc.D[thSx,mc.soilgrid.ravel()-1]*mc.theta[thSx,mc.soilgrid.ravel()-1]
@@ -712,6 +1625,8 @@ def part_diffusion_split(particles,npart,thS,mc,dt,uffink_corr=True,splitfac=5,v
             # corrected step
             vert_sproj=vertcalfac*((corru-corrD)*dt + (xi[:,0]*((2*D[particles.cell[samplenow].values.astype(np.int)]*dt)**0.5)))
             lat_sproj=latcalfac*(xi[:,1]/np.abs(xi[:,1]))*corrD*dt + (xi[:,1]*((2*D_mean*dt)**0.5))
+            if mc.prects=='radial':
+                lat_sproj+=latcalfac*radial_drift(particles.lat[samplenow].values,D_mean,dt,mc)
 
         # new positions
         lat_new=particles.lat
@@ -722,10 +1637,10 @@ def part_diffusion_split(particles,npart,thS,mc,dt,uffink_corr=True,splitfac=5,v
         [lat_new,z_new,nodrain2]=boundcheck(lat_new,z_new,mc)
 
         # saturation check
-        [thS,npart]=gridupdate_thS(lat_new[nodrain],z_new[nodrain],mc) #DEBUG: externalise smooth parameter
+        [thS,npart]=gridupdate_thS(lat_new[nodrain],z_new[nodrain],mc,thS_float=(dynamic_pedo=='table')) #DEBUG: externalise smooth parameter
 
         if dynamic_pedo:
-            phi_mx=vG.psi_thst(thS.ravel()/100.,mc.soilmatrix.alpha[mc.soilgrid.ravel()-1],mc.soilmatrix.n[mc.soilgrid.ravel()-1]).values
+            phi_mx=pedo_props(thS.ravel(),mc.soilgrid.ravel()-1,mc,1.,dynamic_pedo)[3]
         else:
             phi_mx=mc.psi[thS.ravel(),mc.soilgrid.ravel()-1]+mc.mxdepth_cr
 
@@ -735,6 +1650,10 @@ def part_diffusion_split(particles,npart,thS,mc,dt,uffink_corr=True,splitfac=5,v
         if any(-nodrain):
             particles.loc[-nodrain,'flag']=len(mc.maccols)+1
 
+    #all matrix particles moved: rebuild the index of the interface cells if it is in use
+    if hasattr(mc,'cellbucket'):
+        cellbucket_init(particles,mc)
+
     return [particles,thS,npart,phi_mx]
 
 
@@ -66,7 +66,7 @@ def psi_thst(th_star,alpha,n,m=None):
     if m is None:
         m=1.-1./n
     psi = -1./alpha * ( (1-th_star**(1/m))/(th_star**(1/m)) )**(1./n)
-    if (np.iterable(psi)) & any(np.isinf(psi)):
+    if np.iterable(psi) and np.any(np.isinf(psi)):
         if type(alpha)==float:
             psi[np.isinf(psi)]=(-1./alpha * ( (1-0.98**(1/m))/(0.98**(1/m)) )**(1./n))
         else:
@@ -79,7 +79,7 @@ def psi_theta(theta,ths,thr,alpha,n,m=None):
         m=1.-1./n
     th_star=thst_theta(theta,ths,thr)
     psi= -1. * ( (1 - th_star**(1./m)) / (th_star**(1./m)) )**(1./n) / alpha
-    if (np.iterable(psi)) & any(np.isinf(psi)):
+    if np.iterable(psi) and np.any(np.isinf(psi)):
         if type(alpha)==float:
             psi[np.isinf(psi)]=(-1./alpha * ( (1-0.98**(1/m))/(0.98**(1/m)) )**(1./n))
         else:
@@ -106,24 +106,18 @@ def dpsidtheta_thst(th_star,ths,thr,alpha,n,m=None):
     #Calculate matrix head (psi) from relative saturation (theta*)
     if m is None:
         m=1.-1./n
-    if (type(th_star)==float) | (type(th_star)==np.float64):
-        if th_star>0.9899:
-            th_star=0.9899
-        if th_star<0.01:
-            th_star=0.01
-    else:
-        th_star[th_star>0.9899]=0.9899
-        th_star[th_star<0.01]=0.01
-    
+    #clip to a new array (the input is not modified)
+    th_star=np.clip(th_star,0.01,0.9899)
     th_star1=th_star-0.01
-    th_star+=0.01
+    th_star=th_star+0.01
     psi = -1./alpha * ( (1-th_star**(1/m))/(th_star**(1/m)) )**(1./n)
     psist = -1./alpha * ( (1-th_star1**(1/m))/(th_star1**(1/m)) )**(1./n)
 
+    psi98=-1./alpha * ( (1-0.98**(1/m))/(0.98**(1/m)) )**(1./n)
     if np.iterable(psi):
-        psi[np.isinf(psi)]=-1./alpha * ( (1-0.98**(1/m))/(0.98**(1/m)) )**(1./n)
+        psi=np.where(np.isinf(psi),psi98,psi)
     if np.iterable(psist):
-        psist[np.isinf(psist)]=-1./alpha * ( (1-0.98**(1/m))/(0.98**(1/m)) )**(1./n)
+        psist=np.where(np.isinf(psist),psi98,psist)
     
     theta=th_star*(ths-thr)+thr
     thetast=th_star1*(ths-thr)+thr
@@ -135,35 +129,21 @@ def D_psi(psi,ks,ths,thr,alpha,n,m=None):
     #Calculate diffusivity (D) from matrix head (psi)
     if m is None:
         m=1.-1./n
+    #the parameters broadcast against the stacked heads (first axis)
     psix=np.array([psi-0.05,psi,psi+0.05])
-    if isinstance(ks,np.float):
-        kus=ku_psi(psix, ks, alpha, n, m)
-        dth=np.diff(theta_thst(thst_psi(psix,alpha,n,m),ths,thr),axis=0)[0]
-    else:
-        kus=ku_psi(psix, ks.repeat(3).reshape(np.shape(psix)), alpha.repeat(3).reshape(np.shape(psix)), n.repeat(3).reshape(np.shape(psix)), m.repeat(3).reshape(np.shape(psix)))
-        dth=np.diff(theta_thst(thst_psi(psix,alpha.repeat(3).reshape(np.shape(psix)),n.repeat(3).reshape(np.shape(psix)),m.repeat(3).reshape(np.shape(psix))),ths.repeat(3).reshape(np.shape(psix)),thr.repeat(3).reshape(np.shape(psix))),axis=0)[0]
-    
-    if len(np.shape(kus))==1:
-        D=kus[1]*0.1/dth
-    else:
-        D=kus[1,:]*0.1/dth
+    kus=ku_psi(psix, ks, alpha, n, m)
+    dth=np.diff(theta_thst(thst_psi(psix,alpha,n,m),ths,thr),axis=0)[0]
+    D=kus[1]*0.1/dth
     return D
 
 def dDdtheta_thst(th_star,ths,thr,ks,alpha,n,m=None):
     #Calculate matrix head (psi) from relative saturation (theta*)
     if m is None:
         m=1.-1./n
-    if (type(th_star)==float) | (type(th_star)==np.float64):
-        if th_star>0.9899:
-            th_star=0.9899
-        if th_star<0.01:
-            th_star=0.01
-    else:
-        th_star[th_star>0.9899]=0.9899
-        th_star[th_star<0.01]=0.01
-    
+    #clip to a new array (the input is not modified)
+    th_star=np.clip(th_star,0.01,0.9899)
     th_star1=th_star-0.01
-    th_star+=0.01
+    th_star=th_star+0.01
     D=D_thst(th_star,ths,thr,ks,alpha,n,m)
     Dst=D_thst(th_star1,ths,thr,ks,alpha,n,m)
         
@@ -201,57 +181,67 @@ def dcst_thst(thst,ths,thr,ks,alpha,n,m=None):
     D=-ku/(c*theta_thst(thst,ths,thr))
     return D
 
+def vG_eval(th_star,ths,thr,ks,alpha,n,m=None,l=0.5):
+    #Evaluate theta, psi, ku, c, D and dpsi/dtheta from relative saturation (theta*) in one pass
+    #The parameters are plain arrays (or scalars) broadcasting against th_star.
+    #With x=th_star**(1/m) and y=(1-x)**m all functions follow from x and 1-y:
+    #  psi=-1/alpha*((1-x)/x)**(1/n), ku=ks*th_star**l*(1-y)**2
+    #  dpsi/dtheta analytic, c=-1/(dpsi/dtheta) (sign as c_psi), D=ku*dpsi/dtheta (D_thst for l=0.5)
+    #1-y is taken from expm1/log1p to avoid the cancellation at low saturation.
+    #psi is -inf at th_star=0 (no replacement as in psi_thst).
+    if m is None:
+        m=1.-1./n
+    x=th_star**(1./m)
+    r=(1.-x)/x
+    a=-np.expm1(m*np.log1p(-x))
+    theta=th_star*(ths-thr)+thr
+    psi=-1./alpha*r**(1./n)
+    ku=ks*th_star**l*a**2
+    dpsidtheta=(1.-m)/(alpha*m*(ths-thr)*x*th_star*r**m)
+    c=-1./dpsidtheta
+    D=ku*dpsidtheta
+    return [theta,psi,ku,c,D,dpsidtheta]
+
 
 # wrapper
+def soil_params(sample,mc):
+    #ts, tr, ks, alpha and n of the soils in sample (0-based) as plain arrays
+    sm=mc.soilmatrix
+    return [sm.ts.values[sample],sm.tr.values[sample],sm.ks.values[sample],sm.alpha.values[sample],sm.n.values[sample]]
+
 def th_psi_f(psi,sample,mc):
-    if (isinstance(psi,pd.DataFrame)) or (isinstance(psi,pd.Series)):
-        theta=theta_psi(psi.values, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        theta=theta_psi(psi, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    return theta
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return theta_psi(np.asarray(psi), ts, tr, alpha, n)
 
 def psi_th_f(theta,sample,mc):
-    if (isinstance(theta,pd.DataFrame)) or (isinstance(theta,pd.Series)):
-        psi=psi_theta(theta.values, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        psi=psi_theta(theta, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    return psi
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return psi_theta(np.asarray(theta), ts, tr, alpha, n)
 
 def psi_ths_f(thst,sample,mc):
-    if (isinstance(thst,pd.DataFrame)) or (isinstance(thst,pd.Series)):
-        psi=psi_thst(thst.values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        psi=psi_thst(thst, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    return psi
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return psi_thst(np.asarray(thst), alpha, n)
 
 def D_psi_f(psi,sample,mc):
-    if (isinstance(psi,pd.DataFrame)) or (isinstance(psi,pd.Series)):
-        D=D_psi(psi.values, mc.soilmatrix.ks[sample].values, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        D=D_psi(psi, mc.soilmatrix.ks[sample].values, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    return D
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return D_psi(np.asarray(psi), ks, ts, tr, alpha, n)
 
 def D_thst_f(thst,sample,mc):
-    if (isinstance(thst,pd.DataFrame)) or (isinstance(thst,pd.Series)):
-        D=D_thst(thst.values, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.ks[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        D=D_thst(thst, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.ks[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    return D
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return D_thst(np.asarray(thst), ts, tr, ks, alpha, n)
 
 def ku_psi_f(psi,sample,mc):
-    if (isinstance(psi,pd.DataFrame)) or (isinstance(psi,pd.Series)):
-        ku=ku_psi(psi.values, mc.soilmatrix.ks[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        ku=ku_psi(psi, mc.soilmatrix.ks[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    return ku
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return ku_psi(np.asarray(psi), ks, alpha, n)
 
 def Dku_thst_f(thst,sample,mc):
-    if (isinstance(thst,pd.DataFrame)) or (isinstance(thst,pd.Series)):
-        psi=psi_thst(thst.values,mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    else:
-        psi=psi_thst(thst,mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-
-    ku=ku_psi(psi, mc.soilmatrix.ks[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    D=D_psi(psi, mc.soilmatrix.ks[sample].values, mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values, mc.soilmatrix.alpha[sample].values, mc.soilmatrix.n[sample].values)
-    theta=theta_thst(thst,mc.soilmatrix.ts[sample].values, mc.soilmatrix.tr[sample].values)
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    thst=np.asarray(thst)
+    psi=psi_thst(thst, alpha, n)
+    ku=ku_psi(psi, ks, alpha, n)
+    D=D_psi(psi, ks, ts, tr, alpha, n)
+    theta=theta_thst(thst, ts, tr)
     return (D, ku, theta)
+
+def vG_eval_f(thst,sample,mc):
+    [ts,tr,ks,alpha,n]=soil_params(sample,mc)
+    return vG_eval(np.asarray(thst), ts, tr, ks, alpha, n)
@@ -0,0 +1,54 @@
+# Cold import time of the echoRD model core
+# Each sample imports the core modules in a fresh interpreter (as a pool worker does).
+# The core must not load plotting or imaging packages and should import within the target
+# (on top of its numpy, scipy and pandas dependencies).
+# usage: python import_time.py [samples] [target in s]
+
+import os, sys, subprocess
+import numpy as np
+
+core=['vG_conv','dataread','partdyn_d2','infilt','macropore_ini','mccache']
+heavy=['matplotlib','skimage','shapely','descartes']
+target=0.1 #[s] median cold import time of the core on top of numpy/scipy/pandas
+
+code='''
+import sys, time
+heavy=%r
+def loaded():
+    return set(m.split('.')[0] for m in sys.modules if m.split('.')[0] in heavy)
+t0=time.time()
+import numpy, scipy, scipy.ndimage, scipy.constants, pandas
+t1=time.time()
+deps=loaded()
+import %s
+t2=time.time()
+print t1-t0, t2-t1
+print ' '.join(sorted(loaded()-deps))
+''' % (heavy,', '.join(core))
+
+def import_time(samples=5):
+    '''Cold import time of the third party dependencies and of the core modules on top [s]
+       and the plotting/imaging packages loaded by the core (some pandas versions load
+       matplotlib themselves if it is installed, this is not counted)
+    '''
+    libdir=os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','echoRD'))
+    env=dict(os.environ)
+    env['PYTHONPATH']=os.pathsep.join([libdir]+[p for p in [env.get('PYTHONPATH')] if p])
+    times=[]
+    for i in np.arange(samples):
+        out=subprocess.check_output([sys.executable,'-c',code],env=env).splitlines()
+        times.append([float(t) for t in out[0].split()])
+        loaded=out[1].split() if len(out)>1 else []
+    times=np.array(times)
+    return [times[:,0],times[:,1],loaded]
+
+if __name__=='__main__':
+    samples=int(sys.argv[1]) if len(sys.argv)>1 else 5
+    if len(sys.argv)>2:
+        target=float(sys.argv[2])
+    [t_deps,times,loaded]=import_time(samples)
+    print 'cold import of numpy/scipy/pandas: median %.3f s' % np.median(t_deps)
+    print 'cold import of the core on top: median %.3f s, min %.3f s (target %.3f s)' % (np.median(times),np.min(times),target)
+    print 'plotting/imaging packages loaded: %s' % (', '.join(loaded) if loaded else 'none')
+    if loaded or (np.median(times)>target):
+        sys.exit(1)
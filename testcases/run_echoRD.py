@@ -1,7 +1,6 @@
 import numpy as np
 import pandas as pd
 import scipy as sp
-import matplotlib.pyplot as plt
 import scipy.constants as const
 import os, sys
 
@@ -33,10 +32,26 @@ def preproc_echoRD(mc, dr, mcp, pickfile='test.pickle'):
     mcp.mcpick_in(mc,pickfile)
     return mc
 
-def pickup_echoRD(mc, mcp, dr, pickfile='test.pickle'):
+def pickup_echoRD(mc, mcp, dr, pickfile='test.pickle', stream=False):
     mcp.mcpick_out(mc,pickfile)
     [mc,particles,npart]=dr.particle_setup(mc)
-    precTS=pd.read_csv(mc.precf, sep=',',skiprows=3)
+    if stream:
+        #the drivers stream the forcing file in time windows (precwindow)
+        precTS=mc.precf
+    else:
+        precTS=pd.read_csv(mc.precf, sep=',',skiprows=3)
+
+    return(mc,particles,npart,precTS)
+
+def pickup_cached(mc, dr, seed=None, cachedir=None, stream=False):
+    #preprocessed domain from the content addressed cache (built and stored if missing)
+    import mccache
+    mc=mccache.dataread_cached(mc,seed,cachedir)
+    [mc,particles,npart]=dr.particle_setup(mc)
+    if stream:
+        precTS=mc.precf
+    else:
+        precTS=pd.read_csv(mc.precf, sep=',',skiprows=3)
 
     return(mc,particles,npart,precTS)
 
@@ -60,29 +75,18 @@ def particle_setup_obs(theta_obs,mc,vG,dr,pdyn):
 
     # convert theta to particles
     # npart=moistdomain*(2*mc.part_sizefac)
-    npart=np.floor(mc.part_sizefac*vG.thst_theta(moistdomain,mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)), mc.soilmatrix.tr[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)))).astype(int)
+    npart=mc.part_sizefac*vG.thst_theta(moistdomain,mc.soilmatrix.ts[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)), mc.soilmatrix.tr[mc.soilgrid.ravel()-1].reshape(np.shape(mc.soilgrid)))
+    if getattr(mc,'prects',False)=='radial':
+        #ring volume of the cells in the axisymmetric domain
+        npart*=mc.radfac
+    npart=np.floor(npart).astype(int)
 
     # setup particle domain
-    particles=pd.DataFrame(np.zeros(int(np.sum(npart))*8).reshape(int(np.sum(npart)),8),columns=['lat', 'z', 'conc', 'temp', 'age', 'flag', 'fastlane', 'advect'])
-    particles['cell']=pd.Series(np.zeros(int(np.sum(npart)),dtype=int), index=particles.index)
-    # distribute particles
-    k=0
-    npartr=npart.ravel()
-    cells=len(npartr)
+    particles=dr.particle_init(npart,mc)
 
-    for i in np.arange(cells):
-        j=int(npartr[i])
-        particles.cell[k:(k+j)]=i
-        rw,cl=np.unravel_index(i,(mc.mgrid.vertgrid,mc.mgrid.latgrid))
-        particles.lat[k:(k+j)]=(cl+np.random.rand(j))*mc.mgrid.latfac.values
-        particles.z[k:(k+j)]=(rw+np.random.rand(j))*mc.mgrid.vertfac.values
-        k+=j
-
-    particles.fastlane=np.random.randint(len(mc.t_cdf_fast.T), size=len(particles))
-    particles.advect=pdyn.assignadvect(int(np.sum(npart)),mc,particles.fastlane.values,True)
-
-    mc.mgrid['cells']=cells
-    return [mc,particles.iloc[0:k,:],npart]
+    mc.mgrid['cells']=npart.size
+    pdyn.mac_geometry_setup(mc)
+    return [mc,particles,npart]
 
 
 def start_echoRDdx(mc,particles,npart,precTS,pdyn,cinf,runname='echoRD',t_end=3600.,output=60.,start_offset=0.,splitfac=10):
@@ -111,7 +115,7 @@ def start_echoRDxstore(mc,particles,npart,precTS,pdyn,cinf,runname='echoRD',t_en
     return TSstore
 
 
-def CAOSpy_rundx(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_max=1.,splitfac=10,prec_2D=False,maccoat=10.,exfilt_method='Ediss',saveDT=True,vertcalfac=1.,latcalfac=1.,clogswitch=False,infilt_method='MDA',film=True,infiltscale=False):
+def CAOSpy_rundx(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_max=1.,splitfac=10,prec_2D=False,maccoat=10.,exfilt_method='Ediss',saveDT=True,vertcalfac=1.,latcalfac=1.,clogswitch=False,infilt_method='MDA',film=True,infiltscale=False,refined=False,mac_mode='step',precwindow=86400.):
     if run_from_ipython():
         from IPython import display
 
@@ -120,9 +124,24 @@ def CAOSpy_rundx(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_
     acc_mxinf=0. #matrix infiltration may become very small - this shall handle that some particles accumulate to infiltrate
     exfilt_p=0. #exfiltration from the macropores
     s_red=0.
+    pdyn.macbucket_init(particles,mc) #index of particles per macropore
+    pdyn.macocc_init(particles,mc) #occupancy of the macropore grids
+    pdyn.cellbucket_init(particles,mc) #index of matrix particles per interface cell
+    if type(precTS)==str:
+        #forcing file streamed in time windows from its binary cache
+        preccache=cinf.prec_stream(precTS,mc)
+        precwin=tstart
+    else:
+        precsched=cinf.prec_schedule(precTS,mc) #forcing schedule
+        precwin=np.inf
     #loop through time
     while timenow < tstop:
-        [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+        if refined:
+            #coarse state aggregated from the locally refined grid
+            [thS_r,npart_r,rcell]=pdyn.gridupdate_thS_ref(particles.lat.values,particles.z.values,mc)
+            [thS,npart]=pdyn.ref_aggregate(npart_r,mc)
+        else:
+            [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
         if saveDT==True:
             #define dt as Courant/Neumann criterion
             dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[np.amax(thS),:]))
@@ -137,36 +156,52 @@ def CAOSpy_rundx(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_
                 dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[np.amax(thS),:]))*saveDT
                 dt_ku=-mc.mgrid.vertfac.values[0]/np.nanmax(mc.ku[np.amax(thS),:])*saveDT
                 dt=np.amin([dt_D,dt_ku,dt_max,tstop-timenow])
-        #INFILTRATION
-        [p_inf,prec_part,acc_mxinf]=cinf.pmx_infilt(timenow,precTS,prec_part,acc_mxinf,thS,mc,pdyn,dt,0.,prec_2D,particles.index[-1],infilt_method,infiltscale) #drain all ponding // leftover <-> 0.
-        particles=pd.concat([particles,p_inf])
+        #INFILTRATION (skipped in dry intervals of the forcing schedule)
+        if timenow>=precwin:
+            [precsched,precwin]=cinf.prec_window(preccache,timenow,timenow+precwindow)
+        if cinf.prec_lookup(timenow,precsched)[0]>0.:
+            [p_inf,prec_part,acc_mxinf]=cinf.pmx_infilt(timenow,precTS,prec_part,acc_mxinf,thS,mc,pdyn,dt,0.,prec_2D,particles.index[-1],infilt_method,infiltscale,schedule=precsched) #drain all ponding // leftover <-> 0.
+        else:
+            p_inf={'index':np.arange(0)}
+        particles=cinf.particles_append(particles,p_inf)
+        if len(p_inf['index'])>0:
+            pdyn.macbucket_add(p_inf['index'],p_inf['flag'],mc)
+            pdyn.macocc_add(p_inf['z'],p_inf['flag'],mc)
         
         #DIFFUSION
         [particles,thS,npart,phi_mx]=pdyn.part_diffusion_split(particles,npart,thS,mc,dt,False,splitfac,vertcalfac,latcalfac)
         #ADVECTION
         if not particles.loc[(particles.flag>0) & (particles.flag<len(mc.maccols)+1)].empty:
-            [particles,s_red,exfilt_p]=pdyn.mac_advection(particles,mc,thS,dt,clogswitch,maccoat,exfilt_method,film=film)
+            if mac_mode=='event':
+                #event-driven macropore transport within the matrix time step
+                [particles,s_red,exfilt_p]=pdyn.mac_advection_event(particles,mc,thS,dt,clogswitch,maccoat,exfilt_method,film=film,refined=refined)
+            else:
+                [particles,s_red,exfilt_p]=pdyn.mac_advection(particles,mc,thS,dt,clogswitch,maccoat,exfilt_method,film=film,refined=refined)
         #INTERACT
-        particles=pdyn.mx_mp_interact_nobulk(particles,npart,thS,mc,dt)
+        particles=pdyn.mx_mp_interact_nobulk(particles,npart,thS,mc,dt,refined=refined)
 
         if run_from_ipython():
             display.clear_output()
-            display.display_pretty(''.join(['time: ',str(timenow),'s  |  precip: ',str(len(p_inf)),' particles  |  mean v(adv): ',str(particles.loc[particles.flag>0,'advect'].mean()),' m/s  |  exfilt: ',str(int(exfilt_p)),' particles']))
+            display.display_pretty(''.join(['time: ',str(timenow),'s  |  precip: ',str(len(p_inf['index'])),' particles  |  mean v(adv): ',str(particles.loc[particles.flag>0,'advect'].mean()),' m/s  |  exfilt: ',str(int(exfilt_p)),' particles']))
         else:
             print 'time: ',timenow,'s'
 
         #CLEAN UP DATAFRAME
-        drained=drained.append(particles[particles.flag==len(mc.maccols)+1])
-        particles=particles[particles.flag!=len(mc.maccols)+1]
+        #particles dropped from the frame leave the macropore occupancy and buckets
+        drainmask=(particles.flag.values==len(mc.maccols)+1)
+        pdyn.macocc_leave(particles,drainmask,mc)
+        drained=drained.append(particles[drainmask])
+        particles=particles[~drainmask]
         pondparts=(particles.z<0.)
         leftover=np.count_nonzero(-pondparts)
         particles.cell[particles.cell<0]=mc.mgrid.cells.values
+        pdyn.macocc_leave(particles,~pondparts.values,mc)
         particles=particles[pondparts]
         timenow=timenow+dt
 
     return(particles,npart,thS,leftover,drained,timenow)
 
-def CAOSpy_rundx_noise(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_max=1.,splitfac=10,prec_2D=False,maccoat=10.,exfilt_method='Ediss',saveDT=True,vertcalfac=1.,latcalfac=1.,clogswitch=False,infilt_method='MDA',film=True,dynamic_pedo=True,ksnoise=1.):
+def CAOSpy_rundx_noise(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_max=1.,splitfac=10,prec_2D=False,maccoat=10.,exfilt_method='Ediss',saveDT=True,vertcalfac=1.,latcalfac=1.,clogswitch=False,infilt_method='MDA',film=True,dynamic_pedo=True,ksnoise=1.,refined=False,mac_mode='step',precwindow=86400.):
     if run_from_ipython():
         from IPython import display
 
@@ -175,13 +210,34 @@ def CAOSpy_rundx_noise(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drain
     acc_mxinf=0. #matrix infiltration may become very small - this shall handle that some particles accumulate to infiltrate
     exfilt_p=0. #exfiltration from the macropores
     s_red=0.
+    pdyn.macbucket_init(particles,mc) #index of particles per macropore
+    pdyn.macocc_init(particles,mc) #occupancy of the macropore grids
+    pdyn.cellbucket_init(particles,mc) #index of matrix particles per interface cell
+    if dynamic_pedo=='table':
+        #interpolated vG tables on a float thS (resolution of a previous pdyn.proptable_setup)
+        if not hasattr(mc,'ptab'):
+            pdyn.proptable_setup(mc)
+    else:
+        pdyn.pedo_tables(mc) #closed form vG tables of dynamic_pedo
+    if type(precTS)==str:
+        #forcing file streamed in time windows from its binary cache
+        preccache=cinf.prec_stream(precTS,mc)
+        precwin=tstart
+    else:
+        precsched=cinf.prec_schedule(precTS,mc) #forcing schedule
+        precwin=np.inf
     #loop through time
     while timenow < tstop:
-        [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+        if refined:
+            #coarse state aggregated from the locally refined grid
+            [thS_r,npart_r,rcell]=pdyn.gridupdate_thS_ref(particles.lat.values,particles.z.values,mc)
+            [thS,npart]=pdyn.ref_aggregate(npart_r,mc,thS_float=(dynamic_pedo=='table'))
+        else:
+            [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc,thS_float=(dynamic_pedo=='table'))
         if saveDT==True:
             #define dt as Courant/Neumann criterion
-            dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[np.amax(thS),:]))
-            dt_ku=-mc.mgrid.vertfac.values[0]/np.nanmax(mc.ku[np.amax(thS),:])
+            dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[int(np.amax(thS)),:]))
+            dt_ku=-mc.mgrid.vertfac.values[0]/np.nanmax(mc.ku[int(np.amax(thS)),:])
             dt=np.amin([dt_D,dt_ku,dt_max,tstop-timenow])
         else:
             if type(saveDT)==float:
@@ -189,39 +245,55 @@ def CAOSpy_rundx_noise(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drain
                 dt=np.amin([saveDT,tstop-timenow])
             elif type(saveDT)==int:
                 #define dt as modified  Corant/Neumann criterion
-                dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[np.amax(thS),:]))*saveDT
-                dt_ku=-mc.mgrid.vertfac.values[0]/np.nanmax(mc.ku[np.amax(thS),:])*saveDT
+                dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[int(np.amax(thS)),:]))*saveDT
+                dt_ku=-mc.mgrid.vertfac.values[0]/np.nanmax(mc.ku[int(np.amax(thS)),:])*saveDT
                 dt=np.amin([dt_D,dt_ku,dt_max,tstop-timenow])
-        #INFILTRATION
-        [p_inf,prec_part,acc_mxinf]=cinf.pmx_infilt(timenow,precTS,prec_part,acc_mxinf,thS,mc,pdyn,dt,0.,prec_2D,particles.index[-1],infilt_method) #drain all ponding // leftover <-> 0.
-        particles=pd.concat([particles,p_inf])
+        #INFILTRATION (skipped in dry intervals of the forcing schedule)
+        if timenow>=precwin:
+            [precsched,precwin]=cinf.prec_window(preccache,timenow,timenow+precwindow)
+        if cinf.prec_lookup(timenow,precsched)[0]>0.:
+            [p_inf,prec_part,acc_mxinf]=cinf.pmx_infilt(timenow,precTS,prec_part,acc_mxinf,thS,mc,pdyn,dt,0.,prec_2D,particles.index[-1],infilt_method,schedule=precsched) #drain all ponding // leftover <-> 0.
+        else:
+            p_inf={'index':np.arange(0)}
+        particles=cinf.particles_append(particles,p_inf)
+        if len(p_inf['index'])>0:
+            pdyn.macbucket_add(p_inf['index'],p_inf['flag'],mc)
+            pdyn.macocc_add(p_inf['z'],p_inf['flag'],mc)
         
         #DIFFUSION
-        [particles,thS,npart,phi_mx]=pdyn.part_diffusion_split(particles,npart,thS,mc,dt,False,splitfac,vertcalfac,latcalfac,dynamic_pedo=True,ksnoise=ksnoise)
+        [particles,thS,npart,phi_mx]=pdyn.part_diffusion_split(particles,npart,thS,mc,dt,False,splitfac,vertcalfac,latcalfac,dynamic_pedo=dynamic_pedo,ksnoise=ksnoise)
         #ADVECTION
         if not particles.loc[(particles.flag>0) & (particles.flag<len(mc.maccols)+1)].empty:
-            [particles,s_red,exfilt_p]=pdyn.mac_advection(particles,mc,thS,dt,clogswitch,maccoat,exfilt_method,film=film,dynamic_pedo=True,ksnoise=ksnoise)
+            if mac_mode=='event':
+                #event-driven macropore transport within the matrix time step
+                [particles,s_red,exfilt_p]=pdyn.mac_advection_event(particles,mc,thS,dt,clogswitch,maccoat,exfilt_method,film=film,dynamic_pedo=dynamic_pedo,ksnoise=ksnoise,refined=refined)
+            else:
+                [particles,s_red,exfilt_p]=pdyn.mac_advection(particles,mc,thS,dt,clogswitch,maccoat,exfilt_method,film=film,dynamic_pedo=dynamic_pedo,ksnoise=ksnoise,refined=refined)
         #INTERACT
-        particles=pdyn.mx_mp_interact_nobulk(particles,npart,thS,mc,dt,dynamic_pedo=True,ksnoise=ksnoise)
+        particles=pdyn.mx_mp_interact_nobulk(particles,npart,thS,mc,dt,dynamic_pedo=dynamic_pedo,ksnoise=ksnoise,refined=refined)
 
         if run_from_ipython():
             display.clear_output()
-            display.display_pretty(''.join(['time: ',str(timenow),'s  |  precip: ',str(len(p_inf)),' particles  |  mean v(adv): ',str(particles.loc[particles.flag>0,'advect'].mean()),' m/s  |  exfilt: ',str(int(exfilt_p)),' particles']))
+            display.display_pretty(''.join(['time: ',str(timenow),'s  |  precip: ',str(len(p_inf['index'])),' particles  |  mean v(adv): ',str(particles.loc[particles.flag>0,'advect'].mean()),' m/s  |  exfilt: ',str(int(exfilt_p)),' particles']))
         else:
             print 'time: ',timenow,'s'
 
         #CLEAN UP DATAFRAME
-        drained=drained.append(particles[particles.flag==len(mc.maccols)+1])
-        particles=particles[particles.flag!=len(mc.maccols)+1]
+        #particles dropped from the frame leave the macropore occupancy and buckets
+        drainmask=(particles.flag.values==len(mc.maccols)+1)
+        pdyn.macocc_leave(particles,drainmask,mc)
+        drained=drained.append(particles[drainmask])
+        particles=particles[~drainmask]
         pondparts=(particles.z<0.)
         leftover=np.count_nonzero(-pondparts)
         particles.cell[particles.cell<0]=mc.mgrid.cells.values
+        pdyn.macocc_leave(particles,~pondparts.values,mc)
         particles=particles[pondparts]
         timenow=timenow+dt
 
     return(particles,npart,thS,leftover,drained,timenow)
 
-def CAOSpy_rund_diffonly(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_max=1.,splitfac=10,prec_2D=False,saveDT=True,vertcalfac=1.,latcalfac=1.):
+def CAOSpy_rund_diffonly(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,drained,dt_max=1.,splitfac=10,prec_2D=False,saveDT=True,vertcalfac=1.,latcalfac=1.,precwindow=86400.):
     if run_from_ipython():
         from IPython import display
 
@@ -230,6 +302,13 @@ def CAOSpy_rund_diffonly(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,dra
     acc_mxinf=0. #matrix infiltration may become very small - this shall handle that some particles accumulate to infiltrate
     exfilt_p=0. #exfiltration from the macropores
     s_red=0.
+    if type(precTS)==str:
+        #forcing file streamed in time windows from its binary cache
+        preccache=cinf.prec_stream(precTS,mc)
+        precwin=tstart
+    else:
+        precsched=cinf.prec_schedule(precTS,mc) #forcing schedule
+        precwin=np.inf
    #loop through time
     while timenow < tstop:
         [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
@@ -247,23 +326,29 @@ def CAOSpy_rund_diffonly(tstart,tstop,mc,pdyn,cinf,precTS,particles,leftover,dra
                 dt_D=(mc.mgrid.vertfac.values[0])**2 / (6*np.nanmax(mc.D[np.amax(thS),:]))*saveDT
                 dt_ku=-mc.mgrid.vertfac.values[0]/np.nanmax(mc.ku[np.amax(thS),:])*saveDT
                 dt=np.amin([dt_D,dt_ku,tstop-timenow])
-        #INFILTRATION
-        [p_inf,prec_part,acc_mxinf]=cinf.pmx_infilt(timenow,precTS,prec_part,acc_mxinf,thS,mc,pdyn,dt,0.,prec_2D,particles.index[-1]) #drain all ponding // leftover <-> 0.
-        p_inf.flag=0
-        particles=pd.concat([particles,p_inf])
+        #INFILTRATION (skipped in dry intervals of the forcing schedule)
+        if timenow>=precwin:
+            [precsched,precwin]=cinf.prec_window(preccache,timenow,timenow+precwindow)
+        if cinf.prec_lookup(timenow,precsched)[0]>0.:
+            [p_inf,prec_part,acc_mxinf]=cinf.pmx_infilt(timenow,precTS,prec_part,acc_mxinf,thS,mc,pdyn,dt,0.,prec_2D,particles.index[-1],schedule=precsched) #drain all ponding // leftover <-> 0.
+        else:
+            p_inf={'index':np.arange(0)}
+        p_inf['flag']=np.zeros(len(p_inf['index']))
+        particles=cinf.particles_append(particles,p_inf)
         
         #DIFFUSION
         [particles,thS,npart,phi_mx]=pdyn.part_diffusion_split(particles,npart,thS,mc,dt,False,splitfac,vertcalfac,latcalfac)
         
         if run_from_ipython():
             display.clear_output()
-            display.display_pretty(''.join(['time: ',str(timenow),'s  |  precip: ',str(len(p_inf)),' particles']))
+            display.display_pretty(''.join(['time: ',str(timenow),'s  |  precip: ',str(len(p_inf['index'])),' particles']))
         else:
             print 'time: ',timenow,'s'
 
         #CLEAN UP DATAFRAME
-        drained=drained.append(particles[particles.flag==len(mc.maccols)+1])
-        particles=particles[particles.flag!=len(mc.maccols)+1]
+        drainmask=(particles.flag.values==len(mc.maccols)+1)
+        drained=drained.append(particles[drainmask])
+        particles=particles[~drainmask]
         pondparts=(particles.z<0.)
         leftover=np.count_nonzero(-pondparts)
         particles.cell[particles.cell<0]=mc.mgrid.cells.values
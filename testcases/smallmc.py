@@ -0,0 +1,52 @@
+# Small domains for the checks in testcases (test_*.py)
+# The domains are set up from mcini_specht4y without the image analysis
+# (a single macropore or a synthetic patch table) and without the domain and layer caches.
+
+import os, sys
+import numpy as np
+import pandas as pd
+
+testdir=os.path.dirname(os.path.abspath(__file__))
+
+def patch_layers():
+    '''Synthetic patch table of three image layers (as macropore_ini.macfind_layers)
+    '''
+    return pd.DataFrame(dict(depth=[0.1,0.2,0.4], no=[4,3,2], share=[0.01,0.008,0.005],
+                             minA=[5.,5.,5.], maxA=[20.,20.,20.], meanA=[10.,10.,10.], medianA=[10.,10.,10.],
+                             minP=[50.,50.,50.], maxP=[70.,70.,70.], meanP=[60.,60.,60.], medianP=[60.,60.,60.],
+                             minDia=[3.,3.,3.], maxDia=[6.,6.,6.], meanDia=[4.,4.,4.], medianDia=[4.,4.,4.],
+                             minmnD=[20.,20.,20.], maxmnD=[40.,40.,40.], meanmnD=[30.,30.,30.], medianmnD=[30.,31.,32.],
+                             minmxD=[100.,100.,100.], maxmxD=[200.,200.,200.], meanmxD=[150.,150.,150.], medianmxD=[150.,150.,150.]))
+
+def small_mc(seed=1,width=0.1,part_sizefac=50,layers=None):
+    '''Loads echoRD and sets up a single macropore domain of width [m]
+       layers: patch table of the image layers (see patch_layers) to set up the macropores
+               from instead of the single macropore
+       Outputs as run_echoRD.loadconnect and particle_setup: [dr,mc,pdyn,cinf,particles,npart]
+    '''
+    os.chdir(testdir)
+    if testdir not in sys.path:
+        sys.path.insert(0,testdir)
+    import run_echoRD as rE
+    sys.modules.pop('mcini_specht4y',None) #fresh parameter module
+    [dr,mc,mcp,pdyn,cinf,vG]=rE.loadconnect(pathdir=os.path.join(testdir,'..','echoRD'),mcinif='mcini_specht4y')
+    mc.nomac=width
+    mc.part_sizefac=part_sizefac
+    mc.cachedir=None
+    mc.advectref='Shipitalo'
+    np.random.seed(seed)
+    mc=dr.dataread_caos(mc,False)
+    if layers is not None:
+        import macropore_ini as mpo
+        mc.nomac=False
+        mc=mpo.mac_matrix_setup(layers,mc)
+    [mc,particles,npart]=dr.particle_setup(mc)
+    return [dr,mc,pdyn,cinf,particles,npart]
+
+def run_tests(module):
+    '''Runs the test_* functions of a module (for running the checks without pytest)
+    '''
+    tests=sorted(name for name in vars(module) if name.startswith('test_'))
+    for name in tests:
+        getattr(module,name)()
+        print name, 'ok'
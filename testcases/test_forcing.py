@@ -0,0 +1,123 @@
+# Checks of the forcing file streamed in time windows (infilt.prec_stream, prec_window)
+# against the schedule of the full table (infilt.prec_schedule)
+# usage: python test_forcing.py (or pytest)
+
+import os, sys, shutil, tempfile
+import numpy as np
+import pandas as pd
+from smallmc import testdir, run_tests
+sys.path.insert(0,os.path.join(testdir,'..','echoRD'))
+import infilt as cinf
+
+class forcing_mc:
+    prects=False
+    cachedir=None
+
+header='''// CAOS Irrigation Input file
+// all SI! put -9999 for missing value > try to compute in script; at least one (total/intensity) must be set
+// [s]           [s]          [m]         [m/s]        [g/m3]
+'''
+
+def write_forcing(rows,columns='tstart,tend,total,intense,conc'):
+    tmpdir=tempfile.mkdtemp()
+    precf=os.path.join(tmpdir,'irr.dat')
+    with open(precf,'w') as f:
+        f.write(header+columns+'\n')
+        for row in rows:
+            f.write(','.join(str(x) for x in row)+'\n')
+    return [tmpdir,precf]
+
+def stream_lookup(precf,times,window):
+    #forcing at times as the drivers stream it: a new window when the time crosses its end
+    cache=cinf.prec_stream(precf,forcing_mc(),chunksize=2)
+    precwin=times[0]
+    out=[]
+    for t in times:
+        if t>=precwin:
+            [sched,precwin]=cinf.prec_window(cache,t,t+window)
+        out.append(cinf.prec_lookup(t,sched))
+    return np.array(out)
+
+def test_stream_windows():
+    #events with a gap, the window from 1000 to 1500 has no events
+    rows=[[100,250,0.,2e-6,1.],[250,400,0.,3e-6,2.],[700,900,0.,1e-6,0.],[2100,2600,0.,4e-6,1.]]
+    [tmpdir,precf]=write_forcing(rows)
+    try:
+        times=np.arange(0.,3000.,5.)
+        stream=stream_lookup(precf,times,500.)
+        full=cinf.prec_schedule(pd.read_csv(precf,sep=',',skiprows=3),forcing_mc())
+        ref=np.array([cinf.prec_lookup(t,full) for t in times])
+        assert np.array_equal(stream[:,:2],ref[:,:2])
+        #the empty window has no forcing until its end
+        empty=(times>=1000.) & (times<1500.)
+        assert np.all(stream[empty,0]==0.)
+        assert np.all(stream[empty,2]==1500.)
+        #the next change of forcing within a window is the one of the full schedule
+        inwin=(ref[:,2]<np.floor(times/500.+1)*500.)
+        assert np.array_equal(stream[inwin,2],ref[inwin,2])
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_stream_missing_values():
+    #intensity from total over the duration, no concentration
+    [tmpdir,precf]=write_forcing([[100,300,0.002,-9999,-9999]])
+    try:
+        stream=stream_lookup(precf,np.array([50.,150.,350.]),200.)
+        assert np.allclose(stream[:,0],[0.,1e-5,0.])
+        assert np.all(stream[:,1]==0.)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_stream_checks():
+    #only event tables in the CAOS irrigation format are streamed
+    ts_mc=forcing_mc()
+    ts_mc.prects=True
+    [tmpdir,precf]=write_forcing([[100,300,0.,1e-6,1.]])
+    [tmpdir2,precf2]=write_forcing([[100,300,1e-6]],'tstart,tend,intense')
+    try:
+        for mc,f in [(ts_mc,precf),(forcing_mc(),precf2)]:
+            try:
+                cinf.prec_stream(f,mc)
+            except ValueError:
+                assert not os.path.exists(f+'.npy')
+                continue
+            raise AssertionError('forcing accepted for streaming')
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(tmpdir2)
+
+def test_stream_cachedir():
+    #the cache is written to mc.cachedir, not next to the forcing file
+    rows=[[100,250,0.,2e-6,1.],[700,900,0.,1e-6,0.]]
+    [tmpdir,precf]=write_forcing(rows)
+    cachedir=tempfile.mkdtemp()
+    try:
+        mc=forcing_mc()
+        mc.cachedir=os.path.join(cachedir,'forcing')
+        cache=cinf.prec_stream(precf,mc,chunksize=1)
+        assert os.listdir(tmpdir)==['irr.dat']
+        assert os.path.exists(cinf.prec_cachefile(precf,mc.cachedir))
+        assert np.array_equal(cache,np.array(rows)[:,[0,1,3,4]].T)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cachedir)
+
+def test_stream_order():
+    #unsorted and overlapping events are rejected, also across chunks of rows
+    bad=[[[100,250,0.,2e-6,1.],[700,900,0.,1e-6,0.],[300,400,0.,1e-6,0.]],
+         [[100,250,0.,2e-6,1.],[700,900,0.,1e-6,0.],[850,1000,0.,1e-6,0.]],
+         [[100,250,0.,2e-6,1.],[200,300,0.,1e-6,0.]]]
+    for rows in bad:
+        [tmpdir,precf]=write_forcing(rows)
+        try:
+            try:
+                cinf.prec_stream(precf,forcing_mc(),chunksize=2)
+            except ValueError:
+                assert os.listdir(tmpdir)==['irr.dat']
+                continue
+            raise AssertionError('unsorted or overlapping events accepted for streaming')
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__=='__main__':
+    run_tests(sys.modules[__name__])
@@ -0,0 +1,92 @@
+# Checks that the step (mac_advection) and event (mac_advection_event) macropore transport agree
+# for sparse particles in the single macropore domain
+# usage: python test_mac_modes.py (or pytest)
+
+import numpy as np
+from smallmc import small_mc, run_tests
+
+def sparse_particles(particles,mc,pdyn,N,spacing,u=None):
+    #N particles in the macropore, spacing [m] apart from the surface
+    p=particles.copy()
+    sel=np.arange(N)
+    p.flag.values[sel]=1
+    p.lat.values[sel]=mc.md_pos[0]
+    p.z.values[sel]=-np.arange(N)*spacing-0.001
+    p.advect.values[sel]=pdyn.assignadvect(N,mc) if u is None else u
+    for a in ['macbucket','macocc']:
+        if hasattr(mc,a):
+            delattr(mc,a)
+    return [p,sel]
+
+def test_modes_ediss():
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc()
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    for dt in [1.,60.]:
+        advect=[]
+        for mode in [pdyn.mac_advection,pdyn.mac_advection_event]:
+            [p,sel]=sparse_particles(particles,mc,pdyn,20,0.04,-0.05)
+            [p,s_red,exfilt_p]=mode(p,mc,thS,dt,False,1.,'Ediss',film=True)
+            assert exfilt_p==0
+            advect.append(p.advect.values[sel])
+        #the drag is applied once per time step in both modes
+        assert np.allclose(advect[1],advect[0],rtol=0.02)
+
+def test_modes_rwdiff():
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc()
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    result=[]
+    for mode in [pdyn.mac_advection,pdyn.mac_advection_event]:
+        exfilt=0.
+        dz=[]
+        for seed in range(10):
+            np.random.seed(seed)
+            [p,sel]=sparse_particles(particles,mc,pdyn,40,0.0025)
+            z0=p.z.values[sel].copy()
+            for step in range(3):
+                [p,s_red,exfilt_p]=mode(p,mc,thS,5.,False,1.,'RWdiff',film=True)
+                exfilt+=exfilt_p
+            inmac=(p.flag.values[sel]==1)
+            dz.append(np.median(p.z.values[sel][inmac]-z0[inmac]))
+        result.append([exfilt/400.,np.mean(dz)])
+    [[ex_step,dz_step],[ex_event,dz_event]]=result
+    assert dz_step<-0.2
+    assert abs(dz_event-dz_step)<0.05
+    assert abs(ex_event-ex_step)<0.05
+
+def test_event_occupancy():
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc()
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    np.random.seed(2)
+    [p,sel]=sparse_particles(particles,mc,pdyn,2000,0.00005)
+    for step in range(3):
+        [p,s_red,exfilt_p]=pdyn.mac_advection_event(p,mc,thS,1.,True,1.,'RWdiff',film=True)
+    #the occupancy kept by the event mode equals a recount of the particles
+    occ=mc.macocc.copy()
+    assert np.array_equal(occ,pdyn.macocc_init(p,mc))
+
+def test_event_clogging_order():
+    #events are processed in global time order: particle A enters segment 4 at t=0.1 and
+    #reaches the boundary of segment 5 at t=0.2, B reaches it later at t=0.25 with its first event
+    #segment 5 has one free slot, it is taken by A and B waits at the boundary
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc()
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    pdyn.mac_geometry_setup(mc)
+    mc.maccap=np.ones(np.shape(mc.maccap)) #capacity of a segment is its number of slots
+    evbot=mc.mac_evbot
+    full=mc.mac_evslots[5]-1
+    uA=(evbot[4]-evbot[3])/0.1
+    z=np.concatenate(([evbot[3]-0.1*uA,evbot[4]-0.25*0.01],evbot[4]+(np.arange(full)+0.5)*0.001))
+    u=np.concatenate(([uA,0.01],np.zeros(full)))
+    [p,sel]=sparse_particles(particles,mc,pdyn,len(z),0.,-u)
+    p.z.values[sel]=-z
+    #no exchange with the matrix (constant velocities)
+    [p,s_red,exfilt_p]=pdyn.mac_advection_event(p,mc,thS,0.28,True,np.inf,'Ediss',film=False)
+    assert exfilt_p==0
+    assert np.all(p.flag.values[sel]==1)
+    assert np.isclose(-p.z.values[sel[0]],evbot[4]+0.08*uA)
+    assert np.isclose(-p.z.values[sel[1]],evbot[4])
+    assert np.array_equal(mc.macocc,pdyn.macocc_init(p,mc))
+
+if __name__=='__main__':
+    import sys
+    run_tests(sys.modules[__name__])
@@ -0,0 +1,100 @@
+# Checks of the macropore bucket index (partdyn_d2.macbucket_*) against a groupby of the flags
+# and of the index of the interface cells (partdyn_d2.cellbucket_*) against a lookup of all cells
+# usage: python test_macbucket.py (or pytest)
+
+import numpy as np
+import pandas as pd
+from smallmc import small_mc, patch_layers, run_tests
+
+def bucket_mc(n=300,seed=3):
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc(layers=patch_layers())
+    np.random.seed(seed)
+    sel=np.random.choice(len(particles),n,replace=False)
+    particles.flag.values[sel]=np.random.randint(1,len(mc.maccols)+1,n)
+    pdyn.macbucket_init(particles,mc)
+    return [mc,pdyn,particles]
+
+def groupby_flags(particles,mc):
+    #positions of the particles in each macropore from a groupby of the flags
+    pos=pd.Series(np.arange(len(particles))).groupby(particles.flag.values)
+    mac=[]
+    idx=[]
+    for flag,group in pos:
+        if (flag>0) & (flag<=len(mc.maccols)):
+            idx.append(np.sort(group.values))
+            mac.append(np.repeat(flag-1,len(group)))
+    return [np.concatenate(idx),np.concatenate(mac)]
+
+def check_buckets(particles,mc,pdyn):
+    [midx,pmac]=pdyn.macbucket_all(particles,mc)
+    [eidx,emac]=groupby_flags(particles,mc)
+    assert np.array_equal(midx,eidx)
+    assert np.array_equal(pmac,emac)
+
+def test_bucket_init():
+    [mc,pdyn,particles]=bucket_mc()
+    check_buckets(particles,mc,pdyn)
+
+def test_bucket_reuse():
+    [mc,pdyn,particles]=bucket_mc()
+    inmac=np.where(particles.flag.values>0)[0]
+    #some particles leave the macropores through the model (removed from the buckets)
+    out=inmac[:40]
+    outlabels=particles.index.values[out]
+    pdyn.macbucket_remove(outlabels,particles.flag.values[out].astype(int)-1,mc)
+    particles.flag.values[out]=0
+    #some rows are dropped from the frame (stale entries in the buckets)
+    dropped=particles.index.values[inmac[40:100]]
+    particles=particles.drop(dropped)
+    check_buckets(particles,mc,pdyn)
+    #new particles reuse the dropped labels, in decreasing order and with other macropores
+    p_new=particles.iloc[:len(dropped)].copy()
+    p_new.index=dropped[::-1]
+    p_new.flag=np.random.randint(1,len(mc.maccols)+1,len(dropped))
+    particles=pd.concat([particles,p_new])
+    assert not particles.index.is_monotonic_increasing
+    pdyn.macbucket_add(p_new.index.values,p_new.flag.values,mc)
+    check_buckets(particles,mc,pdyn)
+    #particles which left reenter the macropores
+    flags=np.random.randint(1,len(mc.maccols)+1,len(outlabels))
+    particles.loc[outlabels,'flag']=flags
+    pdyn.macbucket_add(outlabels,flags,mc)
+    check_buckets(particles,mc,pdyn)
+
+def test_bucket_labels_unique():
+    [mc,pdyn,particles]=bucket_mc()
+    particles=pd.concat([particles,particles.iloc[:5]])
+    try:
+        pdyn.macbucket_all(particles,mc)
+    except ValueError:
+        return
+    raise AssertionError('duplicate particle labels not detected')
+
+def check_cells(particles,mc,pdyn,cells):
+    #matrix particles in the interface cells from a lookup of the cell of every particle
+    ref=np.where(pdyn.cellmask(cells,mc.macconnect.size)[particles.cell.values.astype(np.int64)] & (particles.flag.values==0))[0]
+    assert len(ref)>0
+    assert np.array_equal(pdyn.cellbucket_find(particles,cells,mc),ref)
+
+def test_cellbucket():
+    [mc,pdyn,particles]=bucket_mc()
+    pdyn.cellbucket_init(particles,mc)
+    cells=mc.ifcells[::2]
+    check_cells(particles,mc,pdyn,cells)
+    check_cells(particles,mc,pdyn,mc.ifcells)
+    #matrix particles enter the macropores, rows are dropped and the index is not monotonic
+    inif=pdyn.cellbucket_find(particles,mc.ifcells,mc)
+    particles.flag.values[inif[::3]]=1
+    particles=particles.drop(particles.index[inif[1::4]])
+    particles=pd.concat([particles.iloc[100:],particles.iloc[:100]])
+    check_cells(particles,mc,pdyn,cells)
+    #particles exfiltrate from the macropores into interface cells
+    out=np.where(particles.flag.values==1)[0][:50]
+    particles.flag.values[out]=0
+    particles.cell.values[out]=np.random.choice(mc.ifcells,len(out))
+    pdyn.cellbucket_add(particles.index.values[out],particles.cell.values[out],mc)
+    check_cells(particles,mc,pdyn,mc.ifcells)
+
+if __name__=='__main__':
+    import sys
+    run_tests(sys.modules[__name__])
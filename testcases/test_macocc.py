@@ -0,0 +1,54 @@
+# Checks of the macropore occupancy state (partdyn_d2.macocc_*) when particles leave
+# the macropore between steps (as by the driver's clean up with macocc_leave)
+# usage: python test_macocc.py (or pytest)
+
+import numpy as np
+from smallmc import small_mc, run_tests
+
+def leave_between_steps(mode):
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc()
+    mode=getattr(pdyn,mode)
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    np.random.seed(1)
+    N=500
+    particles.flag.values[:N]=1
+    particles.lat.values[:N]=mc.md_pos[0]
+    particles.z.values[:N]=-np.random.rand(N)*0.05
+    particles.advect.values[:N]=pdyn.assignadvect(N,mc)
+    [particles,s_red,exfilt_p]=mode(particles,mc,thS,1.,True,1.,'RWdiff',film=True)
+    #particles leave the macropore: rows dropped and flags reset in the frame
+    inmac=np.where(particles.flag.values==1)[0]
+    pdyn.macocc_leave(particles,inmac[::7],mc)
+    particles.flag.values[inmac[::7]]=0
+    dropped=inmac[1::5]
+    dropped=dropped[particles.flag.values[dropped]==1]
+    pdyn.macocc_leave(particles,dropped,mc)
+    particles=particles.drop(particles.index[dropped])
+    occ=mc.macocc.copy()
+    assert np.array_equal(occ,pdyn.macocc_init(particles,mc))
+    mc.macocc=occ
+    result=[]
+    for fresh in [False,True]:
+        if fresh:
+            del mc.macocc, mc.macbucket
+        p=particles.copy()
+        np.random.seed(2)
+        [p,s_red,exfilt_p]=mode(p,mc,thS,1.,True,1.,'RWdiff',film=True)
+        result.append([p,mc.macocc.copy()])
+    #the next step is the same as with an occupancy counted from the particles
+    assert np.array_equal(result[0][0].z.values,result[1][0].z.values)
+    assert np.array_equal(result[0][0].flag.values,result[1][0].flag.values)
+    assert np.array_equal(result[0][0].advect.values,result[1][0].advect.values)
+    assert np.array_equal(result[0][1],result[1][1])
+    del mc.macocc
+    assert np.array_equal(result[1][1],pdyn.macocc_init(result[1][0],mc))
+
+def test_leave_step():
+    leave_between_steps('mac_advection')
+
+def test_leave_event():
+    leave_between_steps('mac_advection_event')
+
+if __name__=='__main__':
+    import sys
+    run_tests(sys.modules[__name__])
@@ -0,0 +1,71 @@
+# Checks of the interpolated property tables (partdyn_d2.proptable_*) in a model step with
+# dynamic_pedo='table' against the closed form vG functions at the float thS
+# usage: python test_proptable.py (or pytest)
+
+import numpy as np
+from smallmc import small_mc, patch_layers, run_tests
+
+def closed_form(pdyn):
+    #vG values of pedo_props from the closed forms at any thS (theta as in pedo_tables)
+    vG=pdyn.vG
+    def props(thS,soil,mc,ksn=1.,dynamic_pedo=True):
+        [ts,tr,ks,alpha,n]=[mc.soilmatrix[c].values[soil] for c in ['ts','tr','ks','alpha','n']]
+        thS=np.asarray(thS,dtype=np.float64)
+        with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+            psi=vG.psi_thst(thS/100.,alpha,n)
+            return [vG.theta_thst(thS,ts,tr)/100.,vG.ku_thst(thS/100.,ks,alpha,n)*ksn,vG.D_thst(thS/100.,ts,tr,ks,alpha,n)*ksn,
+                    psi,vG.D_psi(psi,ks,ts,tr,alpha,n)*ksn]
+    return props
+
+def model_step(particles,mc,pdyn,dt):
+    #diffusion, macropore advection (RWdiff) and macropore entry as in CAOSpy_rundx_noise
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc,thS_float=True)
+    np.random.seed(4)
+    [particles,thS,npart,phi_mx]=pdyn.part_diffusion_split(particles,npart,thS,mc,dt,True,2,dynamic_pedo='table')
+    [particles,s_red,exfilt_p]=pdyn.mac_advection(particles,mc,thS,dt,False,1.,'RWdiff',dynamic_pedo='table')
+    particles=pdyn.mx_mp_interact_nobulk(particles,npart,thS,mc,dt,dynamic_pedo='table')
+    return [particles,thS,phi_mx]
+
+def test_table_step():
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc(layers=patch_layers())
+    pdyn.proptable_setup(mc,10000,'pchip')
+    inmac=np.arange(0,len(particles),50)
+    particles.flag.values[inmac]=np.random.randint(1,len(mc.maccols)+1,len(inmac))
+    particles.lat.values[inmac]=mc.md_pos[particles.flag.values[inmac].astype(int)-1]
+    particles.advect.values[inmac]=pdyn.assignadvect(len(inmac),mc)
+    result=[]
+    table=pdyn.pedo_props
+    for props in [table,closed_form(pdyn)]:
+        pdyn.pedo_props=props
+        try:
+            for a in ['macbucket','macocc','cellbucket']:
+                if hasattr(mc,a):
+                    delattr(mc,a)
+            result.append(model_step(particles.copy(),mc,pdyn,60.))
+        finally:
+            pdyn.pedo_props=table
+    [[p_tab,thS_tab,phi_tab],[p_ref,thS_ref,phi_ref]]=result
+    #the state is a float thS, the step agrees with the closed forms
+    assert thS_tab.dtype.kind=='f'
+    assert np.any(thS_tab!=np.round(thS_tab))
+    assert np.array_equal(p_tab.flag.values,p_ref.flag.values)
+    assert not np.array_equal(p_tab.flag.values,particles.flag.values)
+    assert np.allclose(p_tab.z.values,p_ref.z.values,rtol=1e-6,atol=1e-9)
+    assert np.allclose(p_tab.lat.values,p_ref.lat.values,rtol=1e-6,atol=1e-9)
+    assert np.allclose(thS_tab,thS_ref)
+    assert np.allclose(phi_tab,phi_ref,rtol=1e-5)
+
+def test_table_props():
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc()
+    pdyn.proptable_setup(mc,10000,'pchip')
+    np.random.seed(5)
+    thS=np.random.rand(500)*98.+1.
+    soil=np.random.randint(0,len(mc.soilmatrix),500)
+    tab=pdyn.pedo_props(thS,soil,mc,0.5,'table')
+    ref=closed_form(pdyn)(thS,soil,mc,0.5)
+    for i in range(5):
+        assert np.allclose(tab[i],ref[i],rtol=1e-4)
+
+if __name__=='__main__':
+    import sys
+    run_tests(sys.modules[__name__])
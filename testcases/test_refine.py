@@ -0,0 +1,90 @@
+# Checks of the locally refined grid around the macropores (macropore_ini.mac_refine_setup)
+# usage: python test_refine.py (or pytest)
+
+import numpy as np
+from smallmc import small_mc, patch_layers, run_tests
+
+def refined_mc(reffac=2,halo=1):
+    [dr,mc,pdyn,cinf,particles,npart]=small_mc(layers=patch_layers())
+    import macropore_ini as mpo
+    mc=mpo.mac_refine_setup(mc,reffac,halo)
+    return [mc,pdyn,particles]
+
+def test_refine_setup():
+    [mc,pdyn,particles]=refined_mc()
+    cells=int(mc.mgrid.cells.values[0])
+    nref=int(mc.ref_mask.sum())
+    assert mc.ref_cells==cells+nref*4
+    #each coarse cell is covered once by its own number or by its subcells
+    area=np.bincount(mc.ref_parent,weights=mc.ref_area,minlength=cells)
+    assert np.allclose(area,1.)
+    #subcells in contact with the macropore lie in refined cells adjoined to it
+    sub=np.where(mc.ref_macconnect[cells:]>0)[0]+cells
+    assert len(sub)>0
+    assert np.all(mc.ref_mask.ravel()[mc.ref_parent[sub]])
+    assert np.all(mc.ref_macconnect[:cells][mc.ref_mask.ravel()]==0)
+
+def test_refine_cells():
+    [mc,pdyn,particles]=refined_mc()
+    #the mixed cell of each particle refers to its coarse cell
+    rcell=pdyn.cellgrid_ref(particles.lat.values,particles.z.values,mc)
+    assert np.array_equal(mc.ref_parent[rcell],pdyn.cellgrid(particles.lat.values,particles.z.values,mc))
+
+def test_refine_interact():
+    [mc,pdyn,particles]=refined_mc()
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    np.random.seed(2)
+    particles=pdyn.mx_mp_interact_nobulk(particles,npart,thS,mc,60.,refined=True)
+    entered=particles.flag.values>0
+    assert np.any(entered)
+    #particles only enter from subcells in contact with the macropore
+    rcell=pdyn.cellgrid_ref(particles.lat.values[entered],particles.z.values[entered],mc)
+    assert np.all(mc.ref_macconnect[rcell]==particles.flag.values[entered])
+
+def test_refine_aggregate():
+    [mc,pdyn,particles]=refined_mc()
+    [thS_r,npart_r,rcell]=pdyn.gridupdate_thS_ref(particles.lat.values,particles.z.values,mc)
+    #the aggregated refined state is the state of the coarse grid
+    for thS_float in [False,True]:
+        [thS,npart]=pdyn.ref_aggregate(npart_r,mc,thS_float)
+        [thS_c,npart_c]=pdyn.gridupdate_thS(particles.lat,particles.z,mc,thS_float=thS_float)
+        assert np.array_equal(npart,npart_c)
+        assert np.array_equal(thS,thS_c)
+        assert thS.dtype==thS_c.dtype
+
+def test_refine_exfilt():
+    [mc,pdyn,particles]=refined_mc()
+    [thS,npart]=pdyn.gridupdate_thS(particles.lat,particles.z,mc)
+    for mode in [pdyn.mac_advection,pdyn.mac_advection_event]:
+        np.random.seed(3)
+        p=particles.copy()
+        inmac=np.arange(0,len(p),20)
+        p.flag.values[inmac]=np.random.randint(1,len(mc.maccols)+1,len(inmac))
+        p.lat.values[inmac]=mc.md_pos[p.flag.values[inmac].astype(int)-1]
+        p.advect.values[inmac]=pdyn.assignadvect(len(inmac),mc)
+        flags=p.flag.values.copy()
+        for a in ['macbucket','macocc']:
+            if hasattr(mc,a):
+                delattr(mc,a)
+        [p,s_red,exfilt_p]=mode(p,mc,thS,60.,False,1.,'RWdiff',film=True,refined=True)
+        ex=inmac[(p.flag.values[inmac]==0)]
+        assert len(ex)>0
+        lat=p.lat.values[ex]
+        z=p.z.values[ex]
+        #exfiltrated particles are placed into subcells in contact with their macropore
+        #where their row of the fine grid has one, else within the contact width
+        rw=np.floor(z/(mc.mgrid.vertfac.values[0]/mc.ref_fac)).astype(np.int64)
+        rw=np.fmin(np.fmax(rw,0),np.shape(mc.ref_idx)[0]-1)
+        incontact=np.any(mc.ref_macconnect[mc.ref_idx[rw,:]]==flags[ex][:,np.newaxis],axis=1)
+        assert np.sum(incontact)>len(ex)/2
+        rcell=pdyn.cellgrid_ref(lat,z,mc)
+        assert np.all(mc.ref_macconnect[rcell[incontact]]==flags[ex][incontact])
+        pmac=flags[ex][~incontact].astype(np.int64)-1
+        macincr=np.fmin(pdyn.macdepth_idx(z[~incontact],mc),np.shape(mc.md_contact)[1]-1)
+        assert np.all(np.abs(lat[~incontact]-mc.md_pos[pmac])<=mc.md_contact[pmac,macincr]/2.)
+        #the cell of the exfiltrated particles is the one of their new position
+        assert np.array_equal(p.cell.values[ex],pdyn.cellgrid(lat,z,mc))
+
+if __name__=='__main__':
+    import sys
+    run_tests(sys.modules[__name__])